@@ -0,0 +1,307 @@
+"""
+CipherH Analytics Rollups
+
+Materialized per-day, per-platform aggregates for /api/analytics/summary:
+interaction count, sentiment sum/count and a HyperLogLog sketch of distinct
+active users. Closed days are built from Interaction by a background job and
+stored in the daily_rollups table, and the summary combines them with a live
+query over the still-open tail. Days that are not built yet are covered by
+that live query too, so a summary never waits for a build. The cost of a
+365-day summary is dominated by reading 365 rollup rows, not by scanning a
+year of interactions.
+
+Flushing an insert, update or delete of an interaction in a closed day
+deletes that day's rollup in the same transaction, and the background job
+rebuilds it.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, func, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import db
+from models import Interaction
+
+ALL_PLATFORMS = '*'
+
+
+class HyperLogLog:
+    """Fixed-size distinct-count sketch (p=11: 2048 registers, ~2.3% error)"""
+    P = 11
+    M = 1 << P
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers else bytearray(self.M)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.P)
+        rest = h & ((1 << (64 - self.P)) - 1)
+        rank = (64 - self.P) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.M)
+        estimate = alpha * self.M * self.M / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.M and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.M * math.log(self.M / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+
+class DailyRollup(db.Model):
+    __tablename__ = 'daily_rollups'
+
+    day = db.Column(db.Date, primary_key=True)
+    platform = db.Column(db.String(50), primary_key=True)
+    interaction_count = db.Column(db.Integer, nullable=False, default=0)
+    sentiment_sum = db.Column(db.Float, nullable=False, default=0.0)
+    sentiment_count = db.Column(db.Integer, nullable=False, default=0)
+    user_sketch = db.Column(db.LargeBinary, nullable=False)
+    built_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class RollupEngine:
+    """Builds missing daily rollups and answers summary queries from them"""
+    # Days are only closed once late write-behind flushes can no longer land in them
+    CLOSE_GRACE = timedelta(hours=1)
+
+    def __init__(self):
+        self.app = None
+        self._table_ready = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._wanted_from = None
+        self.stats = {'built': 0, 'invalidated': 0, 'failed_builds': 0}
+
+    def _ensure_table(self, bind=None):
+        if not self._table_ready:
+            DailyRollup.__table__.create(bind if bind is not None else db.engine, checkfirst=True)
+            self._table_ready = True
+
+    def last_closed_day(self, now=None):
+        return ((now or datetime.utcnow()) - self.CLOSE_GRACE).date() - timedelta(days=1)
+
+    def ensure_started(self, app):
+        """Start the background job that builds missing rollups"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.app = app
+            self._thread = threading.Thread(target=self._run, name='cipherh-rollups', daemon=True)
+            self._thread.start()
+
+    def request_build(self, first_day):
+        """Have the background job build every missing closed day from first_day on"""
+        with self._lock:
+            if self._wanted_from is None or first_day < self._wanted_from:
+                self._wanted_from = first_day
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(600)
+            self._wake.clear()
+            if self._wanted_from is None:
+                continue
+            try:
+                with self.app.app_context():
+                    self.ensure_built(self._wanted_from, self.last_closed_day())
+            except Exception as e:
+                self.stats['failed_builds'] += 1
+                logging.error(f'CipherH: Building analytics rollups failed: {e}')
+            finally:
+                with self.app.app_context():
+                    db.session.remove()
+
+    def _aggregate(self, start, end):
+        """Per-platform aggregates and user sketches for interactions in [start, end)"""
+        rows = db.session.query(
+            Interaction.platform,
+            func.count(Interaction.id),
+            func.sum(Interaction.sentiment_score),
+            func.count(Interaction.sentiment_score)
+        ).filter(
+            Interaction.timestamp >= start, Interaction.timestamp < end
+        ).group_by(Interaction.platform).all()
+        aggregates = {
+            platform: {'count': count, 'sentiment_sum': float(s_sum or 0.0), 'sentiment_count': s_count}
+            for platform, count, s_sum, s_count in rows
+        }
+
+        sketches = {ALL_PLATFORMS: HyperLogLog()}
+        users = db.session.query(Interaction.platform, Interaction.user_id).filter(
+            Interaction.timestamp >= start, Interaction.timestamp < end
+        ).distinct().yield_per(5000)
+        for platform, user_id in users:
+            sketches.setdefault(platform, HyperLogLog()).add(user_id)
+            sketches[ALL_PLATFORMS].add(user_id)
+        return aggregates, sketches
+
+    def build_day(self, day):
+        start = datetime.combine(day, datetime.min.time())
+        aggregates, sketches = self._aggregate(start, start + timedelta(days=1))
+        total = {
+            'count': sum(a['count'] for a in aggregates.values()),
+            'sentiment_sum': sum(a['sentiment_sum'] for a in aggregates.values()),
+            'sentiment_count': sum(a['sentiment_count'] for a in aggregates.values())
+        }
+        for platform, agg in list(aggregates.items()) + [(ALL_PLATFORMS, total)]:
+            db.session.add(DailyRollup(
+                day=day,
+                platform=platform,
+                interaction_count=agg['count'],
+                sentiment_sum=agg['sentiment_sum'],
+                sentiment_count=agg['sentiment_count'],
+                user_sketch=sketches.get(platform, HyperLogLog()).to_bytes()
+            ))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker built this day first
+            db.session.rollback()
+
+    def _built_days(self, first_day, last_day):
+        return {d for (d,) in db.session.query(DailyRollup.day).filter(
+            DailyRollup.platform == ALL_PLATFORMS,
+            DailyRollup.day >= first_day, DailyRollup.day <= last_day
+        )}
+
+    def ensure_built(self, first_day, last_day):
+        """Materialize every closed day in [first_day, last_day] that has no rollup yet.
+        Runs on the background job; summaries only request builds."""
+        if first_day > last_day:
+            return
+        self._ensure_table()
+        built = self._built_days(first_day, last_day)
+        day = first_day
+        while day <= last_day:
+            if day not in built:
+                self.build_day(day)
+                self.stats['built'] += 1
+                logging.info(f'CipherH: Built analytics rollup for {day.isoformat()}')
+            day += timedelta(days=1)
+
+    @staticmethod
+    def _gaps(first_day, last_day, built):
+        """Contiguous [start, end) datetime ranges of the days in [first_day, last_day] not in built"""
+        gaps, start, day = [], None, first_day
+        while day <= last_day + timedelta(days=1):
+            if day <= last_day and day not in built:
+                start = start or day
+            elif start is not None:
+                gaps.append((datetime.combine(start, datetime.min.time()),
+                             datetime.combine(day, datetime.min.time())))
+                start = None
+            day += timedelta(days=1)
+        return gaps
+
+    def summary(self, days):
+        """Combine closed-day rollups with a live query over the open tail and unbuilt days"""
+        now = datetime.utcnow()
+        first_day = (now - timedelta(days=days - 1)).date()
+        last_closed = self.last_closed_day(now)
+        self._ensure_table()
+
+        counts, sentiment_sum, sentiment_count = {}, 0.0, 0
+        users = HyperLogLog()
+        live_ranges = []
+        if first_day <= last_closed:
+            built = self._built_days(first_day, last_closed)
+            live_ranges = self._gaps(first_day, last_closed, built)
+            if live_ranges:
+                self.ensure_started(current_app._get_current_object())
+                self.request_build(first_day)
+            rows = db.session.query(
+                DailyRollup.platform, DailyRollup.interaction_count,
+                DailyRollup.sentiment_sum, DailyRollup.sentiment_count
+            ).filter(DailyRollup.day >= first_day, DailyRollup.day <= last_closed)
+            for platform, count, s_sum, s_count in rows:
+                if platform == ALL_PLATFORMS:
+                    sentiment_sum += s_sum
+                    sentiment_count += s_count
+                elif count:
+                    counts[platform] = counts.get(platform, 0) + count
+            for (sketch,) in db.session.query(DailyRollup.user_sketch).filter(
+                DailyRollup.platform == ALL_PLATFORMS,
+                DailyRollup.day >= first_day, DailyRollup.day <= last_closed
+            ):
+                users.merge(HyperLogLog(sketch))
+
+        live_start = datetime.combine(max(first_day, last_closed + timedelta(days=1)), datetime.min.time())
+        live_ranges.append((live_start, now + timedelta(seconds=1)))
+        for start, end in live_ranges:
+            aggregates, sketches = self._aggregate(start, end)
+            for platform, agg in aggregates.items():
+                counts[platform] = counts.get(platform, 0) + agg['count']
+                sentiment_sum += agg['sentiment_sum']
+                sentiment_count += agg['sentiment_count']
+            users.merge(sketches[ALL_PLATFORMS])
+
+        return {
+            'period_days': days,
+            'since': first_day.isoformat(),
+            'total_interactions': sum(counts.values()),
+            'active_users': users.count(),
+            'platform_distribution': [
+                {'platform': platform, 'count': count}
+                for platform, count in sorted(counts.items(), key=lambda p: -p[1])
+            ],
+            'average_sentiment': sentiment_sum / sentiment_count if sentiment_count else None,
+            'interactions_with_sentiment': sentiment_count
+        }
+
+
+# Global instance
+rollup_engine = RollupEngine()
+
+
+@event.listens_for(Interaction, 'after_insert')
+@event.listens_for(Interaction, 'after_update')
+@event.listens_for(Interaction, 'after_delete')
+def _mark_day_changed(mapper, connection, target):
+    last_closed = rollup_engine.last_closed_day()
+    timestamps = [target.timestamp] + list(inspect(target).attrs.timestamp.history.deleted or ())
+    days = {ts.date() for ts in timestamps if ts is not None and ts.date() <= last_closed}
+    if days:
+        session = inspect(target).session
+        if session is not None:
+            session.info.setdefault('cipherh_changed_days', set()).update(days)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_changed_days(session, flush_context):
+    # Same transaction as the change itself: a rollback keeps the rollup
+    days = session.info.pop('cipherh_changed_days', None)
+    if not days:
+        return
+    connection = session.connection()
+    rollup_engine._ensure_table(connection)
+    connection.execute(DailyRollup.__table__.delete().where(DailyRollup.day.in_(sorted(days))))
+    rollup_engine.stats['invalidated'] += len(days)
+    logging.info(f'CipherH: Invalidated analytics rollups for {len(days)} changed days')
+    if rollup_engine._thread is not None:
+        rollup_engine.request_build(min(days))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_days(session):
+    session.info.pop('cipherh_changed_days', None)
@@ -0,0 +1,314 @@
+"""
+CipherH ASGI Entry Point
+
+Async serving mode. The hot endpoints run as coroutines:
+POST /api/conversation, POST /api/webhook/<platform> and POST /api/chat.
+Every other path is the existing Flask app, mounted through asgiref's
+WsgiToAsgi when it is installed. That covers the admin pages and the
+rest of the API; SocketIO stays on the WSGI server.
+
+A connection waiting on the brain holds only a coroutine, not a worker
+thread. A brain with astream_response is awaited directly. Blocking
+work with no async driver runs on a bounded thread pool inside an app
+context: a sync brain SDK, user lookups and commits. With
+CIPHERH_WRITE_BEHIND=1 persistence is a buffer append, so a
+conversation needs no pool round trip for the DB. Run with:
+
+    uvicorn asgi:application --workers 2
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app, db
+from brain_admission import BrainOverloaded, admitted_reply, brain_admission
+from metrics import brain_latency, request_latency
+from profiler import PROFILE_HEADER, current_profile, request_profiler
+from platform_adapters import platform_manager
+from response_cache import response_cache, cache_requested
+from streaming import async_brain
+from webhook_inbox import webhook_inbox
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class BodyTooLarge(ValueError):
+    """Raised when a request body exceeds MAX_BODY_BYTES"""
+
+
+class BlockingBridge:
+    """Runs blocking calls on a bounded pool, each inside a Flask app context"""
+    def __init__(self, app, workers=32):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cipherh-asgi')
+
+    def _call(self, fn, args, profile=None):
+        if profile is not None:
+            request_profiler.attach(profile)
+        with self.app.app_context():
+            try:
+                return fn(*args)
+            finally:
+                db.session.remove()
+                if profile is not None:
+                    request_profiler.detach()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) on the pool; returns its concurrent.futures.Future"""
+        # The pool does not inherit context variables, so a request's profile is passed along
+        profile = current_profile.get() if request_profiler.enabled else None
+        return self.executor.submit(self._call, fn, args, profile)
+
+    async def run(self, fn, *args, timeout=None):
+        # Cancelling on timeout also drops the call if it is still queued in the pool
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(fn, *args)), timeout)
+
+
+class AsyncBrain:
+    """Brain replies for coroutines: cache, admission control, deadline and single-flight.
+    Slots come from the same BrainAdmission as the sync path, so its caps hold across both."""
+    def __init__(self, bridge, admission):
+        self.bridge = bridge
+        self.admission = admission
+        self._flights = {}
+
+    async def reply(self, message, platform, user_id, use_cache=True):
+        """Returns (reply, shed_reason) like brain_admission.admitted_reply"""
+        brain = async_brain()
+        deadline = self.admission.deadline
+        if brain is None:
+            # Sync brain: the existing admission path, run on the pool under the same deadline
+            future = self.bridge.submit(self._sync_reply, message, platform, user_id, use_cache,
+                                        time.monotonic() + deadline)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), deadline)
+            except asyncio.TimeoutError:
+                if not future.cancelled():
+                    # The call already started and keeps its slot until the brain returns;
+                    # count it as abandoned until then rather than as freed capacity
+                    self.admission.abandon()
+                    future.add_done_callback(lambda f: self.admission.abandoned_done())
+                self.admission.record('shed_deadline')
+                return self.admission.fallback_reply, 'deadline'
+
+        key = response_cache.key_for(message, platform) if response_cache.enabled and use_cache else None
+        if key:
+            cached = response_cache.get(key)
+            if cached is not None:
+                return cached, None
+        flight_key = ('shared',) + key if key else (message, platform, user_id)
+        flight = self._flights.get(flight_key)
+        if flight is not None:
+            self.admission.record('coalesced')
+            return await asyncio.shield(flight)
+
+        flight = self._flights[flight_key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._generate(brain, message, platform, user_id, deadline)
+            if key and result[1] is None:
+                response_cache.put(key, result[0])
+            flight.set_result(result)
+            return result
+        except Exception as e:
+            flight.set_exception(e)
+            # Followers re-raise it; mark it retrieved so a lone leader doesn't log it twice
+            flight.exception()
+            raise
+        finally:
+            self._flights.pop(flight_key, None)
+
+    def _sync_reply(self, message, platform, user_id, use_cache, deadline):
+        from app import process_cipher_message
+        return admitted_reply(message, platform, user_id, process_cipher_message,
+                              use_cache=use_cache, deadline=deadline)
+
+    async def _acquire(self, platform, deadline):
+        """Take an admission slot; a caller that must queue waits on a pool thread"""
+        if self.admission.try_acquire(platform):
+            return
+        future = asyncio.get_running_loop().run_in_executor(
+            self.bridge.executor, self.admission.acquire, platform, deadline
+        )
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The waiting thread may still be granted a slot; hand it back
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or self.admission.release(platform))
+            raise
+
+    async def _generate(self, brain, message, platform, user_id, deadline):
+        deadline = time.monotonic() + deadline
+        if self.admission.enabled:
+            try:
+                await self._acquire(platform, deadline)
+            except BrainOverloaded as e:
+                return e.fallback_reply, e.reason
+        admitted = time.monotonic()
+        service_time = None
+        try:
+            parts = []
+
+            async def collect():
+                async for chunk in brain.astream_response(message, platform, user_id):
+                    parts.append(chunk)
+            await asyncio.wait_for(collect(), max(deadline - admitted, 0.001))
+            service_time = time.monotonic() - admitted
+            brain_latency.labels(platform).observe(service_time)
+            return ''.join(parts), None
+        except asyncio.TimeoutError:
+            self.admission.record('shed_deadline')
+            return self.admission.fallback_reply, 'deadline'
+        finally:
+            if self.admission.enabled:
+                self.admission.release(platform, service_time)
+
+
+async def _read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise BodyTooLarge('Request body too large')
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class HotPathApp:
+    """ASGI app serving the hot API endpoints natively and everything else via Flask"""
+    ROUTES = [
+        (re.compile(r'^/api/conversation$'), 'conversation'),
+        (re.compile(r'^/api/webhook/(?P<platform>[\w-]+)$'), 'webhook'),
+        (re.compile(r'^/api/chat$'), 'chat')
+    ]
+    # Flask rule templates, so both serving modes report the same route labels
+    RULES = {
+        'conversation': '/api/conversation',
+        'webhook': '/api/webhook/<platform>',
+        'chat': '/api/chat'
+    }
+
+    def __init__(self, flask_app, workers=32):
+        self.flask_app = flask_app
+        self.bridge = BlockingBridge(flask_app, workers)
+        self.brain = AsyncBrain(self.bridge, brain_admission)
+        self.fallback = WsgiToAsgi(flask_app) if WsgiToAsgi else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            for pattern, name in self.ROUTES:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self._dispatch(name, match.groupdict(), scope, receive, send)
+        if self.fallback is None:
+            if scope['type'] == 'http':
+                await _send_json(send, 404, {'error': 'Not served in ASGI mode (install asgiref to mount Flask)'})
+            return
+        await self.fallback(scope, receive, send)
+
+    async def _dispatch(self, name, params, scope, receive, send):
+        started = time.perf_counter()
+        headers = {k.decode('latin-1').title(): v.decode('latin-1') for k, v in scope['headers']}
+        profile = None
+        if request_profiler.enabled:
+            profile = request_profiler.begin('POST', self.RULES[name], scope['path'],
+                                             headers.get(PROFILE_HEADER.title()))
+            current_profile.set(profile)
+        status = None
+        try:
+            body = await _read_body(receive)
+            if body is None:
+                return
+            if 'json' not in headers.get('Content-Type', ''):
+                status = 400
+                return await _send_json(send, status, {'error': 'Expected JSON payload'})
+            data = json.loads(body or b'null')
+            if data is not None and not isinstance(data, dict):
+                status = 400
+                return await _send_json(send, status, {'error': 'Expected a JSON object'})
+            status, payload = await getattr(self, name)(data, headers, body, **params)
+        except BodyTooLarge as e:
+            status, payload = 413, {'error': str(e)}
+        except ValueError as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception as e:
+            logging.error(f'CipherH: ASGI {name} error: {e}', exc_info=True)
+            status, payload = 500, {'error': f'{name.title()} processing failed'}
+        finally:
+            if profile is not None:
+                # Time not sampled on a bridge thread was spent awaiting on the event loop
+                request_profiler.finish(profile, status=status, residual=True)
+        await _send_json(send, status, payload)
+        request_latency.labels('POST', self.RULES[name]).observe(time.perf_counter() - started)
+
+    async def conversation(self, data, headers, body):
+        if not isinstance(data, dict) or not all(f in data for f in ('message', 'user_id', 'platform')):
+            return 400, {'error': 'message, user_id, and platform are required'}
+        from routes.api import persist_conversation
+
+        reply, shed_reason = await self.brain.reply(
+            data['message'], data['platform'], data['user_id'], use_cache=cache_requested(data, headers)
+        )
+        result = {'response': reply, 'user_id': data['user_id'], 'platform': data['platform']}
+        if shed_reason:
+            return 200, {**result, 'interaction_id': None, 'degraded': shed_reason}
+        result['interaction_id'] = await self.bridge.run(persist_conversation, data, reply)
+        return 200, result
+
+    async def webhook(self, data, headers, body, platform):
+        if not data:
+            return 400, {'error': 'Empty data received'}
+        adapter = platform_manager.get_adapter(platform)
+        if not adapter:
+            return 400, {'error': f'Platform {platform} not supported'}
+        if webhook_inbox.enabled:
+            webhook_inbox.start(self.flask_app, platform_manager.handle_webhook, platform_manager.handle_webhooks)
+            # Appends can wait on a worker's write lock, so keep them off the event loop
+            inbox_id, duplicate = await self.bridge.run(
+                webhook_inbox.append, platform, adapter.event_id(data), body.decode('utf-8')
+            )
+            return 200, {'status': 'duplicate' if duplicate else 'accepted', 'inbox_id': inbox_id}
+        # Adapters and the handlers behind them block; keep them off the event loop
+        result = await self.bridge.run(platform_manager.handle_webhook, platform, data)
+        return 200, {'status': 'processed', 'result': result}
+
+    async def chat(self, data, headers, body):
+        message = (data or {}).get('message')
+        if not message:
+            return 400, {'error': 'Message is required'}
+        platform = data.get('platform', 'web')
+        user_id = data.get('user_id', 'anonymous')
+        reply, shed_reason = await self.brain.reply(message, platform, user_id,
+                                                    use_cache=cache_requested(data, headers))
+        result = {'response': reply, 'platform': platform, 'user_id': user_id}
+        if shed_reason:
+            result['degraded'] = shed_reason
+        return 200, result
+
+
+application = HotPathApp(flask_app, workers=int(os.getenv('CIPHERH_ASGI_THREADS', '32')))
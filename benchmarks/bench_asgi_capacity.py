@@ -0,0 +1,113 @@
+"""
+Benchmark: concurrent-connection capacity, sync workers vs the ASGI hot path
+
+N simultaneous /api/chat requests against FakeBrain, whose first token
+takes CIPHERH_FAKE_BRAIN_FIRST_TOKEN_MS (default 300 ms):
+
+  sync   each request pins one of W worker threads for the whole brain call
+         (stream_cipher_message, as the Flask view runs it)
+  async  asgi.application; a waiting request holds only a coroutine
+
+A last run sends sync and async traffic at once under a small admission
+cap and reports the peak number of brain calls in flight, which must not
+exceed the cap: both paths take slots from the same BrainAdmission.
+
+    python benchmarks/bench_asgi_capacity.py [connections] [sync_workers]
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('CIPHERH_FAKE_BRAIN', '1')
+os.environ.setdefault('CIPHERH_FAKE_BRAIN_FIRST_TOKEN_MS', '300')
+os.environ.setdefault('CIPHERH_FAKE_BRAIN_DELAY_MS', '0')
+os.environ.setdefault('CIPHERH_BRAIN_MAX_CONCURRENCY', '1024')
+os.environ.setdefault('CIPHERH_BRAIN_QUEUE_SIZE', '10000')
+os.environ.setdefault('CIPHERH_BRAIN_DEADLINE_MS', '120000')
+
+import asgi  # noqa: E402
+from brain_admission import brain_admission  # noqa: E402
+from streaming import ReplyStream, stream_cipher_message  # noqa: E402
+
+
+def _sync(connections, workers):
+    def request(n):
+        return ''.join(ReplyStream(stream_cipher_message(f'q{n}', 'web', f'u{n}', use_cache=False)))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(request, range(connections)))
+    return time.perf_counter() - started
+
+
+async def _chat(n):
+    body = json.dumps({'message': f'q{n}', 'user_id': f'u{n}', 'cache': False}).encode()
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/chat',
+             'headers': [(b'content-type', b'application/json')]}
+    await asgi.application(scope, receive, send)
+    return sent[0]['status']
+
+
+async def _async(connections):
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(_chat(n) for n in range(connections)))
+    return time.perf_counter() - started, statuses.count(200)
+
+
+def _mixed(connections, workers, cap):
+    brain_admission.max_concurrent = cap
+    peak, done = [0], threading.Event()
+
+    def watch():
+        while not done.is_set():
+            peak[0] = max(peak[0], brain_admission.in_flight)
+            time.sleep(0.001)
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    syncer = threading.Thread(target=_sync, args=(connections, workers))
+    syncer.start()
+    asyncio.run(_async(connections))
+    syncer.join()
+    done.set()
+    watcher.join()
+    return peak[0]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    first_token = float(os.environ['CIPHERH_FAKE_BRAIN_FIRST_TOKEN_MS'])
+    print(f'{connections} concurrent connections, brain first token {first_token:g} ms')
+
+    elapsed = _sync(connections, workers)
+    print(f'  sync, {workers} workers: {elapsed:6.2f}s  {connections / elapsed:7.0f} req/s')
+    threads_before = threading.active_count()
+    elapsed, ok = asyncio.run(_async(connections))
+    print(f'  async hot path:   {elapsed:6.2f}s  {connections / elapsed:7.0f} req/s  '
+          f'{ok} ok, {threading.active_count() - threads_before} extra threads')
+
+    cap = 16
+    peak = _mixed(connections // 5, workers, cap)
+    print(f'  sync + async under a cap of {cap}: peak {peak} brain calls in flight')
+
+
+if __name__ == '__main__':
+    main()
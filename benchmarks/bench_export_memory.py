@@ -0,0 +1,64 @@
+"""
+Benchmark: peak memory of the streaming analytics export
+
+Streams N synthetic interaction records through the CSV and NDJSON
+encoders (optionally gzip) used by /admin/api/analytics/export, each
+run in a fresh process, and reports peak RSS and peak traced Python
+allocations. Both should stay flat as N grows.
+
+    python benchmarks/bench_export_memory.py [rows ...]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _records(count):
+    start = datetime(2026, 1, 1)
+    for i in range(count):
+        yield {
+            'timestamp': (start + timedelta(seconds=i)).isoformat(),
+            'platform': ('facebook', 'telegram', 'zalo')[i % 3],
+            'user_id': f'user{i % 5000}',
+            'username': f'Người dùng {i % 5000}',
+            'message_length': 40 + i % 200,
+            'response_length': 120 + i % 900,
+            'sentiment_score': (i % 21 - 10) / 10,
+            'context_tags': 'greeting,question' if i % 2 else None
+        }
+
+
+def _measure(export_format, use_gzip, count):
+    sys.path.insert(0, ROOT)
+    from routes.admin import _csv_chunks, _gzip_chunks, _ndjson_chunks, _stream_export
+
+    encode = _csv_chunks if export_format == 'csv' else _ndjson_chunks
+    chunks = encode(_records(count))
+    if use_gzip:
+        chunks = _gzip_chunks(chunks)
+    tracemalloc.start()
+    size = sum(len(chunk) for chunk in _stream_export(chunks))
+    _, traced_peak = tracemalloc.get_traced_memory()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{export_format}{"+gzip" if use_gzip else ""} rows={count} bytes={size} '
+          f'traced_peak={traced_peak / 1024:.0f}KB max_rss={rss_peak / 1024:.1f}MB')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        _measure(sys.argv[2], sys.argv[3] == '1', int(sys.argv[4]))
+        return
+    counts = [int(n) for n in sys.argv[1:]] or [10000, 100000, 400000]
+    for export_format, use_gzip in (('csv', '0'), ('csv', '1'), ('ndjson', '0'), ('ndjson', '1')):
+        for count in counts:
+            subprocess.run([sys.executable, __file__, '--run', export_format, use_gzip, str(count)], check=True)
+
+
+if __name__ == '__main__':
+    main()
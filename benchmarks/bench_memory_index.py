@@ -0,0 +1,116 @@
+"""
+Benchmark: memory index recall and latency, exact scan vs IVF
+
+Builds a MemoryIndex over N synthetic memories (topic-clustered word
+salads, embedded by HashingEmbedder) and runs 200 queries. Reports
+recall@10 against an exact float32 scan and the search latency, for what
+search_vector() serves by default (the chunked exact int8 scan) and for
+the opt-in IVF index at a few nprobe values. A last check has two
+processes append to one index at once and verifies no rows are lost.
+
+    python benchmarks/bench_memory_index.py [N ...]
+"""
+
+import logging
+import multiprocessing
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from memory_index import MemoryIndex  # noqa: E402
+
+QUERIES = 200
+NPROBES = (12, 64)
+
+
+def _corpus(seed=7):
+    rng = random.Random(seed)
+    vocab = list({''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+                  for _ in range(70000)})[:60000]
+    topics = [vocab[i * 30:(i + 1) * 30] for i in range(2000)]
+
+    def text():
+        topic = rng.choice(topics)
+        return ' '.join(rng.choice(topic) if rng.random() < 0.85 else rng.choice(vocab) for _ in range(12))
+    return text
+
+
+def _measure(index, exact, queries, k=10):
+    recalls, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        hits = index.search_vector(query, k)
+        latencies.append(time.perf_counter() - started)
+        truth = set((np.argpartition(-(exact @ query), k)[:k] + 1).tolist())
+        recalls.append(len(truth & {hit['memory_id'] for hit in hits}) / k)
+    latencies.sort()
+    return np.mean(recalls), latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000
+
+
+def bench(n):
+    text = _corpus()
+    texts = [text() for _ in range(n)]
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(tmp, dim=256)
+        index.load()
+        exact = np.concatenate([index.embedder.embed_many(texts[s:s + 50000]) for s in range(0, n, 50000)])
+        started = time.perf_counter()
+        for s in range(0, n, 50000):
+            index.add_many(list(range(s + 1, min(n, s + 50000) + 1)), texts[s:s + 50000])
+        built = time.perf_counter() - started
+        queries = index.embedder.embed_many([text() for _ in range(QUERIES)])
+
+        recall, p50, p95 = _measure(index, exact, queries)
+        print(f'  N={n:>7}  served (exact):   recall@10 {recall:.3f}  p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  '
+              f'(append {built:.1f}s)')
+
+        # CIPHERH_MEMORY_INDEX_IVF=1, as the background thread would train it
+        index.ivf, index.exact_below = True, 0
+        started = time.perf_counter()
+        index.train()
+        trained = time.perf_counter() - started
+        for nprobe in NPROBES:
+            index.nprobe = nprobe
+            recall, p50, p95 = _measure(index, exact, queries)
+            print(f'  N={n:>7}  ivf nprobe={nprobe:<4}  recall@10 {recall:.3f}  p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  '
+                  f'({len(index.centroids)} partitions, trained in {trained:.1f}s)')
+        del exact
+
+
+def _append(path, first_id, count):
+    index = MemoryIndex(path, dim=64)
+    for memory_id in range(first_id, first_id + count, 50):
+        index.add_many(list(range(memory_id, memory_id + 50)), [f'memory {i}' for i in range(memory_id, memory_id + 50)])
+
+
+def concurrent_writers(count=5000):
+    with tempfile.TemporaryDirectory() as tmp:
+        writers = [multiprocessing.Process(target=_append, args=(tmp, first, count)) for first in (1, count + 1)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        index = MemoryIndex(tmp, dim=64)
+        index.load()
+        ids = sorted(int(i) for i in index.ids[:index.count])
+        intact = ids == list(range(1, 2 * count + 1))
+        print(f'  two processes appending {count} each: {index.count} rows, ids intact: {intact}')
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+    for n in sizes:
+        bench(n)
+    concurrent_writers()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark: shared message formatter vs the old per-adapter slicing
+
+The common case is a short reply that fits every limit. For it, compares
+the old adapters' format_message (a len() check plus slice, and the email
+f-string, copied here) with today's adapters: format_message, which still
+returns one string, and format_parts, which returns the parts to send.
+Telegram now also escapes MarkdownV2, which the old code did not do.
+Also times splitting a long reply, which the old code could only
+truncate.
+
+Asserts that format_message is no slower than the old slicing for the
+short reply, within TOLERANCE for timer noise. For Telegram the
+allowance adds the cost of escape_markdown_v2 alone, the one piece of
+work the old code skipped.
+
+    python benchmarks/bench_message_format.py
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.CRITICAL)
+
+from message_format import escape_markdown_v2  # noqa: E402
+from platform_adapters import EmailAdapter, FacebookAdapter, TelegramAdapter  # noqa: E402
+
+SHORT = 'Chào bạn! Hôm nay CipherH có thể giúp gì cho bạn? 😊'
+LONG = 'Đây là một câu trả lời dài. ' * 250
+TOLERANCE = 1.2
+
+
+class OldFacebook:
+    def format_message(self, message, context=None):
+        formatted = message
+        if len(message) > 2000:
+            formatted = message[:1997] + '...'
+        return formatted
+
+
+class OldTelegram:
+    def format_message(self, message, context=None):
+        if len(message) > 4096:
+            message = message[:4093] + '...'
+        return message
+
+
+class OldEmail:
+    def format_message(self, message, context=None):
+        return f"""Xin chào,\n\n{message}\n\nBest regards,\nTrần Văn Khải (CipherH)\n\n---\nTin nhắn này được gửi tự động từ hệ thống CipherH AGI."""
+
+
+def _time(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def _best_of(fns, number, rounds=30):
+    """Best per-call time of each fn, measured in alternation so drift hits them alike"""
+    best = [float('inf')] * len(fns)
+    for _ in range(rounds):
+        for i, fn in enumerate(fns):
+            best[i] = min(best[i], timeit.timeit(fn, number=number))
+    return [t / number for t in best]
+
+
+def main():
+    pairs = [('facebook', OldFacebook(), FacebookAdapter()),
+             ('telegram', OldTelegram(), TelegramAdapter()),
+             ('email', OldEmail(), EmailAdapter())]
+    assert pairs[2][2].format_message(SHORT) == pairs[2][1].format_message(SHORT)
+
+    print(f'short reply ({len(SHORT)} chars), ns per call')
+    for name, old, new in pairs:
+        old_ns, new_ns, parts_ns, escape_ns = (t * 1e9 for t in _best_of([
+            lambda: old.format_message(SHORT),
+            lambda: new.format_message(SHORT),
+            lambda: new.format_parts(SHORT),
+            lambda: escape_markdown_v2(SHORT)
+        ], 20000))
+        allowed = (old_ns + (escape_ns if new.message_format.escape else 0)) * TOLERANCE
+        print(f'  {name:9s} old format_message {old_ns:6.0f}   format_message {new_ns:6.0f}   '
+              f'format_parts {parts_ns:6.0f}   (allowed {allowed:.0f})')
+        assert new_ns <= allowed, f'{name}: format_message {new_ns:.0f} ns is slower than the old {old_ns:.0f} ns'
+
+    old, new = pairs[0][1], pairs[0][2]
+    print(f'long reply ({len(LONG)} chars), us per call')
+    print(f'  facebook  old (truncates) {_time(lambda: old.format_message(LONG), 2000) * 1e6:6.1f}   '
+          f'format_parts (splits) {_time(lambda: new.format_parts(LONG), 2000) * 1e6:6.1f}   '
+          f'parts {[len(part) for part in new.format_parts(LONG)]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark: histogram overhead
+
+Measures what instrumentation adds to a hot path: observe() on a series,
+labels() + observe() as the routes call it, and the time() context
+manager, single-threaded and from 4 threads at once. Checks that
+quantiles stay within the 1/16 bucket error, and that 1000 short-lived
+threads leave no per-thread arrays behind. Ends with the cost of
+rendering /metrics.
+
+    python benchmarks/bench_metrics.py
+"""
+
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import metrics, quantile  # noqa: E402
+
+N = 1000000
+
+
+def _per_call(fn, values, baseline):
+    started = time.perf_counter()
+    for value in values:
+        fn(value)
+    return ((time.perf_counter() - started) - baseline) / len(values) * 1e9
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    histogram = metrics.histogram('bench_seconds', 'Benchmark histogram', ('label',))
+    series = histogram.labels('x')
+    rng = random.Random(7)
+    values = [rng.lognormvariate(-4, 1) for _ in range(N)]
+
+    started = time.perf_counter()
+    for value in values:
+        pass
+    baseline = time.perf_counter() - started
+
+    print('overhead per call, ns')
+    print(f'  observe()            {_per_call(series.observe, values, baseline):6.0f}')
+    print(f'  labels() + observe() {_per_call(lambda v: histogram.labels("x").observe(v), values, baseline):6.0f}')
+    started = time.perf_counter()
+    for _ in range(200000):
+        with series.time():
+            pass
+    print(f'  with time():         {(time.perf_counter() - started) / 200000 * 1e9:6.0f}')
+
+    def work():
+        for value in values[:250000]:
+            histogram.labels('y').observe(value)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f'  4 threads, per call  {(time.perf_counter() - started) / N * 1e9:6.0f}  '
+          f'(count {histogram.labels("y").snapshot()[1]})')
+
+    accuracy = histogram.labels('accuracy')
+    for value in values:
+        accuracy.observe(value)
+    counts, total, _, _ = accuracy.snapshot()
+    ordered = sorted(values)
+    errors = [abs(quantile(counts, total, q) / ordered[int(q * N)] - 1) for q in (0.5, 0.9, 0.99)]
+    print(f'quantile error p50/p90/p99: {" ".join(f"{e:.2%}" for e in errors)}')
+
+    churn = histogram.labels('churn')
+    for _ in range(20):
+        batch = [threading.Thread(target=churn.observe, args=(0.001,)) for _ in range(50)]
+        for thread in batch:
+            thread.start()
+        for thread in batch:
+            thread.join()
+    print(f'1000 short-lived threads: {churn.snapshot()[1]} observations, '
+          f'{len(churn._shards)} per-thread arrays left')
+
+    started = time.perf_counter()
+    metrics.render_prometheus()
+    print(f'render /metrics: {(time.perf_counter() - started) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark: PlatformManager.send_many vs a loop of send_message
+
+Broadcasts one message to N Facebook recipients two ways, first through
+FakeTransport with a simulated round trip, then over real HTTP against a
+local stub of the Graph API (single Send API calls vs batch requests).
+Rate limits are lifted so only delivery cost is measured.
+
+    python benchmarks/bench_send_many.py [recipients]
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.CRITICAL)
+
+from platform_adapters import PlatformManager  # noqa: E402
+from platform_transport import FakeTransport, HTTPTransport  # noqa: E402
+
+ROUND_TRIP = 0.002
+
+
+class GraphStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        time.sleep(ROUND_TRIP)
+        if self.path == '/':
+            operations = json.loads(parse_qs(body)['batch'][0])
+            reply = [{'code': 200, 'body': json.dumps({'message_id': f'm{i}'})} for i in range(len(operations))]
+        else:
+            reply = {'message_id': 'm'}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _manager():
+    manager = PlatformManager()
+    manager.configure_rate_limits('facebook', {'rate_limit': 1e9, 'rate_burst': 1e9,
+                                               'recipient_rate_limit': 1e9, 'recipient_burst': 1e9})
+    return manager
+
+
+def _run(manager, recipients):
+    started = time.perf_counter()
+    for recipient_id in recipients:
+        manager.send_message('facebook', recipient_id, 'Xin chào!')
+    loop = time.perf_counter() - started
+    started = time.perf_counter()
+    result = manager.send_many('facebook', recipients, 'Xin chào!')
+    bulk = time.perf_counter() - started
+    assert result['sent'] == len(recipients), result['failed']
+    return loop, bulk
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    recipients = [f'user{i}' for i in range(count)]
+
+    manager = _manager()
+    manager.set_transport(FakeTransport(delay=ROUND_TRIP), 'facebook')
+    loop, bulk = _run(manager, recipients)
+    print(f'FakeTransport ({ROUND_TRIP * 1000:g} ms): send_message loop {loop:.2f}s, send_many {bulk:.2f}s')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GraphStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    manager = _manager()
+
+    def build_request(platform, recipient_id, message):
+        method, url, headers, body = manager.build_request(platform, recipient_id, message)
+        return method, base + url.split('graph.facebook.com', 1)[1], headers, body
+
+    def build_batch_request(platform, recipient_ids, message):
+        method, url, headers, body = manager.build_batch_request(platform, recipient_ids, message)
+        return method, base + '/', headers, body
+
+    manager.set_transport(HTTPTransport(build_request, batch_builder=build_batch_request,
+                                        batch_parser=manager.parse_batch_response), 'facebook')
+    loop, bulk = _run(manager, recipients)
+    print(f'HTTP Graph stub ({ROUND_TRIP * 1000:g} ms): send_message loop {loop:.2f}s, '
+          f'send_many (batch API) {bulk:.2f}s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark: webhook inbox replay, one event at a time vs coalesced bursts
+
+Replays recorded webhook payloads through a WebhookInbox twice: once with
+only the single-event handler, once with the batch path
+(PlatformManager.handle_webhooks). Each handler call pays a simulated
+DB transaction and context fetch per conversation, which is what the batch
+path saves. A last run puts one poison payload in every burst to show that
+only it is failed.
+
+    python benchmarks/bench_webhook_replay.py [recorded.jsonl]
+
+Lines of recorded.jsonl are {"platform": ..., "payload": {...}}; without a
+file, bursts of Facebook messages across a few chats are generated.
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from platform_adapters import PlatformManager  # noqa: E402
+from webhook_inbox import WebhookInbox  # noqa: E402
+
+# Simulated cost of one DB transaction plus one context fetch
+CONVERSATION_COST = 0.002
+EVENTS = 2000
+CHATS = 40
+
+
+def _recorded(path):
+    if path:
+        with open(path, encoding='utf-8') as f:
+            return [(line['platform'], line['payload']) for line in map(json.loads, f) if line]
+    rng = random.Random(7)
+    return [('facebook', {'object': 'page', 'entry': [{'messaging': [{
+                'sender': {'id': f'chat{rng.randrange(CHATS)}'},
+                'message': {'mid': f'm{n}', 'text': f'hello {n}'}}]}]})
+            for n in range(EVENTS)]
+
+
+def _replay(events, batched, poison=False):
+    manager = PlatformManager()
+    calls = {'conversations': 0}
+
+    def handler(platform, data):
+        if poison and data.get('poison'):
+            raise ValueError('poison payload')
+        calls['conversations'] += 1
+        time.sleep(CONVERSATION_COST)
+        return manager.handle_webhook(platform, data)
+
+    def batch_handler(platform, batch):
+        if poison and any(data.get('poison') for data in batch):
+            raise ValueError('poison payload in burst')
+        results = manager.handle_webhooks(platform, batch)
+        calls['conversations'] += len(results)
+        time.sleep(CONVERSATION_COST * len(results))
+        return results
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inbox = WebhookInbox(os.path.join(tmp, 'inbox.db'), max_attempts=1)
+        inbox.handler = handler
+        inbox.batch_handler = batch_handler if batched else None
+        for n, (platform, payload) in enumerate(events):
+            if poison and n % inbox.batch_size == 0:
+                payload = {**payload, 'poison': True}
+            inbox.append(platform, f'e{n}', json.dumps(payload))
+
+        started = time.perf_counter()
+        while True:
+            rows = inbox.claim()
+            if not rows:
+                break
+            inbox.process(rows)
+        elapsed = time.perf_counter() - started
+    return elapsed, calls['conversations'], inbox.stats
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    events = _recorded(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f'{len(events)} recorded webhooks, {CONVERSATION_COST * 1000:g} ms per conversation handled')
+    single, single_calls, _ = _replay(events, batched=False)
+    batched, batched_calls, _ = _replay(events, batched=True)
+    print(f'  one at a time: {single:6.2f}s  {len(events) / single:8.0f} events/s  {single_calls} handler calls')
+    print(f'  coalesced:     {batched:6.2f}s  {len(events) / batched:8.0f} events/s  {batched_calls} handler calls')
+    print(f'  speedup:       {single / batched:6.1f}x')
+
+    _, _, stats = _replay(events, batched=True, poison=True)
+    print(f'  one poison payload per burst: processed {stats["processed"]}, failed {stats["failed"]}, '
+          f'bursts split {stats["split_batches"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+CipherH Brain Admission Control
+
+Bounds concurrent calls into the brain backend. Each call takes a slot
+under a global cap and an optional per-platform cap. Callers that find
+no free slot wait in a bounded FIFO queue. A caller is shed with
+BrainOverloaded, and the route answers with a fast fallback reply, when
+the queue is full, when its deadline passes, or when the expected wait
+already exceeds the deadline. Identical prompts that are already in
+flight share the leader's result instead of taking another slot
+(single-flight). Queue depth, wait times and shed counts are exported
+via get_stats(). Disable with CIPHERH_BRAIN_ADMISSION=0.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import brain_latency
+from response_cache import response_cache
+
+DEFAULT_FALLBACK_REPLY = 'CipherH đang hơi bận một chút, bạn nhắn lại sau ít phút nhé.'
+
+
+class BrainOverloaded(Exception):
+    """Raised when a brain call is shed; carries the fallback reply to send instead"""
+    def __init__(self, reason, fallback_reply):
+        super().__init__(f'Brain overloaded ({reason})')
+        self.reason = reason
+        self.fallback_reply = fallback_reply
+
+
+def _parse_platform_limits(value):
+    """'facebook:8,zalo:4' -> {'facebook': 8, 'zalo': 4}"""
+    limits = {}
+    for item in (value or '').split(','):
+        if ':' in item:
+            platform, limit = item.split(':', 1)
+            limits[platform.strip()] = int(limit)
+    return limits
+
+
+class _Waiter:
+    __slots__ = ('platform',)
+
+    def __init__(self, platform):
+        self.platform = platform
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class BrainAdmission:
+    """Concurrency caps, a deadline-aware wait queue and single-flight for brain calls"""
+    def __init__(self, max_concurrent=32, platform_limits=None, max_queue=128,
+                 deadline=8.0, fallback_reply=DEFAULT_FALLBACK_REPLY):
+        self.enabled = os.getenv('CIPHERH_BRAIN_ADMISSION', '1') != '0'
+        self.max_concurrent = max_concurrent
+        self.platform_limits = platform_limits or {}
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.fallback_reply = fallback_reply
+        self.in_flight = 0
+        self.platform_in_flight = {}
+        self._queue = deque()
+        self._flights = {}
+        self._cond = threading.Condition()
+        self._service_time = None
+        self._waits = deque(maxlen=1000)
+        self.abandoned_in_flight = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'coalesced': 0, 'shed_queue_full': 0,
+                      'shed_deadline': 0, 'abandoned': 0, 'max_queue_depth': 0}
+
+    def _has_capacity(self, platform):
+        if self.in_flight >= self.max_concurrent:
+            return False
+        limit = self.platform_limits.get(platform)
+        return limit is None or self.platform_in_flight.get(platform, 0) < limit
+
+    def _is_next(self, waiter):
+        """FIFO among waiters that could run now, so one busy platform does not block the rest"""
+        for queued in self._queue:
+            if self._has_capacity(queued.platform):
+                return queued is waiter
+        return False
+
+    def _expected_wait(self, position):
+        if self._service_time is None:
+            return 0.0
+        return self._service_time * (position + 1) / self.max_concurrent
+
+    def _shed(self, reason):
+        self.stats[f'shed_{reason}'] += 1
+        raise BrainOverloaded(reason, self.fallback_reply)
+
+    def acquire(self, platform, deadline=None):
+        """Take a slot or raise BrainOverloaded; deadline is an absolute time.monotonic()"""
+        deadline = deadline or time.monotonic() + self.deadline
+        started = time.monotonic()
+        with self._cond:
+            if not self._queue and self._has_capacity(platform):
+                self._take(platform, 0.0)
+                return
+            if len(self._queue) >= self.max_queue:
+                self._shed('queue_full')
+            if started + self._expected_wait(len(self._queue)) > deadline:
+                self._shed('deadline')
+
+            waiter = _Waiter(platform)
+            self._queue.append(waiter)
+            self.stats['queued'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], len(self._queue))
+            try:
+                while not (self._has_capacity(platform) and self._is_next(waiter)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed('deadline')
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(waiter)
+                # Whoever is next may be runnable now that this waiter left
+                self._cond.notify_all()
+            self._take(platform, time.monotonic() - started)
+
+    def try_acquire(self, platform):
+        """Take a slot only if one is free and nobody is queued; never waits"""
+        with self._cond:
+            if not self._queue and self._has_capacity(platform):
+                self._take(platform, 0.0)
+                return True
+            return False
+
+    def record(self, stat):
+        """Count an admission event seen outside acquire/run (the async path)"""
+        with self._cond:
+            self.stats[stat] += 1
+
+    def abandon(self):
+        """A caller stopped waiting for a call that still holds its slot"""
+        with self._cond:
+            self.stats['abandoned'] += 1
+            self.abandoned_in_flight += 1
+
+    def abandoned_done(self):
+        """An abandoned call returned and released its slot"""
+        with self._cond:
+            self.abandoned_in_flight -= 1
+
+    def _take(self, platform, waited):
+        self.in_flight += 1
+        self.platform_in_flight[platform] = self.platform_in_flight.get(platform, 0) + 1
+        self.stats['admitted'] += 1
+        self._waits.append(waited)
+
+    def release(self, platform, service_time=None):
+        with self._cond:
+            self.in_flight -= 1
+            self.platform_in_flight[platform] -= 1
+            if service_time is not None:
+                # EWMA of brain latency, used to shed callers that cannot make their deadline
+                self._service_time = service_time if self._service_time is None else \
+                    0.8 * self._service_time + 0.2 * service_time
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, platform, deadline=None):
+        """Hold a brain slot for the duration of the block (used by streaming replies)"""
+        if not self.enabled:
+            with brain_latency.labels(platform).time():
+                yield
+            return
+        self.acquire(platform, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            service_time = time.monotonic() - started
+            brain_latency.labels(platform).observe(service_time)
+            self.release(platform, service_time)
+
+    def run(self, key, platform, fn, deadline=None):
+        """Call fn() under admission control, sharing the result of an identical call in flight"""
+        if not self.enabled:
+            with brain_latency.labels(platform).time():
+                return fn()
+        deadline = deadline or time.monotonic() + self.deadline
+        flight = leader = None
+        with self._cond:
+            if key is not None:
+                flight = self._flights.get(key)
+                if flight is not None:
+                    flight.followers += 1
+                    self.stats['coalesced'] += 1
+                else:
+                    leader = self._flights[key] = _Flight()
+        if flight is not None:
+            if not flight.done.wait(max(0.0, deadline - time.monotonic())):
+                with self._cond:
+                    self._shed('deadline')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        flight = leader
+        try:
+            with self.slot(platform, deadline):
+                result = fn()
+            if flight:
+                flight.result = result
+            return result
+        except Exception as e:
+            if flight:
+                flight.error = e
+            raise
+        finally:
+            if flight:
+                with self._cond:
+                    self._flights.pop(key, None)
+                flight.done.set()
+
+    def get_stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                **self.stats,
+                'enabled': self.enabled,
+                'in_flight': self.in_flight,
+                'abandoned_in_flight': self.abandoned_in_flight,
+                'platform_in_flight': {p: n for p, n in self.platform_in_flight.items() if n},
+                'queue_depth': len(self._queue),
+                'max_concurrent': self.max_concurrent,
+                'wait_ms_avg': round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+                'wait_ms_p95': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else None,
+                'service_ms_ewma': round(self._service_time * 1000, 1) if self._service_time else None
+            }
+
+
+# Global instance
+brain_admission = BrainAdmission(
+    max_concurrent=int(os.getenv('CIPHERH_BRAIN_MAX_CONCURRENCY', '32')),
+    platform_limits=_parse_platform_limits(os.getenv('CIPHERH_BRAIN_PLATFORM_LIMITS')),
+    max_queue=int(os.getenv('CIPHERH_BRAIN_QUEUE_SIZE', '128')),
+    deadline=float(os.getenv('CIPHERH_BRAIN_DEADLINE_MS', '8000')) / 1000,
+    fallback_reply=os.getenv('CIPHERH_BRAIN_FALLBACK_REPLY', DEFAULT_FALLBACK_REPLY)
+)
+
+
+def admitted_reply(message, platform, user_id, processor, use_cache=True, deadline=None):
+    """Reply through the response cache and admission control; returns (reply, shed_reason).
+    deadline is an absolute time.monotonic(), by default now plus the admission deadline.
+    Prompts the cache would share across users are coalesced on its key,
+    all others only with an identical (message, platform, user_id) call."""
+    shared_key = response_cache.key_for(message, platform) if response_cache.enabled and use_cache else None
+    key = ('shared',) + shared_key if shared_key else (message, platform, user_id)
+
+    def admitted(message, platform, user_id):
+        return brain_admission.run(key, platform, lambda: processor(message, platform, user_id), deadline)
+
+    try:
+        return response_cache.process(message, platform, user_id, admitted, use_cache=use_cache), None
+    except BrainOverloaded as e:
+        return e.fallback_reply, e.reason
@@ -0,0 +1,199 @@
+"""
+CipherH Broadcast Aggregator
+
+Coalesces per-message SocketIO events into periodic frames. Every
+interval, subscribed clients get one 'interaction_batch' frame with
+counts per platform and a small sample of events, instead of one emit
+per message. Clients subscribe to platforms (rooms 'platform:<name>').
+Each client has a bounded buffer: a frame waits there while the client
+still owes acks, and the oldest frames are dropped and counted when the
+buffer is full. A client whose oldest unacked frame is older than the
+client timeout is treated as gone.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import request
+from flask_socketio import join_room, leave_room
+
+from app import socketio
+
+
+class _Client:
+    __slots__ = ('platforms', 'inflight', 'buffer', 'dropped')
+
+    def __init__(self, platforms, buffer_size):
+        self.platforms = platforms
+        # Send times of the frames still awaiting an ack, oldest first
+        self.inflight = deque()
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+
+
+class BroadcastAggregator:
+    """Batches new_interaction events into throttled per-client frames"""
+    def __init__(self, socketio, interval=0.25, sample_size=5, max_inflight=2,
+                 buffer_size=20, client_timeout=60.0):
+        self.socketio = socketio
+        self.interval = interval
+        self.sample_size = sample_size
+        self.max_inflight = max_inflight
+        self.buffer_size = buffer_size
+        self.client_timeout = client_timeout
+        self._counts = {}
+        self._samples = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.stats = {'published': 0, 'frames_sent': 0, 'frames_dropped': 0, 'clients_expired': 0}
+
+    def _ensure_running(self):
+        if self._task is None:
+            with self._lock:
+                if self._task is None:
+                    self._task = self.socketio.start_background_task(self._run)
+
+    def publish(self, event):
+        """Record one interaction event; O(1), never emits inline"""
+        platform = event.get('platform')
+        with self._lock:
+            self._counts[platform] = self._counts.get(platform, 0) + 1
+            samples = self._samples.setdefault(platform, deque(maxlen=self.sample_size))
+            samples.append(event)
+            self.stats['published'] += 1
+        self._ensure_running()
+
+    def subscribe(self, sid, platforms=None):
+        """Subscribe a client to some platforms, or to all of them when platforms is empty"""
+        platforms = frozenset(platforms or ())
+        with self._lock:
+            client = self._clients.get(sid)
+            if client:
+                for platform in client.platforms - platforms:
+                    leave_room(f'platform:{platform}', sid=sid)
+            self._clients[sid] = _Client(platforms, self.buffer_size)
+        for platform in platforms:
+            join_room(f'platform:{platform}', sid=sid)
+        self._ensure_running()
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            client = self._clients.pop(sid, None)
+        if client:
+            for platform in client.platforms:
+                leave_room(f'platform:{platform}', sid=sid)
+
+    def _build_frames(self, counts, samples):
+        """One frame per distinct subscription, shared by every client that has it"""
+        frames = {}
+        timestamp = datetime.utcnow().isoformat()
+        for client in self._clients.values():
+            key = client.platforms
+            if key in frames:
+                continue
+            selected = {p: c for p, c in counts.items() if not key or p in key}
+            if not selected:
+                frames[key] = None
+                continue
+            sample = [e for p, events in samples.items() if not key or p in key for e in events]
+            frames[key] = {
+                'count': sum(selected.values()),
+                'by_platform': selected,
+                'sample': sample[-self.sample_size:],
+                'window_ms': int(self.interval * 1000),
+                'timestamp': timestamp
+            }
+        return frames
+
+    def _deliver(self, sid, frame):
+        def ack(*args):
+            with self._lock:
+                client = self._clients.get(sid)
+                if client is None:
+                    return
+                if client.inflight:
+                    client.inflight.popleft()
+                pending = client.buffer.popleft() if client.buffer else None
+                if pending is not None:
+                    client.inflight.append(time.monotonic())
+                    self.stats['frames_sent'] += 1
+            if pending is not None:
+                self._deliver(sid, pending)
+
+        self.socketio.emit('interaction_batch', frame, to=sid, callback=ack)
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            samples, self._samples = self._samples, {}
+            if not counts:
+                return
+            now = time.monotonic()
+            frames = self._build_frames(counts, samples)
+            sends = []
+            for sid, client in list(self._clients.items()):
+                frame = frames.get(client.platforms)
+                if frame is None:
+                    continue
+                if len(client.inflight) < self.max_inflight:
+                    client.inflight.append(now)
+                    self.stats['frames_sent'] += 1
+                    sends.append((sid, frame))
+                    continue
+                if now - client.inflight[0] > self.client_timeout:
+                    # Its oldest frame has gone unacked for too long: treat as gone
+                    del self._clients[sid]
+                    self.stats['clients_expired'] += 1
+                    continue
+                if len(client.buffer) == client.buffer.maxlen:
+                    client.dropped += 1
+                    self.stats['frames_dropped'] += 1
+                client.buffer.append({**frame, 'dropped': client.dropped})
+        for sid, frame in sends:
+            self._deliver(sid, frame)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f'CipherH: Broadcast flush failed: {e}')
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'clients': len(self._clients),
+                'buffered_frames': sum(len(c.buffer) for c in self._clients.values())
+            }
+
+
+# Global instance
+broadcaster = BroadcastAggregator(
+    socketio,
+    interval=float(os.getenv('CIPHERH_BROADCAST_INTERVAL_MS', '250')) / 1000
+)
+
+
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    platforms = (data or {}).get('platforms') or []
+    broadcaster.subscribe(request.sid, platforms)
+    return {'status': 'subscribed', 'platforms': platforms}
+
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data=None):
+    broadcaster.unsubscribe(request.sid)
+    return {'status': 'unsubscribed'}
+
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    broadcaster.unsubscribe(request.sid)
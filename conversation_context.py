@@ -0,0 +1,151 @@
+"""
+CipherH Conversation Context
+
+Per-user ring buffers of recent conversation turns, fed by the
+interaction write path. They serve /api/users/<platform>/<id>/history,
+so reads for active users never touch the database. The first read for a user that is not
+cached loads the last turns from the DB. The write-behind buffer is
+flushed first so that load sees every turn. A cached history is
+trusted for CIPHERH_CONTEXT_TTL seconds (default 30) and then reloaded,
+so turns written by other workers or outside the write path show up.
+Total memory is bounded by a byte budget, and the least recently used
+users are evicted.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy import event
+
+from models import Interaction
+
+# Rough per-turn bookkeeping (dict, deque slot, timestamp) in bytes
+TURN_OVERHEAD = 240
+
+
+def _turn_size(turn):
+    return TURN_OVERHEAD + len((turn['message'] or '').encode('utf-8')) + \
+        len((turn['cipher_response'] or '').encode('utf-8'))
+
+
+class _History:
+    __slots__ = ('turns', 'bytes', 'loaded', 'since')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self.bytes = 0
+        # True once the most recent max_turns turns (or all of them) are known
+        self.loaded = False
+        # When the DB was last read for this user, or the buffer started
+        self.since = time.monotonic()
+
+
+class ConversationContext:
+    """LRU of per-user recent-turn ring buffers bounded by total bytes"""
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_turns=50, ttl=30.0):
+        self.max_bytes = max_bytes
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'bypassed': 0, 'appends': 0, 'evictions': 0}
+
+    def _push(self, history, turn):
+        if len(history.turns) == history.turns.maxlen:
+            dropped = _turn_size(history.turns[0])
+            history.bytes -= dropped
+            self._bytes -= dropped
+        history.turns.append(turn)
+        size = _turn_size(turn)
+        history.bytes += size
+        self._bytes += size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            _, history = self._users.popitem(last=False)
+            self._bytes -= history.bytes
+            self.stats['evictions'] += 1
+
+    def append(self, user_id, turn):
+        """Record a new turn; turn holds id, message, cipher_response and timestamp"""
+        with self._lock:
+            history = self._users.get(user_id)
+            if history is None:
+                history = self._users[user_id] = _History(self.max_turns)
+            else:
+                self._users.move_to_end(user_id)
+            self._push(history, turn)
+            self.stats['appends'] += 1
+            self._evict()
+
+    def recent(self, user_id, limit, loader):
+        """Last `limit` turns, newest first; loader(user_id, n) returns DB turns oldest first"""
+        if limit > self.max_turns:
+            with self._lock:
+                self.stats['bypassed'] += 1
+            return list(reversed(loader(user_id, limit)))
+
+        with self._lock:
+            history = self._users.get(user_id)
+            fresh = history is not None and time.monotonic() - history.since < self.ttl
+            if fresh and (history.loaded or len(history.turns) >= limit):
+                self._users.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return list(reversed(history.turns))[:limit]
+
+        started = time.monotonic()
+        turns = loader(user_id, self.max_turns)
+        with self._lock:
+            self.stats['loads'] += 1
+            history = self._users.get(user_id)
+            newest = turns[-1]['timestamp'] if turns else None
+            pending = [t for t in history.turns if newest is None or t['timestamp'] > newest] if history else []
+            if history is not None:
+                self._bytes -= history.bytes
+            history = self._users[user_id] = _History(self.max_turns)
+            # Turns appended while loading are newer than anything the DB returned
+            for turn in turns + pending:
+                self._push(history, turn)
+            history.loaded = True
+            history.since = started
+            self._evict()
+            return list(reversed(history.turns))[:limit]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            history = self._users.pop(user_id, None)
+            if history is not None:
+                self._bytes -= history.bytes
+
+    def get_stats(self):
+        with self._lock:
+            reads = self.stats['hits'] + self.stats['loads']
+            return {
+                **self.stats,
+                'users': len(self._users),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hit_rate': round(self.stats['hits'] / reads, 4) if reads else None
+            }
+
+
+# Global instance
+conversation_context = ConversationContext(
+    max_bytes=int(os.getenv('CIPHERH_CONTEXT_CACHE_MB', '32')) * 1024 * 1024,
+    max_turns=int(os.getenv('CIPHERH_CONTEXT_TURNS', '50')),
+    ttl=float(os.getenv('CIPHERH_CONTEXT_TTL', '30'))
+)
+
+
+@event.listens_for(Interaction, 'after_delete')
+def _invalidate_context(mapper, connection, target):
+    conversation_context.invalidate(target.user_id)
+
+
+@event.listens_for(Interaction, 'after_update')
+def _refresh_context(mapper, connection, target):
+    # Sentiment or tags changed after the fact; reload this user on next read
+    conversation_context.invalidate(target.user_id)
@@ -0,0 +1,355 @@
+"""
+CipherH Interaction Search
+
+Full-text search over Interaction.message and cipher_response for the
+admin panel. The index is an SQLite FTS5 side database, like the webhook
+inbox. It is fed from the interaction write path: new exchanges are
+buffered and indexed in batches by a background thread, so the index
+never needs a rebuild. Text is indexed with Vietnamese diacritics folded
+(including đ, which FTS5's unicode61 tokenizer leaves alone), so
+"chao ban" finds "Chào bạn". Interactions stored before the index
+existed are backfilled once, in the background. Deleted interactions
+are removed by the indexer after their delete commits. Disable with
+CIPHERH_INTERACTION_SEARCH=0.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import Interaction
+from response_cache import normalize_message
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    ref TEXT NOT NULL UNIQUE,
+    user_id INTEGER,
+    platform TEXT,
+    ts TEXT NOT NULL,
+    message TEXT,
+    cipher_response TEXT
+);
+CREATE INDEX IF NOT EXISTS docs_ts ON docs (ts);
+CREATE INDEX IF NOT EXISTS docs_platform_ts ON docs (platform, ts);
+CREATE INDEX IF NOT EXISTS docs_user_ts ON docs (user_id, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+    message, cipher_response, content='', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Backfilled rows get ids below every live row (interaction id - offset),
+# so FTS rowid order is time order and newest-first needs no sort
+BACKFILL_ID_OFFSET = 2 ** 62
+
+_TERM_RE = re.compile(r'(-?)"([^"]*)"|(\S+)')
+
+
+def utc_timestamp(value):
+    """An ISO string or datetime as the naive-UTC isoformat the index stores.
+    Aware values (+07:00, Z) are converted to UTC; naive ones are taken as UTC.
+    Raises ValueError for anything else."""
+    if isinstance(value, str):
+        value = value.strip()
+        if value[-1:] in ('Z', 'z'):
+            value = value[:-1] + '+00:00'
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        raise ValueError(f'Not an ISO timestamp: {value!r}')
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def build_match(query):
+    """Turn a search box query into an FTS5 MATCH expression.
+
+    Terms are ANDed; "quoted words" match as a phrase, a trailing * matches
+    a prefix and a leading - excludes the term. Everything is folded and
+    quoted, so user input can never be FTS5 syntax. Returns None if the
+    query has no positive terms."""
+    include, exclude = [], []
+    for match in _TERM_RE.finditer(query or ''):
+        negate, phrase, bare = match.group(1), match.group(2), match.group(3)
+        prefix = False
+        if bare is not None:
+            negate = bare.startswith('-') and len(bare) > 1
+            prefix = bare.endswith('*')
+            phrase = bare.lstrip('-').rstrip('*')
+        words = normalize_message(phrase)
+        if not words:
+            continue
+        term = f'"{words}"' + ('*' if prefix else '')
+        (exclude if negate else include).append(term)
+    if not include:
+        return None
+    return ' '.join(include) + ''.join(f' NOT {term}' for term in exclude)
+
+
+class InteractionSearch:
+    """FTS5 index of interactions, fed incrementally from the write path"""
+    def __init__(self, path, batch_size=200, flush_interval=1.0, max_pending=20000):
+        self.enabled = os.getenv('CIPHERH_INTERACTION_SEARCH', '1') != '0'
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.app = None
+        self._pending = []
+        self._removals = []
+        self._dropping = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._thread = None
+        self._initialized = False
+        self.stats = {'indexed': 0, 'removed': 0, 'backfilled': 0, 'flushes': 0,
+                      'dropped': 0, 'searches': 0, 'last_search_ms': None}
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._initialized:
+                conn.executescript(SCHEMA)
+                # Interactions before this moment come from the one-time backfill
+                conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                             ('started_at', datetime.utcnow().isoformat()))
+                self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def start(self, app):
+        """Start the background indexer (idempotent); call before the first add()"""
+        if self._thread is not None or not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None:
+                self.app = app
+                # Stamps started_at before anything is queued, so add() and backfill never overlap
+                self._conn()
+                self._thread = threading.Thread(target=self._run, name='cipherh-search-indexer', daemon=True)
+                self._thread.start()
+                logging.info('CipherH: Interaction search indexer started')
+
+    def add(self, ref, user_id, platform, message, cipher_response, timestamp):
+        """Queue one interaction for indexing; ref is its interaction id"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                # Indexer is far behind; the backlog is bounded, search just misses these
+                self.stats['dropped'] += 1
+                if not self._dropping:
+                    self._dropping = True
+                    logging.error(f'CipherH: Search index backlog full ({self.max_pending} rows), '
+                                  f'dropping new interactions until it drains')
+                return
+            self._pending.append((str(ref), user_id, platform, timestamp.isoformat(),
+                                  message or '', cipher_response or ''))
+            pending = len(self._pending)
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def _insert(self, conn, rows, backfill=False):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for ref, user_id, platform, ts, message, cipher_response in rows:
+                doc_id = int(ref) - BACKFILL_ID_OFFSET if backfill else None
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO docs (id, ref, user_id, platform, ts, message, cipher_response) '
+                    'VALUES (coalesce(?, (SELECT max(coalesce(max(id), 0), 0) + 1 FROM docs)), ?, ?, ?, ?, ?, ?)',
+                    (doc_id, ref, user_id, platform, ts, message, cipher_response)
+                )
+                if cursor.rowcount:
+                    conn.execute('INSERT INTO docs_fts (rowid, message, cipher_response) VALUES (?, ?, ?)',
+                                 (cursor.lastrowid, normalize_message(message), normalize_message(cipher_response)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def flush(self):
+        """Index everything queued so far, then apply queued removals; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+                if self._dropping:
+                    logging.error(f'CipherH: Search index dropped {self.stats["dropped"]} interactions so far')
+                    self._dropping = False
+            written = 0
+            if rows:
+                try:
+                    self._insert(self._conn(), rows)
+                except Exception as e:
+                    logging.error(f'CipherH: Indexing {len(rows)} interactions failed: {e}')
+                    with self._lock:
+                        overflow = len(rows) + len(self._pending) - self.max_pending
+                        if overflow > 0:
+                            self.stats['dropped'] += overflow
+                            logging.error(f'CipherH: Search index backlog full, dropped {overflow} interactions')
+                        self._pending = (rows + self._pending)[-self.max_pending:]
+                else:
+                    self.stats['indexed'] += len(rows)
+                    self.stats['flushes'] += 1
+                    written = len(rows)
+            # After the inserts, so a row deleted while still queued is removed too
+            self._apply_removals()
+            return written
+
+    def queue_removal(self, ref):
+        """Unindex an interaction on the next flush; called once its delete has committed"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._removals.append(ref)
+        self._wake.set()
+
+    def _apply_removals(self):
+        with self._lock:
+            refs, self._removals = self._removals, []
+        for ref in refs:
+            try:
+                self.remove(ref)
+            except Exception as e:
+                logging.error(f'CipherH: Removing interaction {ref} from the search index failed: {e}')
+
+    def remove(self, ref):
+        conn = self._conn()
+        row = conn.execute('SELECT id, message, cipher_response FROM docs WHERE ref = ?', (str(ref),)).fetchone()
+        if row is None:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Contentless FTS5 deletes need the indexed values back
+            conn.execute("INSERT INTO docs_fts (docs_fts, rowid, message, cipher_response) VALUES ('delete', ?, ?, ?)",
+                         (row[0], normalize_message(row[1]), normalize_message(row[2])))
+            conn.execute('DELETE FROM docs WHERE id = ?', (row[0],))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.stats['removed'] += 1
+
+    def backfill(self, batch_size=2000):
+        """Index interactions stored before the index existed, resuming from a watermark"""
+        from interaction_writer import interaction_writer
+        conn = self._conn()
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        if meta.get('backfill_done'):
+            return 0
+        if interaction_writer.enabled:
+            # Write-behind rows from before started_at must be in the DB first
+            interaction_writer.flush()
+        started_at = datetime.fromisoformat(meta['started_at'])
+        last_id = int(meta.get('backfill_id', 0))
+        total = 0
+        while True:
+            rows = Interaction.query.with_entities(
+                Interaction.id, Interaction.user_id, Interaction.platform, Interaction.timestamp,
+                Interaction.message, Interaction.cipher_response
+            ).filter(Interaction.id > last_id, Interaction.timestamp < started_at)\
+                .order_by(Interaction.id).limit(batch_size).all()
+            if not rows:
+                break
+            self._insert(conn, [(str(r.id), r.user_id, r.platform, r.timestamp.isoformat(),
+                                 r.message or '', r.cipher_response or '') for r in rows], backfill=True)
+            last_id = rows[-1].id
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('backfill_id', str(last_id)))
+            total += len(rows)
+            self.stats['backfilled'] += len(rows)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfill_done', '1')")
+        if total:
+            logging.info(f'CipherH: Backfilled {total} interactions into the search index')
+        return total
+
+    def _run(self):
+        try:
+            with self.app.app_context():
+                self.backfill()
+        except Exception as e:
+            logging.error(f'CipherH: Search index backfill error: {e}')
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def search(self, query, platform=None, user_id=None, since=None, until=None,
+               limit=20, order='recent'):
+        """Matching interactions as dicts, newest first or by relevance (order='relevance').
+        since/until are ISO timestamps or datetimes bounding the interaction time;
+        naive values are taken as UTC. Only indexed interactions are searched, so
+        one recorded in the last flush_interval may not show up yet."""
+        match = build_match(query)
+        if not self.enabled or match is None:
+            return []
+        since = utc_timestamp(since) if since is not None else None
+        until = utc_timestamp(until) if until is not None else None
+        started = time.perf_counter()
+
+        relevance = order == 'relevance'
+        # bm25() reads whole doclists; newest-first streams rowids and stops at LIMIT
+        sql = [f'SELECT d.ref, d.user_id, d.platform, d.ts, d.message, d.cipher_response, '
+               f'{"bm25(docs_fts)" if relevance else "NULL"} '
+               'FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid WHERE docs_fts MATCH ?']
+        params = [match]
+        for clause, value in (('d.platform = ?', platform), ('d.user_id = ?', user_id),
+                              ('d.ts >= ?', since), ('d.ts < ?', until)):
+            if value is not None:
+                sql.append(f'AND {clause}')
+                params.append(value)
+        sql.append('ORDER BY bm25(docs_fts)' if relevance else 'ORDER BY docs_fts.rowid DESC')
+        sql.append('LIMIT ?')
+        params.append(limit)
+
+        rows = self._conn().execute(' '.join(sql), params).fetchall()
+        self.stats['searches'] += 1
+        self.stats['last_search_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return [{
+            'id': ref,
+            'user_id': user_id,
+            'platform': platform,
+            'timestamp': ts,
+            'message': message,
+            'cipher_response': cipher_response,
+            'score': round(-score, 4) if score is not None else None
+        } for ref, user_id, platform, ts, message, cipher_response, score in rows]
+
+    def get_stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {**self.stats, 'enabled': self.enabled, 'pending': pending}
+
+
+# Global instance
+interaction_search = InteractionSearch(os.getenv('CIPHERH_SEARCH_DB', 'interaction_search.db'))
+
+
+@event.listens_for(Interaction, 'after_delete')
+def _queue_unindex(mapper, connection, target):
+    # No SQLite I/O inside the ORM flush; a rolled-back delete must stay searchable
+    session = object_session(target)
+    if session is not None and interaction_search.enabled:
+        session.info.setdefault('cipherh_unindex', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _unindex_committed(session):
+    for interaction_id in session.info.pop('cipherh_unindex', ()):
+        interaction_search.queue_removal(interaction_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_unindex(session):
+    session.info.pop('cipherh_unindex', None)
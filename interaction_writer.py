@@ -0,0 +1,289 @@
+"""
+CipherH Interaction Writer
+
+Write-behind persistence for /api/conversation. Interaction rows and user
+counter increments are buffered in memory and flushed as batched multi-row
+statements when the buffer fills or the flush interval elapses, and once more
+on shutdown. Enabled with CIPHERH_WRITE_BEHIND=1.
+
+On PostgreSQL, interaction ids are pre-allocated in blocks from the table's
+id sequence (hi-lo style, CIPHERH_WRITE_BEHIND_ID_BLOCK ids per round trip),
+so record() returns the id the row will be inserted with. On databases
+without sequences the id is assigned at flush; record() then returns None.
+Either way on_saved is called once the row exists. Rows the database
+rejects (e.g. for a deleted user) are isolated by bisecting the batch and
+dropped with an error log, so the rest of the batch still lands. Transient failures requeue the batch.
+"""
+
+import atexit
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+INSERT_COLUMNS = ('user_id', 'platform', 'message', 'cipher_response', 'timestamp')
+
+
+def new_ulid():
+    """Return a 26-char ULID: 48-bit millisecond timestamp plus 80 random bits"""
+    value = (int(time.time() * 1000) << 80) | secrets.randbits(80)
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+class InteractionWriter:
+    """Buffers interactions and user activity, flushing them in batches"""
+    def __init__(self, flush_size=200, flush_interval=1.0, max_buffer=10000, id_block=100):
+        self.enabled = os.getenv('CIPHERH_WRITE_BEHIND') == '1'
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.id_block = id_block
+        self.app = None
+        self._rows = []
+        self._counters = {}
+        self._ids = deque()
+        self._sequences = None
+        self._lock = threading.Lock()
+        self._id_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats = {'buffered': 0, 'flushed': 0, 'flushes': 0, 'failed_flushes': 0,
+                      'rejected': 0, 'dropped': 0, 'id_blocks': 0}
+
+    def start(self, app):
+        """Bind to the Flask app and start the background flusher (idempotent)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.app = app
+            self._thread = threading.Thread(target=self._run, name='cipherh-interaction-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+        logging.info('CipherH: Write-behind interaction writer started')
+
+    def reserve_id(self):
+        """Hand out a pre-allocated interaction id, or None if the database has no id sequence"""
+        with self._id_lock:
+            if not self._ids and self._sequences is not False:
+                try:
+                    self._ids.extend(self._reserve_block())
+                except Exception as e:
+                    # The row still gets an id at flush; only this response goes without one
+                    logging.error(f'CipherH: Reserving interaction ids failed: {e}')
+            return self._ids.popleft() if self._ids else None
+
+    def _reserve_block(self):
+        from sqlalchemy import text
+        from app import db
+        from models import Interaction
+
+        if self._sequences is None:
+            self._sequences = db.engine.dialect.name == 'postgresql'
+            if not self._sequences:
+                logging.warning('CipherH: No id sequence on this database; '
+                                'write-behind interaction ids are assigned at flush')
+                return []
+        # nextval is not transactional: the block stays reserved without a commit
+        with db.engine.connect() as conn:
+            ids = [row[0] for row in conn.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :n)"),
+                {'table': Interaction.__table__.fullname, 'n': self.id_block}
+            )]
+        self.stats['id_blocks'] += 1
+        return ids
+
+    def record(self, user_id, platform, message, cipher_response, timestamp=None, on_saved=None):
+        """Buffer one interaction and return its pre-allocated id (None without a sequence).
+        on_saved(interaction_id) is called from the flushing thread once the row exists."""
+        timestamp = timestamp or datetime.utcnow()
+        interaction_id = self.reserve_id()
+        with self._lock:
+            self._rows.append({
+                'id': interaction_id,
+                'user_id': user_id,
+                'platform': platform,
+                'message': message,
+                'cipher_response': cipher_response,
+                'timestamp': timestamp,
+                'on_saved': on_saved
+            })
+            count, _ = self._counters.get(user_id, (0, None))
+            self._counters[user_id] = (count + 1, timestamp)
+            self.stats['buffered'] += 1
+            pending = len(self._rows)
+        if pending >= self.max_buffer:
+            # Backpressure: the flusher is falling behind, write inline
+            self.flush()
+        elif pending >= self.flush_size:
+            self._wake.set()
+        return interaction_id
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows and counter increments, in one transaction when every row is valid"""
+        from sqlalchemy.exc import DataError, IntegrityError
+
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                counters, self._counters = self._counters, {}
+            if not rows and not counters:
+                return 0
+            written, rejected = [], []
+            try:
+                with self.app.app_context():
+                    try:
+                        written = list(zip(rows, self._write(rows, counters)))
+                    except (IntegrityError, DataError):
+                        # One bad row (e.g. its user was deleted) must not fail every later flush:
+                        # bisect the batch down to the rows the database rejects and drop those
+                        self._isolate(rows, written, rejected)
+                        self._write([], self._discount(counters, rejected))
+            except Exception as e:
+                logging.error(f'CipherH: Write-behind flush of {len(rows)} interactions failed: {e}')
+                done = {id(row) for row, _ in written} | {id(row) for row in rejected}
+                self._requeue([row for row in rows if id(row) not in done], self._discount(counters, rejected))
+                self.stats['failed_flushes'] += 1
+            else:
+                self.stats['flushes'] += 1
+            self.stats['flushed'] += len(written)
+            self._notify(written)
+            return len(written)
+
+    def _isolate(self, rows, written, rejected):
+        from sqlalchemy.exc import DataError, IntegrityError
+
+        try:
+            written.extend(zip(rows, self._write(rows, {})))
+        except (IntegrityError, DataError) as e:
+            if len(rows) == 1:
+                rejected.append(rows[0])
+                self.stats['rejected'] += 1
+                logging.error(f'CipherH: Dropping interaction of user {rows[0]["user_id"]} '
+                              f'rejected by the database: {e}')
+                return
+            half = len(rows) // 2
+            self._isolate(rows[:half], written, rejected)
+            self._isolate(rows[half:], written, rejected)
+
+    @staticmethod
+    def _discount(counters, rejected):
+        """Counter increments without those of rejected rows"""
+        if not rejected:
+            return counters
+        counters = dict(counters)
+        for row in rejected:
+            count, last = counters.get(row['user_id'], (0, None))
+            if count <= 1:
+                counters.pop(row['user_id'], None)
+            else:
+                counters[row['user_id']] = (count - 1, last)
+        return counters
+
+    def _notify(self, written):
+        for row, interaction_id in written:
+            if row['on_saved'] is not None:
+                try:
+                    row['on_saved'](interaction_id)
+                except Exception as e:
+                    logging.error(f'CipherH: Write-behind callback for interaction {interaction_id} failed: {e}')
+
+    def _write(self, rows, counters):
+        """Insert rows and apply counters in one transaction; returns the new interaction ids"""
+        from sqlalchemy import bindparam
+        from app import db
+        from models import Interaction, User
+
+        ids = []
+        try:
+            interactions = Interaction.__table__
+            reserved = [row for row in rows if row['id'] is not None]
+            if reserved:
+                db.session.execute(
+                    interactions.insert(),
+                    [{'id': row['id'], **{column: row[column] for column in INSERT_COLUMNS}} for row in reserved]
+                )
+            for row in rows:
+                if row['id'] is None:
+                    # No pre-allocated id: insert singly to learn the one the database assigns
+                    result = db.session.execute(
+                        interactions.insert().values({column: row[column] for column in INSERT_COLUMNS})
+                    )
+                    ids.append(result.inserted_primary_key[0])
+                else:
+                    ids.append(row['id'])
+            if counters:
+                users = User.__table__
+                db.session.execute(
+                    users.update()
+                    .where(users.c.id == bindparam('uid'))
+                    .values(
+                        interaction_count=users.c.interaction_count + bindparam('delta'),
+                        last_interaction=bindparam('last')
+                    ),
+                    [{'uid': uid, 'delta': count, 'last': last} for uid, (count, last) in counters.items()]
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        return ids
+
+    def _requeue(self, rows, counters):
+        with self._lock:
+            combined = rows + self._rows
+            overflow = len(combined) - self.max_buffer
+            if overflow > 0:
+                # The database has been failing long enough to fill the buffer; the oldest rows are lost
+                self.stats['dropped'] += overflow
+                logging.error(f'CipherH: Write-behind buffer full, dropped {overflow} interactions')
+                for row in combined[:overflow]:
+                    count, last = counters.get(row['user_id'], (0, None))
+                    if count:
+                        counters[row['user_id']] = (count - 1, last)
+                combined = combined[overflow:]
+            self._rows = combined
+            for uid, (count, last) in counters.items():
+                if not count:
+                    continue
+                pending, newer = self._counters.get(uid, (0, None))
+                self._counters[uid] = (pending + count, newer or last)
+
+    def stop(self):
+        """Stop the flusher and write whatever is still buffered"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self.app is not None:
+            self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'enabled': self.enabled, 'pending': len(self._rows)}
+
+
+# Global instance
+interaction_writer = InteractionWriter(
+    flush_size=int(os.getenv('CIPHERH_WRITE_BEHIND_BATCH', '200')),
+    flush_interval=float(os.getenv('CIPHERH_WRITE_BEHIND_INTERVAL', '1.0')),
+    id_block=int(os.getenv('CIPHERH_WRITE_BEHIND_ID_BLOCK', '100'))
+)
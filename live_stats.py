@@ -0,0 +1,249 @@
+"""
+CipherH Live Stats
+
+Incrementally maintained counters for the dashboard and status endpoints:
+running totals, per-platform interaction counts and 24h windows kept in a
+ring buffer of one-minute buckets. Reads are O(1). A background job
+seeds the counters on startup and periodically reconciles them against the
+database. Reconciliation applies the drift it finds as a delta, so
+increments recorded while its queries run are kept.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+
+from app import db
+from models import User, Interaction, Memory, PlatformConfig
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_epoch(timestamp):
+    return (timestamp - _EPOCH).total_seconds()
+
+
+class _Bucket:
+    __slots__ = ('index', 'interactions', 'users')
+
+    def __init__(self, index):
+        self.index = index
+        self.interactions = 0
+        self.users = set()
+
+
+class RollingWindow:
+    """Interaction count and distinct active users over a sliding window"""
+    def __init__(self, window_seconds=86400, bucket_seconds=60):
+        self.bucket_seconds = bucket_seconds
+        self.size = window_seconds // bucket_seconds
+        self.head = int(time.time() // bucket_seconds)
+        self.buckets = [None] * self.size
+        for b in range(self.head - self.size + 1, self.head + 1):
+            self.buckets[b % self.size] = _Bucket(b)
+        self.interactions = 0
+        self.last_bucket = {}
+
+    def _advance(self, index):
+        if index <= self.head:
+            return
+        start = max(self.head + 1, index - self.size + 1)
+        for b in range(start, index + 1):
+            bucket = self.buckets[b % self.size]
+            self.interactions -= bucket.interactions
+            for user_key in bucket.users:
+                if self.last_bucket.get(user_key) == bucket.index:
+                    del self.last_bucket[user_key]
+            self.buckets[b % self.size] = _Bucket(b)
+        self.head = index
+
+    def add(self, user_key, epoch_seconds):
+        index = int(epoch_seconds // self.bucket_seconds)
+        self._advance(max(index, int(time.time() // self.bucket_seconds)))
+        if index <= self.head - self.size:
+            return
+        bucket = self.buckets[index % self.size]
+        if bucket.index != index:
+            return
+        bucket.interactions += 1
+        self.interactions += 1
+
+        previous = self.last_bucket.get(user_key)
+        if previous is not None and previous >= index:
+            return
+        if previous is not None:
+            self.buckets[previous % self.size].users.discard(user_key)
+        bucket.users.add(user_key)
+        self.last_bucket[user_key] = index
+
+    def read(self):
+        self._advance(int(time.time() // self.bucket_seconds))
+        return {'interactions': self.interactions, 'active_users': len(self.last_bucket)}
+
+
+class LiveStats:
+    """Totals and rolling windows fed from the interaction write path"""
+    def __init__(self, reconcile_interval=600.0):
+        self.reconcile_interval = reconcile_interval
+        self.app = None
+        self.totals = {'users': 0, 'interactions': 0, 'memories': 0, 'platform_configs': 0, 'engaged_users': 0}
+        self.platforms = {}
+        self.window = RollingWindow()
+        self.reconciled_at = None
+        self._journal = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self, app):
+        """Start the job that seeds the counters from the database and keeps reconciling them"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.app = app
+            self._thread = threading.Thread(target=self._run, name='cipherh-live-stats', daemon=True)
+            self._thread.start()
+
+    def record_interaction(self, user_key, platform, timestamp=None, first_interaction=False):
+        epoch = _to_epoch(timestamp) if timestamp else time.time()
+        with self._lock:
+            self.totals['interactions'] += 1
+            if first_interaction:
+                self.totals['engaged_users'] += 1
+            self.platforms[platform] = self.platforms.get(platform, 0) + 1
+            self.window.add(user_key, epoch)
+            if self._journal is not None:
+                self._journal.append((user_key, epoch))
+
+    def record_created(self, counter):
+        with self._lock:
+            self.totals[counter] += 1
+
+    def record_deleted(self, counter, platform=None):
+        with self._lock:
+            self.totals[counter] = max(0, self.totals[counter] - 1)
+            if platform is not None and self.platforms.get(platform):
+                self.platforms[platform] -= 1
+
+    def snapshot(self):
+        with self._lock:
+            recent = self.window.read()
+            return {
+                'totals': dict(self.totals),
+                'recent': {
+                    'interactions_24h': recent['interactions'],
+                    'active_users_24h': recent['active_users']
+                },
+                'platforms': [
+                    {'platform': platform, 'count': count}
+                    for platform, count in sorted(self.platforms.items(), key=lambda p: -p[1])
+                ],
+                'reconciled_at': self.reconciled_at
+            }
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.reconcile()
+            except Exception as e:
+                logging.error(f'CipherH: Live stats reconciliation failed: {e}')
+            finally:
+                with self.app.app_context():
+                    db.session.remove()
+            time.sleep(self.reconcile_interval)
+
+    def reconcile(self):
+        """Correct the in-memory counters by their drift from the database"""
+        with self._lock:
+            # Counters as of the start of the queries; what is recorded from here on is kept
+            start_totals, start_platforms = dict(self.totals), dict(self.platforms)
+            self._journal = []
+        try:
+            totals, platforms, window = self._query()
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+
+        with self._lock:
+            for key, value in totals.items():
+                self.totals[key] += value - start_totals.get(key, 0)
+            for platform in set(platforms) | set(start_platforms):
+                drift = platforms.get(platform, 0) - start_platforms.get(platform, 0)
+                self.platforms[platform] = self.platforms.get(platform, 0) + drift
+            # The window was rebuilt from rows; replay the interactions recorded during the scan
+            for user_key, epoch in self._journal:
+                window.add(user_key, epoch)
+            self.window = window
+            self._journal = None
+            self.reconciled_at = datetime.utcnow().isoformat()
+        logging.info('CipherH: Live stats reconciled with database')
+
+    def _query(self):
+        totals = {
+            'users': User.query.count(),
+            'interactions': Interaction.query.count(),
+            'memories': Memory.query.count(),
+            'platform_configs': PlatformConfig.query.count(),
+            'engaged_users': User.query.filter(User.interaction_count > 0).count()
+        }
+        platforms = dict(db.session.query(
+            Interaction.platform, func.count(Interaction.id)
+        ).group_by(Interaction.platform).all())
+
+        window = RollingWindow()
+        since = datetime.utcnow() - timedelta(days=1)
+        rows = db.session.query(Interaction.user_id, Interaction.timestamp).filter(
+            Interaction.timestamp >= since
+        ).yield_per(5000)
+        for user_id, timestamp in rows:
+            window.add(user_id, _to_epoch(timestamp))
+        return totals, platforms, window
+
+
+# Global instance
+live_stats = LiveStats(reconcile_interval=float(os.getenv('CIPHERH_STATS_RECONCILE_INTERVAL', '600')))
+
+
+@event.listens_for(User, 'after_insert')
+def _count_user(mapper, connection, target):
+    live_stats.record_created('users')
+
+
+@event.listens_for(Memory, 'after_insert')
+def _count_memory(mapper, connection, target):
+    live_stats.record_created('memories')
+
+
+@event.listens_for(PlatformConfig, 'after_insert')
+def _count_platform_config(mapper, connection, target):
+    live_stats.record_created('platform_configs')
+
+
+@event.listens_for(User, 'after_delete')
+def _uncount_user(mapper, connection, target):
+    live_stats.record_deleted('users')
+    if target.interaction_count:
+        live_stats.record_deleted('engaged_users')
+
+
+@event.listens_for(Interaction, 'after_delete')
+def _uncount_interaction(mapper, connection, target):
+    # The 24h window keeps the deleted turn until the next reconciliation
+    live_stats.record_deleted('interactions', platform=target.platform)
+
+
+@event.listens_for(Memory, 'after_delete')
+def _uncount_memory(mapper, connection, target):
+    live_stats.record_deleted('memories')
+
+
+@event.listens_for(PlatformConfig, 'after_delete')
+def _uncount_platform_config(mapper, connection, target):
+    live_stats.record_deleted('platform_configs')
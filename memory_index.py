@@ -0,0 +1,564 @@
+"""
+CipherH Memory Index
+
+In-process nearest-neighbour search over Memory content for
+prompt assembly and /admin/api/memory/search. Vectors are stored as int8
+with a per-vector scale in memory-mapped files under
+CIPHERH_MEMORY_INDEX_DIR, a quarter of the size of float32. By default
+search is an exact scan, scored in cache-sized chunks of rows so no
+float32 copy of the whole matrix is made.
+
+With CIPHERH_MEMORY_INDEX_IVF=1, indexes of at least
+CIPHERH_MEMORY_INDEX_EXACT_BELOW vectors (default 50000) are searched with
+an inverted-file (IVF) index instead. Spherical k-means centroids
+partition the vectors, and a query scores only the nprobe closest
+partitions. Training rewrites the files with each partition's rows
+contiguous, so a probe reads one slice. New memories are appended and
+assigned to their partition incrementally. IVF is opt-in because its
+recall depends on how clustered the embeddings are: on the benchmark's
+hashed embeddings recall@10 stays below 0.9 until nprobe covers most
+partitions (see benchmarks/bench_memory_index.py).
+
+Training (when the index has grown 4x), compaction and catching up on
+memories created while the index was offline run on a background thread,
+never in a request. Writers in different processes are serialized by an
+flock on index.lock, and every process picks up the others' appends,
+retrains and deletes from meta.json. Deleted memories are dropped from
+results once their delete commits. A retrain, or a compaction once a
+tenth of the rows are deleted, rewrites the rows without them and
+empties the deleted set.
+
+HashingEmbedder is a deterministic local embedder: hashed word, word
+bigram and character trigram features over diacritic-folded text. It
+is the default and what the benchmarks use. A model-backed embedder
+with the same embed_many() can be passed instead. NumPy is optional:
+without it the index is disabled and search returns nothing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import Memory
+from response_cache import normalize_message
+
+
+class HashingEmbedder:
+    """Deterministic feature-hashing embedder; no model or network needed"""
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _features(self, text):
+        words = normalize_message(text).split()
+        for word in words:
+            yield word, 1.0
+            padded = f'#{word}#'
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.3
+        for a, b in zip(words, words[1:]):
+            yield f'{a} {b}', 0.7
+
+    def embed_many(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vector = vectors[row]
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vector[h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def embed(self, text):
+        return self.embed_many([text])[0]
+
+
+def _spherical_kmeans(vectors, n_clusters, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        empty = ~sums.any(axis=1)
+        # Reseed empty clusters from random points so every partition stays in use
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+class MemoryIndex:
+    """Memory-mapped index of memory embeddings with exact or IVF top-k cosine search"""
+    MIN_TRAIN = 1024
+    TRAIN_SAMPLE = 20000
+    ASSIGN_CHUNK = 65536
+    SCORE_CHUNK = 1024
+    MIN_COMPACT = 1000
+
+    def __init__(self, path, dim=256, embedder=None, nprobe=12, exact_below=50000, ivf=False):
+        self.enabled = np is not None and os.getenv('CIPHERH_MEMORY_INDEX', '1') != '0'
+        self.path = path
+        self.dim = dim
+        self.embedder = embedder
+        self.nprobe = nprobe
+        self.exact_below = exact_below
+        self.ivf = ivf
+        self.count = 0
+        self.capacity = 0
+        self.trained_count = 0
+        self.max_memory_id = 0
+        self.generation = 0
+        self.deleted = set()
+        self.vectors = None
+        self.scales = None
+        self.ids = None
+        self.assign = None
+        self.centroids = None
+        self.bounds = None
+        self._pending_lists = []
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._meta_mtime = None
+        self.app = None
+        self._thread = None
+        self._wake = threading.Event()
+        self.caught_up = False
+        self.stats = {'searches': 0, 'exact_searches': 0, 'added': 0, 'trainings': 0, 'compactions': 0,
+                      'last_search_ms': None}
+
+    # ---- storage ----
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _data_file(self, name, generation=None):
+        # Row files are versioned; meta.json names the live generation
+        return self._file(f'{name}.{self.generation if generation is None else generation}')
+
+    def _map(self, filename, dtype, shape):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(filename, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+
+    def _grow(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2, 4096)
+        for array in (self.vectors, self.scales, self.ids, self.assign):
+            if array is not None:
+                array.flush()
+        self.vectors = self._map(self._data_file('vectors.i8'), np.int8, (capacity, self.dim))
+        self.scales = self._map(self._data_file('scales.f32'), np.float32, (capacity,))
+        self.ids = self._map(self._data_file('ids.i64'), np.int64, (capacity,))
+        self.assign = self._map(self._data_file('assign.i32'), np.int32, (capacity,))
+        self.capacity = capacity
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared with other processes writing this index"""
+        if fcntl is None:
+            yield
+            return
+        with open(self._file('index.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save_meta(self):
+        for array in (self.vectors, self.scales, self.ids, self.assign):
+            if array is not None:
+                array.flush()
+        meta = {
+            'dim': self.dim,
+            'count': self.count,
+            'trained_count': self.trained_count,
+            'max_memory_id': self.max_memory_id,
+            'generation': self.generation,
+            'deleted': sorted(self.deleted)
+        }
+        tmp = self._file(f'meta.json.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file('meta.json'))
+        self._meta_mtime = os.stat(self._file('meta.json')).st_mtime_ns
+
+    def _refresh(self):
+        """Pick up appends, retrains and deletes that other processes wrote to meta.json"""
+        try:
+            mtime = os.stat(self._file('meta.json')).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._meta_mtime:
+            return
+        with open(self._file('meta.json')) as f:
+            meta = json.load(f)
+        self._meta_mtime = mtime
+        self._apply_meta(meta)
+
+    def _apply_meta(self, meta):
+        if meta.get('dim', self.dim) != self.dim:
+            raise ValueError(f'Memory index at {self.path} has dim {meta.get("dim")}, expected {self.dim}')
+        previous = self.count
+        generation = meta.get('generation', 0)
+        if generation != self.generation or self.vectors is None:
+            # Retrained elsewhere: the rows were rewritten into new files
+            self.vectors = self.scales = self.ids = self.assign = None
+            self.generation, self.capacity, self.centroids, previous = generation, 0, None, None
+        self.count = meta.get('count', 0)
+        self.trained_count = meta.get('trained_count', 0)
+        self.max_memory_id = meta.get('max_memory_id', 0)
+        self.deleted = set(meta.get('deleted', []))
+        self._grow(self.count)
+        if previous is None:
+            if self.trained_count and os.path.exists(self._data_file('centroids.npy')):
+                self.centroids = np.load(self._data_file('centroids.npy'))
+                self._rebuild_lists()
+        elif self.centroids is not None:
+            for row in range(previous, self.count):
+                self._pending_lists[self.assign[row]].append(row)
+
+    def load(self):
+        """Open the on-disk index, creating an empty one if none exists"""
+        with self._lock:
+            if self._loaded or not self.enabled:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self.embedder = self.embedder or HashingEmbedder(self.dim)
+            self._refresh()
+            if self.vectors is None:
+                self._apply_meta({})
+            self._loaded = True
+            logging.info(f'CipherH: Memory index loaded with {self.count} vectors from {self.path}')
+
+    def _rebuild_lists(self):
+        # Trained rows are sorted by partition; rows added since then are tracked per partition
+        self.bounds = np.searchsorted(np.asarray(self.assign[:self.trained_count]),
+                                      np.arange(len(self.centroids) + 1))
+        self._pending_lists = [[] for _ in self.centroids]
+        for row in range(self.trained_count, self.count):
+            self._pending_lists[self.assign[row]].append(row)
+
+    # ---- writes ----
+
+    def _needs_training(self):
+        return self.ivf and self.count >= max(self.exact_below, self.MIN_TRAIN) and \
+            self.count >= 4 * self.trained_count
+
+    def _needs_compaction(self):
+        return len(self.deleted) >= max(self.MIN_COMPACT, self.count // 10)
+
+    def add_many(self, memory_ids, texts):
+        """Embed and append memories; a retrain, once due, is left to the background thread"""
+        if not self.enabled or not memory_ids:
+            return
+        self.load()
+        vectors = self.embedder.embed_many(list(texts))
+        with self._lock, self._file_lock():
+            self._refresh()
+            start = self.count
+            end = start + len(memory_ids)
+            self._grow(end)
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.vectors[start:end] = np.rint(vectors / scales[:, None])
+            self.scales[start:end] = scales
+            self.ids[start:end] = memory_ids
+            self.count = end
+            self.max_memory_id = max(self.max_memory_id, int(max(memory_ids)))
+            self.stats['added'] += len(memory_ids)
+            if self.centroids is not None:
+                labels = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+                self.assign[start:end] = labels
+                for row, label in zip(range(start, end), labels):
+                    self._pending_lists[label].append(row)
+            self._save_meta()
+            if self._needs_training():
+                self._wake.set()
+
+    def add(self, memory_id, text):
+        self.add_many([memory_id], [text])
+
+    def remove(self, memory_id):
+        """Drop a memory from search results"""
+        if not self.enabled:
+            return
+        self.load()
+        with self._lock, self._file_lock():
+            self._refresh()
+            self.deleted.add(int(memory_id))
+            self._save_meta()
+            if self._needs_compaction():
+                self._wake.set()
+
+    def train(self):
+        """(Re)build IVF partitions over every stored vector and rewrite rows in partition order,
+        dropping deleted memories"""
+        started = time.monotonic()
+        with self._lock:
+            self._refresh()
+            generation = self.generation
+            sampled_count = self.count
+            n_clusters = int(min(1024, max(16, np.sqrt(sampled_count))))
+            rng = np.random.default_rng(sampled_count)
+            sample_rows = np.sort(rng.choice(sampled_count, min(sampled_count, self.TRAIN_SAMPLE), replace=False))
+            sample = self._dequantize(sample_rows)
+        # k-means runs without the locks, so searches and appends carry on meanwhile
+        centroids = _spherical_kmeans(sample, n_clusters)
+
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.generation != generation:
+                # Another process retrained or compacted while the centroids were computed
+                return
+            labels = np.empty(self.count, dtype=np.int32)
+            for start in range(0, self.count, self.ASSIGN_CHUNK):
+                # Per-row scales are positive and don't change the argmax
+                end = min(start + self.ASSIGN_CHUNK, self.count)
+                chunk = np.asarray(self.vectors[start:end], dtype=np.float32)
+                labels[start:end] = np.argmax(chunk @ centroids.T, axis=1)
+            self._rewrite(labels, centroids)
+            self.stats['trainings'] += 1
+            logging.info(f'CipherH: Memory index trained {n_clusters} partitions over {self.count} vectors '
+                         f'in {time.monotonic() - started:.1f}s')
+
+    def compact(self):
+        """Rewrite the rows without deleted memories, keeping the current partitions"""
+        with self._lock, self._file_lock():
+            self._refresh()
+            if not self.deleted:
+                return
+            dropped = len(self.deleted)
+            if self.centroids is not None:
+                labels = np.array(self.assign[:self.count], dtype=np.int32)
+            else:
+                labels = np.zeros(self.count, dtype=np.int32)
+            self._rewrite(labels, self.centroids)
+            self.stats['compactions'] += 1
+            logging.info(f'CipherH: Memory index compacted {dropped} deleted memories, {self.count} vectors left')
+
+    def _rewrite(self, labels, centroids):
+        """Write the live rows in partition order as the next generation; caller holds both locks"""
+        rows = np.arange(self.count)
+        found = set()
+        if self.deleted:
+            gone = np.isin(np.asarray(self.ids[:self.count]), np.fromiter(self.deleted, dtype=np.int64))
+            found = set(np.asarray(self.ids[:self.count])[gone].tolist())
+            rows = np.flatnonzero(~gone)
+        order = rows[np.argsort(labels[rows], kind='stable')]
+        count = len(order)
+
+        # Write the next generation beside the live one; meta.json switches over atomically
+        old_generation, capacity = self.generation, self.capacity
+        generation = old_generation + 1
+        columns = [('vectors.i8', self.vectors), ('scales.f32', self.scales), ('ids.i64', self.ids)]
+        for name, source in columns:
+            target = self._map(self._data_file(name, generation), source.dtype, source.shape)
+            for start in range(0, count, self.ASSIGN_CHUNK):
+                chunk = order[start:start + self.ASSIGN_CHUNK]
+                target[start:start + len(chunk)] = source[chunk]
+            target.flush()
+            del target
+        assign = self._map(self._data_file('assign.i32', generation), np.int32, (capacity,))
+        assign[:count] = labels[order]
+        assign.flush()
+        del assign
+        if centroids is not None:
+            with open(self._data_file('centroids.npy', generation), 'wb') as f:
+                np.save(f, centroids)
+
+        self.vectors = self.scales = self.ids = self.assign = None
+        self.generation, self.capacity = generation, 0
+        self._grow(capacity)
+        self.centroids = centroids
+        self.count = count
+        self.trained_count = count if centroids is not None else 0
+        # Deleted ids with no row yet may still be appended (their add raced the delete); keep those
+        self.deleted = {i for i in self.deleted if i not in found and i > self.max_memory_id}
+        self._save_meta()
+        for name in ('vectors.i8', 'scales.f32', 'ids.i64', 'assign.i32', 'centroids.npy'):
+            try:
+                os.remove(self._data_file(name, old_generation))
+            except FileNotFoundError:
+                pass
+        if centroids is not None:
+            self._rebuild_lists()
+
+    # ---- reads ----
+
+    def _dequantize(self, rows):
+        return np.asarray(self.vectors[rows], dtype=np.float32) * self.scales[rows][:, None]
+
+    def _score(self, rows, query):
+        """(scores, ids) for a row slice or an array of row numbers"""
+        return (np.asarray(self.vectors[rows], dtype=np.float32) @ query) * self.scales[rows], \
+            np.asarray(self.ids[rows])
+
+    @staticmethod
+    def _top(scores, ids, k, deleted):
+        """The k best (scores, ids), unordered, without deleted ids"""
+        if deleted is not None:
+            keep = ~np.isin(ids, deleted)
+            scores, ids = scores[keep], ids[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+            scores, ids = scores[top], ids[top]
+        return scores, ids
+
+    def _exact_scores(self, query):
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, self.SCORE_CHUNK):
+            end = min(start + self.SCORE_CHUNK, self.count)
+            # Cache-sized chunks: only a chunk is ever converted to float32, and it stays in cache
+            np.matmul(self.vectors[start:end].astype(np.float32), query, out=scores[start:end])
+        scores *= self.scales[:self.count]
+        return scores, np.asarray(self.ids[:self.count])
+
+    def search_vector(self, query, k=5, nprobe=None):
+        query = np.asarray(query, dtype=np.float32)
+        with self._lock:
+            self._refresh()
+            if not self.count:
+                return []
+            deleted = np.fromiter(self.deleted, dtype=np.int64) if self.deleted else None
+            if not self.ivf or self.centroids is None or self.count < self.exact_below:
+                parts = [self._exact_scores(query)]
+                self.stats['exact_searches'] += 1
+            else:
+                probes = np.argsort(query @ self.centroids.T)[::-1][:nprobe or self.nprobe]
+                parts = [self._score(slice(self.bounds[c], self.bounds[c + 1]), query) for c in probes]
+                pending = [row for c in probes for row in self._pending_lists[c]]
+                if pending:
+                    parts.append(self._score(np.sort(np.asarray(pending, dtype=np.int64)), query))
+            scores, ids = self._top(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]),
+                                    k, deleted)
+            order = np.argsort(-scores)
+            return [{'memory_id': int(ids[i]), 'score': round(float(scores[i]), 4)} for i in order]
+
+    def search(self, text, k=5, nprobe=None):
+        """Top-k memories by cosine similarity to text: [{'memory_id', 'score'}]"""
+        if not self.enabled:
+            return []
+        self.load()
+        started = time.perf_counter()
+        results = self.search_vector(self.embedder.embed(text), k, nprobe)
+        self.stats['searches'] += 1
+        self.stats['last_search_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return results
+
+    def catch_up(self, batch_size=5000):
+        """Index memories created since the last indexed id (e.g. while the index was offline)"""
+        if not self.enabled:
+            return 0
+        self.load()
+        added = 0
+        while True:
+            rows = Memory.query.with_entities(Memory.id, Memory.content)\
+                .filter(Memory.id > self.max_memory_id)\
+                .order_by(Memory.id).limit(batch_size).all()
+            if not rows:
+                self.caught_up = True
+                return added
+            self.add_many([r.id for r in rows], [r.content or '' for r in rows])
+            added += len(rows)
+
+    def start(self, app):
+        """Start the background thread that catches up on missed memories and retrains"""
+        if self._thread is not None or not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None:
+                self.app = app
+                self._thread = threading.Thread(target=self._run, name='cipherh-memory-index', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    if not self.caught_up:
+                        self.catch_up()
+                    with self._lock:
+                        self._refresh()
+                        train, compact = self._needs_training(), self._needs_compaction()
+                    if train:
+                        self.train()
+                    elif compact:
+                        self.compact()
+            except Exception as e:
+                logging.error(f'CipherH: Memory index maintenance failed: {e}')
+            self._wake.wait(60)
+            self._wake.clear()
+
+    def lookup(self, text, k=5, nprobe=None):
+        """Top-k Memory rows for text as (memory, score), best first"""
+        hits = self.search(text, k, nprobe)
+        if not hits:
+            return []
+        memories = {m.id: m for m in Memory.query.filter(Memory.id.in_([h['memory_id'] for h in hits]))}
+        return [(memories[h['memory_id']], h['score']) for h in hits if h['memory_id'] in memories]
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            'enabled': self.enabled,
+            'vectors': self.count,
+            'deleted': len(self.deleted),
+            'partitions': len(self.centroids) if self.centroids is not None else 0,
+            'ivf': self.ivf,
+            'nprobe': self.nprobe,
+            'exact_below': self.exact_below,
+            'caught_up': self.caught_up
+        }
+
+
+# Global instance
+memory_index = MemoryIndex(
+    os.getenv('CIPHERH_MEMORY_INDEX_DIR', 'memory_index'),
+    dim=int(os.getenv('CIPHERH_MEMORY_INDEX_DIM', '256')),
+    nprobe=int(os.getenv('CIPHERH_MEMORY_INDEX_NPROBE', '12')),
+    exact_below=int(os.getenv('CIPHERH_MEMORY_INDEX_EXACT_BELOW', '50000')),
+    ivf=os.getenv('CIPHERH_MEMORY_INDEX_IVF') == '1'
+)
+
+
+@event.listens_for(Memory, 'after_delete')
+def _queue_removal(mapper, connection, target):
+    # A rolled-back delete must stay searchable; remove only once it commits
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('cipherh_deleted_memories', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _remove_deleted_memories(session):
+    for memory_id in session.info.pop('cipherh_deleted_memories', ()):
+        try:
+            memory_index.remove(memory_id)
+        except Exception as e:
+            logging.error(f'CipherH: Removing memory {memory_id} from the index failed: {e}')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_deleted_memories(session):
+    session.info.pop('cipherh_deleted_memories', None)
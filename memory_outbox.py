@@ -0,0 +1,261 @@
+"""
+CipherH Memory Outbox
+
+Moves Notion writes out of the request path. create_memory commits the
+Memory row and a pending memory_outbox row in the same transaction. A
+background syncer claims pending rows in batches and stores them in the
+vault, paced by a token bucket at Notion's rate limit. It then fills in
+Memory.notion_id. Failures are retried with exponential backoff until
+max_attempts. The syncer starts with the app, so rows left pending by a
+restart are drained without waiting for the next write. Vault index
+refreshes (always a full update_memory_index) run in the background, and
+the time of the last one is kept in vault_sync_state. FakeVault
+(CIPHERH_FAKE_VAULT=1) stands in for Notion locally.
+"""
+
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+from app import db
+from models import Memory
+from platform_adapters import TokenBucket
+
+PENDING = 'pending'
+SYNCED = 'synced'
+FAILED = 'failed'
+
+
+class MemoryOutbox(db.Model):
+    __tablename__ = 'memory_outbox'
+
+    memory_id = db.Column(db.Integer, db.ForeignKey(Memory.__table__.c.id, ondelete='CASCADE'), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default=PENDING, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.Float, nullable=False, default=time.time)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    synced_at = db.Column(db.DateTime)
+
+
+class VaultSyncState(db.Model):
+    __tablename__ = 'vault_sync_state'
+
+    key = db.Column(db.String(64), primary_key=True)
+    watermark = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class FakeVault:
+    """Local stand-in for the Notion vault with latency and injectable failures"""
+    def __init__(self, latency=0.05, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.insights = {}
+        self.calls = 0
+        self.index_runs = []
+        self._lock = threading.Lock()
+
+    def store_insight(self, content, confidence, memory_type):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if self.fail_every and self.calls % self.fail_every == 0:
+                raise ConnectionError('Fake vault: simulated Notion 502')
+            notion_id = f'fake-{secrets.token_hex(8)}'
+            self.insights[notion_id] = {'content': content, 'confidence': confidence, 'memory_type': memory_type}
+        return notion_id
+
+    def update_memory_index(self):
+        time.sleep(self.latency)
+        self.index_runs.append(datetime.utcnow())
+        return len(self.insights)
+
+    def get_vault_status(self):
+        return {'connected': True, 'fake': True, 'insights': len(self.insights)}
+
+
+class MemorySyncer:
+    """Background worker draining memory_outbox into the vault"""
+    WATERMARK_KEY = 'memory_index'
+
+    def __init__(self, batch_size=20, interval=5.0, rate=3.0, burst=3, max_attempts=8, lease_seconds=120.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.bucket = TokenBucket(rate, burst)
+        self.app = None
+        self._vault = None
+        self._wake = threading.Event()
+        self._reindex = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._tables_ready = False
+        self.stats = {'synced': 0, 'retried': 0, 'failed': 0, 'batches': 0, 'index_runs': 0}
+
+    @property
+    def vault(self):
+        if self._vault is None:
+            if os.getenv('CIPHERH_FAKE_VAULT') == '1':
+                self._vault = fake_vault
+            else:
+                from app import notion_vault
+                self._vault = notion_vault
+        return self._vault
+
+    def ensure_tables(self):
+        if not self._tables_ready:
+            MemoryOutbox.__table__.create(db.engine, checkfirst=True)
+            VaultSyncState.__table__.create(db.engine, checkfirst=True)
+            self._tables_ready = True
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self.app = app
+                self._thread = threading.Thread(target=self._run, name='cipherh-memory-sync', daemon=True)
+                self._thread.start()
+                logging.info('CipherH: Memory syncer started')
+
+    def enqueue(self, memory):
+        """Add the outbox row for a new memory to the current transaction"""
+        self.ensure_tables()
+        db.session.add(MemoryOutbox(memory_id=memory.id, status=PENDING, available_at=time.time()))
+
+    def wake(self):
+        self._wake.set()
+
+    def request_reindex(self):
+        self._reindex.set()
+        self._wake.set()
+
+    def claim(self):
+        """Lease up to batch_size due rows; a row another worker leased first is skipped"""
+        now = time.time()
+        candidates = [memory_id for (memory_id,) in db.session.query(MemoryOutbox.memory_id).filter(
+            MemoryOutbox.status == PENDING, MemoryOutbox.available_at <= now
+        ).order_by(MemoryOutbox.memory_id).limit(self.batch_size)]
+        claimed = []
+        table = MemoryOutbox.__table__
+        for memory_id in candidates:
+            result = db.session.execute(
+                table.update()
+                .where(table.c.memory_id == memory_id, table.c.status == PENDING, table.c.available_at <= now)
+                .values(available_at=now + self.lease_seconds, attempts=table.c.attempts + 1)
+            )
+            if result.rowcount:
+                claimed.append(memory_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        memories = {m.id: m for m in Memory.query.filter(Memory.id.in_(claimed))}
+        missing = [i for i in claimed if i not in memories]
+        if missing:
+            # Memory deleted before it was synced
+            db.session.execute(table.update().where(table.c.memory_id.in_(missing)).values(
+                status=FAILED, last_error='Memory no longer exists'))
+            db.session.commit()
+        attempts = dict(db.session.query(MemoryOutbox.memory_id, MemoryOutbox.attempts).filter(
+            MemoryOutbox.memory_id.in_(claimed)))
+        return [(memories[i], attempts[i]) for i in claimed if i in memories]
+
+    def sync_batch(self):
+        """Store one claimed batch in the vault; returns the number of rows handled"""
+        batch = self.claim()
+        if not batch:
+            return 0
+        synced, failures = [], []
+        for memory, attempts in batch:
+            wait = self.bucket.reserve()
+            if wait:
+                time.sleep(wait)
+            try:
+                notion_id = self.vault.store_insight(memory.content, memory.confidence, memory.memory_type)
+                if not notion_id:
+                    raise RuntimeError('Vault returned no id')
+                synced.append((memory.id, notion_id))
+            except Exception as e:
+                failures.append((memory.id, attempts, str(e)))
+
+        now = datetime.utcnow()
+        memory_table, outbox = Memory.__table__, MemoryOutbox.__table__
+        for memory_id, notion_id in synced:
+            db.session.execute(memory_table.update().where(memory_table.c.id == memory_id).values(notion_id=notion_id))
+            db.session.execute(outbox.update().where(outbox.c.memory_id == memory_id).values(
+                status=SYNCED, synced_at=now, last_error=None))
+        for memory_id, attempts, error in failures:
+            if attempts >= self.max_attempts:
+                values = {'status': FAILED, 'last_error': error}
+                self.stats['failed'] += 1
+                logging.error(f'CipherH: Memory {memory_id} failed to sync to vault: {error}')
+            else:
+                values = {'available_at': time.time() + min(600, 2 ** attempts), 'last_error': error}
+                self.stats['retried'] += 1
+            db.session.execute(outbox.update().where(outbox.c.memory_id == memory_id).values(**values))
+        db.session.commit()
+        self.stats['synced'] += len(synced)
+        self.stats['batches'] += 1
+        return len(batch)
+
+    def reindex(self):
+        """Rebuild the vault index and record when the run started"""
+        started = datetime.utcnow()
+        self.vault.update_memory_index()
+        state = db.session.get(VaultSyncState, self.WATERMARK_KEY)
+        if state is None:
+            state = VaultSyncState(key=self.WATERMARK_KEY)
+            db.session.add(state)
+        # Start time, not end time: memories synced during the run may not be in the index yet
+        state.watermark = started
+        state.updated_at = datetime.utcnow()
+        db.session.commit()
+        self.stats['index_runs'] += 1
+        logging.info('CipherH: Vault index refreshed')
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.ensure_tables()
+                    while self.sync_batch() == self.batch_size:
+                        pass
+                    if self._reindex.is_set():
+                        # Cleared first so a request made during the run triggers another one
+                        self._reindex.clear()
+                        try:
+                            self.reindex()
+                        except Exception:
+                            # Keep the request; it is retried on the next pass
+                            self._reindex.set()
+                            raise
+            except Exception as e:
+                logging.error(f'CipherH: Memory sync error: {e}')
+            finally:
+                with self.app.app_context():
+                    db.session.remove()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def get_stats(self):
+        counts = dict(db.session.query(MemoryOutbox.status, db.func.count(MemoryOutbox.memory_id))
+                      .group_by(MemoryOutbox.status).all()) if self._tables_ready else {}
+        state = db.session.get(VaultSyncState, self.WATERMARK_KEY) if self._tables_ready else None
+        return {
+            **self.stats,
+            'by_status': counts,
+            'last_reindex': state.watermark.isoformat() if state and state.watermark else None
+        }
+
+
+# Global instances
+fake_vault = FakeVault(latency=float(os.getenv('CIPHERH_FAKE_VAULT_LATENCY_MS', '50')) / 1000)
+memory_syncer = MemorySyncer(
+    batch_size=int(os.getenv('CIPHERH_MEMORY_SYNC_BATCH', '20')),
+    rate=float(os.getenv('CIPHERH_NOTION_RATE_LIMIT', '3'))
+)
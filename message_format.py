@@ -0,0 +1,287 @@
+"""
+CipherH Message Formatting
+
+Table-driven outbound formatting shared by the platform adapters. Each
+platform has a MessageFormat in PLATFORM_FORMATS with up to four limits:
+code points, UTF-16 units (what Telegram counts), UTF-8 bytes and
+grapheme clusters. A spec also sets a markup dialect (Telegram
+MarkdownV2 escaping) and an optional template. Templates are compiled
+once, when the spec is built.
+
+A reply over the limit is split into parts at a paragraph, line,
+sentence or word boundary instead of being cut with '...'. Only the
+last allowed part (max_parts) is ever truncated. No cut lands inside a
+grapheme cluster: combining marks, emoji ZWJ sequences, skin tones,
+flags and keycaps stay whole. Messages that fit take a fast path of
+one length check.
+"""
+
+import re
+import string
+import sys
+import unicodedata
+
+ELLIPSIS = '…'
+ZWJ = '\u200d'
+
+# Markdown V2 reserved characters; each must be backslash-escaped in plain text
+_MARKDOWN_V2_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+_MARKDOWN_V2_RE = re.compile('[' + re.escape(_MARKDOWN_V2_SPECIAL) + ']')
+
+_SENTENCE_END_RE = re.compile(r'[.!?…。](?=\s)')
+
+
+def _is_regional_indicator(ch):
+    return '\U0001F1E6' <= ch <= '\U0001F1FF'
+
+
+def _extends(text, i):
+    """True if text[i] continues the grapheme cluster of text[i - 1] (no cut before i)"""
+    ch, prev = text[i], text[i - 1]
+    if ch == ZWJ or prev == ZWJ or (prev == '\r' and ch == '\n'):
+        return True
+    if ('\ufe00' <= ch <= '\ufe0f' or '\U0001F3FB' <= ch <= '\U0001F3FF' or ch == '\u20e3'
+            or '\U000E0020' <= ch <= '\U000E007F' or '\U000E0100' <= ch <= '\U000E01EF'):
+        return True
+    if unicodedata.combining(ch) or unicodedata.category(ch) in ('Mn', 'Mc', 'Me'):
+        return True
+    if _is_regional_indicator(ch) and _is_regional_indicator(prev):
+        # Flags are RI pairs: ch joins prev only if prev opens a pair
+        run = 1
+        while i - run - 1 >= 0 and _is_regional_indicator(text[i - run - 1]):
+            run += 1
+        return run % 2 == 1
+    return False
+
+
+def grapheme_boundary(text, i):
+    """Largest grapheme cluster boundary <= i"""
+    while 0 < i < len(text) and _extends(text, i):
+        i -= 1
+    return i
+
+
+def count_graphemes(text):
+    return sum(1 for i in range(len(text)) if i == 0 or not _extends(text, i))
+
+
+def _escape_match(match):
+    return '\\' + match[0]
+
+
+def escape_markdown_v2(text):
+    # Most replies have nothing to escape: one scan, no copy
+    if _MARKDOWN_V2_RE.search(text) is None:
+        return text
+    # A callable is ~2x faster than a backreference template, which is expanded per match
+    return _MARKDOWN_V2_RE.sub(_escape_match, text)
+
+
+DIALECTS = {
+    'plain': None,
+    'markdown_v2': escape_markdown_v2
+}
+
+
+class CompiledTemplate:
+    """A str.format-style template parsed once into literal and field pieces"""
+    def __init__(self, template):
+        self.template = template
+        self.pieces = []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if spec or conversion:
+                raise ValueError(f'Template field {{{field}}} uses a format spec, which is not supported')
+            self.pieces.append((literal, field))
+        self.fields = {field for _, field in self.pieces if field}
+        # The usual shape, text around a single {message}, is kept as a (prefix, suffix)
+        # pair and renders as one concatenation; None for any other shape
+        self.simple = None
+        if [field for _, field in self.pieces if field] == ['message']:
+            index = next(i for i, (_, field) in enumerate(self.pieces) if field)
+            self.simple = (''.join(literal for literal, _ in self.pieces[:index + 1]),
+                           ''.join(literal for literal, _ in self.pieces[index + 1:]))
+
+    def render(self, values):
+        out = []
+        for literal, field in self.pieces:
+            out.append(literal)
+            if field:
+                out.append(str(values.get(field, '')))
+        return ''.join(out)
+
+
+class MessageFormat:
+    """Per-platform limits, markup dialect and template for outbound messages"""
+    def __init__(self, max_chars=None, max_utf16=None, max_bytes=None, max_graphemes=None,
+                 dialect='plain', template=None, max_parts=5, parse_mode=None):
+        if dialect not in DIALECTS:
+            raise ValueError(f'Unknown markup dialect {dialect}')
+        self.escape = DIALECTS[dialect]
+        self.dialect = dialect
+        self.parse_mode = parse_mode
+        self.max_parts = max_parts
+        self.template = CompiledTemplate(template) if template else None
+        # (prefix, suffix) of a simple template, else None
+        self.framing = self.template.simple if self.template else None
+
+        # Template text counts against every limit; reserve it once here
+        frame = self.template.render({'message': ''}) if self.template else ''
+        self.limits = []
+        for unit, limit in (('chars', max_chars), ('utf16', max_utf16),
+                            ('bytes', max_bytes), ('graphemes', max_graphemes)):
+            if limit is not None:
+                budget = limit - self.measure(frame, unit)
+                if budget <= 0:
+                    raise ValueError(f'Template leaves no room for the message under the {unit} limit')
+                self.limits.append((unit, budget))
+        # Any text this short fits every limit without measuring it
+        self.fast_len = min((budget // {'utf16': 2, 'bytes': 4}.get(unit, 1) for unit, budget in self.limits),
+                            default=sys.maxsize)
+        # Replies up to this length skip splitting; -1 when the template needs a full render
+        self.short_len = self.fast_len if self.template is None or self.framing is not None else -1
+        self.format_one = self._compile_format_one()
+
+    @staticmethod
+    def measure(text, unit):
+        if unit == 'chars':
+            return len(text)
+        if unit == 'utf16':
+            return len(text.encode('utf-16-le')) // 2
+        if unit == 'bytes':
+            return len(text.encode('utf-8'))
+        return count_graphemes(text)
+
+    def fits(self, text):
+        if len(text) <= self.fast_len:
+            return True
+        return all(self.measure(text, unit) <= budget for unit, budget in self.limits)
+
+    def _max_prefix(self, text, suffix=''):
+        """Length of the longest prefix that fits with suffix appended, at a grapheme boundary"""
+        hi = len(text)
+        for unit, budget in self.limits:
+            if unit != 'graphemes':
+                # These count every code point as at least one unit
+                hi = min(hi, budget - len(suffix))
+        hi = max(hi, 0)
+        if not self.fits(text[:hi] + suffix):
+            # Binary search the longest fitting prefix; every measure grows with length
+            lo = 0
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.fits(text[:mid] + suffix):
+                    lo = mid
+                else:
+                    hi = mid - 1
+        return grapheme_boundary(text, hi)
+
+    @staticmethod
+    def _break_at(text, cut):
+        """Move a cut back to the best natural break in the last half of the part"""
+        if cut >= len(text):
+            return cut
+        floor = cut // 2
+        for separator in ('\n\n', '\n'):
+            i = text.rfind(separator, floor, cut)
+            if i != -1:
+                return i + len(separator)
+        ends = [m.end() for m in _SENTENCE_END_RE.finditer(text, floor, cut)]
+        if ends:
+            return ends[-1]
+        i = max(text.rfind(' ', floor, cut), text.rfind('\t', floor, cut))
+        return i + 1 if i != -1 else cut
+
+    def split(self, text, max_parts=None):
+        """Split text into parts that each fit the limits (before markup and template)"""
+        if self.fits(text):
+            return [text]
+        max_parts = max_parts or self.max_parts
+        parts = []
+        rest = text
+        while rest and not self.fits(rest):
+            if len(parts) == max_parts - 1:
+                # Out of parts: truncate the last one with a single-character ellipsis
+                cut = self._max_prefix(rest, suffix=ELLIPSIS)
+                parts.append(rest[:cut].rstrip() + ELLIPSIS)
+                return parts
+            cut = self._max_prefix(rest)
+            if cut == 0:
+                # A single grapheme larger than the limit; cut it rather than loop forever
+                cut = max(1, min(len(rest), min(b for _, b in self.limits)))
+            else:
+                cut = self._break_at(rest, cut)
+            part = rest[:cut].rstrip()
+            if part:
+                parts.append(part)
+            rest = rest[cut:].lstrip()
+        if rest:
+            parts.append(rest)
+        return parts
+
+    def _compile_format_one(self):
+        """Build format_one for this spec. A short reply reads only closure variables: one length
+        check (none without limits), then the escape or the one concatenation the spec needs."""
+        short_len, escape, general = self.short_len, self.escape, self.format
+        prefix, suffix = self.framing or ('', '')
+
+        def truncated(message, context):
+            return general(message, context, max_parts=1)[0]
+
+        if short_len < 0:
+            def format_one(message, context=None):
+                return truncated(message, context)
+        elif escape is not None:
+            def format_one(message, context=None):
+                if len(message) > short_len:
+                    return truncated(message, context)
+                return f'{prefix}{escape(message)}{suffix}'
+        elif self.framing is None:
+            def format_one(message, context=None):
+                if len(message) > short_len:
+                    return truncated(message, context)
+                return message
+        elif not self.limits:
+            def format_one(message, context=None):
+                return f'{prefix}{message}{suffix}'
+        else:
+            def format_one(message, context=None):
+                if len(message) > short_len:
+                    return truncated(message, context)
+                return f'{prefix}{message}{suffix}'
+        format_one.__doc__ = ('Return the message as one string within the limits, '
+                              'truncated with an ellipsis if too long')
+        return format_one
+
+    def format(self, message, context=None, max_parts=None):
+        """Return the list of message parts to send, in order; max_parts=1 truncates instead of splitting"""
+        if len(message) <= self.short_len:
+            return [self.format_one(message)]
+        parts = self.split(message, max_parts)
+        if self.escape is None and self.template is None:
+            return parts
+        values = dict(context) if isinstance(context, dict) else {}
+        formatted = []
+        for part in parts:
+            if self.escape is not None:
+                part = self.escape(part)
+            if self.framing is not None:
+                prefix, suffix = self.framing
+                part = f'{prefix}{part}{suffix}'
+            elif self.template is not None:
+                values['message'] = part
+                part = self.template.render(values)
+            formatted.append(part)
+        return formatted
+
+
+EMAIL_TEMPLATE = ('Xin chào,\n\n{message}\n\nBest regards,\nTrần Văn Khải (CipherH)\n\n---\n'
+                  'Tin nhắn này được gửi tự động từ hệ thống CipherH AGI.')
+
+PLATFORM_FORMATS = {
+    'facebook': MessageFormat(max_chars=2000),
+    'tiktok': MessageFormat(max_chars=500),
+    'zalo': MessageFormat(max_chars=1000),
+    # Telegram counts UTF-16 units of the text after entity parsing, so escapes are free
+    'telegram': MessageFormat(max_utf16=4096, dialect='markdown_v2', parse_mode='MarkdownV2'),
+    'email': MessageFormat(template=EMAIL_TEMPLATE, max_parts=1)
+}
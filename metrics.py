@@ -0,0 +1,281 @@
+"""
+CipherH Metrics
+
+Latency histograms for the hot paths. Each one is keyed by a small set
+of labels:
+
+- HTTP request latency per route
+- brain call latency
+- DB commit time
+- adapter send time
+- webhook queue lag
+
+They are exported in Prometheus text format at /metrics and summarized
+(count, p50/p90/p99, max) in /admin/api/system/status.
+
+Histograms are HDR-style: 16 log-linear sub-buckets per power of two of
+microseconds, so a recorded value is off by at most 1/16 (6.25%). Each
+thread (or greenlet) records into its own bucket array, so observe()
+takes no lock. The arrays are only summed when the histogram is read.
+When a thread ends, its array is folded into a shared one and dropped,
+so thread-per-request servers do not accumulate arrays. For Prometheus,
+the fine buckets are folded into fixed `le` buckets. A fine bucket that
+straddles a boundary is counted in the next `le` up. Disable with
+CIPHERH_METRICS=0.
+"""
+
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+# Up to 2^36 us (~19 hours); anything longer lands in the last bucket
+MAX_SHIFT = 32
+BUCKET_COUNT = SUB_COUNT + (MAX_SHIFT + 1) * SUB_COUNT
+
+# Prometheus `le` bounds in seconds
+EXPORT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _bucket_index(micros):
+    if micros < SUB_COUNT:
+        return max(micros, 0)
+    shift = micros.bit_length() - SUB_BITS - 1
+    if shift > MAX_SHIFT:
+        return BUCKET_COUNT - 1
+    return SUB_COUNT + shift * SUB_COUNT + (micros >> shift) - SUB_COUNT
+
+
+def _bucket_bounds(index):
+    """[low, high) of a bucket in microseconds"""
+    if index < SUB_COUNT:
+        return index, index + 1
+    shift, sub = divmod(index - SUB_COUNT, SUB_COUNT)
+    top = SUB_COUNT + sub
+    return top << shift, (top + 1) << shift
+
+
+class _Owner:
+    """Lives in a thread's local storage; its collection means the thread is gone"""
+    __slots__ = ('__weakref__',)
+
+
+class _Series:
+    """One label combination: per-thread bucket arrays merged on read"""
+    __slots__ = ('label_values', '_local', '_shards', '_retired', '_lock')
+
+    def __init__(self, label_values):
+        self.label_values = label_values
+        self._local = threading.local()
+        # Arrays of live threads, by id(); finished threads are folded into _retired
+        self._shards = {}
+        self._retired = [[0] * BUCKET_COUNT, 0, 0]
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        # [counts, sum_micros, max_micros]; only the owning thread writes to it
+        shard = [[0] * BUCKET_COUNT, 0, 0]
+        owner = _Owner()
+        with self._lock:
+            self._shards[id(shard)] = shard
+        weakref.finalize(owner, self._retire, shard)
+        self._local.shard = shard
+        self._local.owner = owner
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            retired = self._retired
+            counts = retired[0]
+            for i, n in enumerate(shard[0]):
+                if n:
+                    counts[i] += n
+            retired[1] += shard[1]
+            retired[2] = max(retired[2], shard[2])
+
+    def observe(self, seconds):
+        micros = int(seconds * 1000000)
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[0][_bucket_index(micros)] += 1
+        shard[1] += micros
+        if micros > shard[2]:
+            shard[2] = micros
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        """(bucket counts, total count, sum in seconds, max in seconds) across threads"""
+        counts = [0] * BUCKET_COUNT
+        total_micros = max_micros = 0
+        # Under the lock, so a shard being retired is counted exactly once
+        with self._lock:
+            for shard_counts, shard_sum, shard_max in [self._retired, *self._shards.values()]:
+                for i, n in enumerate(shard_counts):
+                    if n:
+                        counts[i] += n
+                total_micros += shard_sum
+                max_micros = max(max_micros, shard_max)
+        return counts, sum(counts), total_micros / 1e6, max_micros / 1e6
+
+
+def quantile(counts, total, q):
+    """Value (seconds) at quantile q, as the midpoint of its bucket"""
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if n and seen >= rank:
+            low, high = _bucket_bounds(i)
+            return (low + high) / 2 / 1e6
+    return None
+
+
+class _NullSeries:
+    def observe(self, seconds):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+_NULL_SERIES = _NullSeries()
+
+
+class LatencyHistogram:
+    """A named histogram family; labels(...) returns the series to observe into"""
+    def __init__(self, name, description, labelnames=(), enabled=True):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.enabled = enabled
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        if not self.enabled:
+            return _NULL_SERIES
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(values, _Series(values))
+        return series
+
+    def observe(self, seconds, *values):
+        self.labels(*values).observe(seconds)
+
+    def series(self):
+        with self._lock:
+            return list(self._series.values())
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """Holds the histograms and renders them for Prometheus and the admin status"""
+    def __init__(self):
+        self.enabled = os.getenv('CIPHERH_METRICS', '1') != '0'
+        self.histograms = []
+
+    def histogram(self, name, description, labelnames=()):
+        histogram = LatencyHistogram(name, description, labelnames, enabled=self.enabled)
+        self.histograms.append(histogram)
+        return histogram
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for histogram in self.histograms:
+            lines.append(f'# HELP {histogram.name} {histogram.description}')
+            lines.append(f'# TYPE {histogram.name} histogram')
+            for series in histogram.series():
+                counts, total, total_seconds, _ = series.snapshot()
+                labels = [f'{k}="{_escape_label(v)}"' for k, v in zip(histogram.labelnames, series.label_values)]
+                cumulative, i = 0, 0
+                for le in EXPORT_BUCKETS:
+                    limit = le * 1e6
+                    while i < BUCKET_COUNT and _bucket_bounds(i)[1] <= limit:
+                        cumulative += counts[i]
+                        i += 1
+                    label_text = ','.join(labels + [f'le="{le}"'])
+                    lines.append(f'{histogram.name}_bucket{{{label_text}}} {cumulative}')
+                label_text = ','.join(labels + ['le="+Inf"'])
+                lines.append(f'{histogram.name}_bucket{{{label_text}}} {total}')
+                suffix = '{' + ','.join(labels) + '}' if labels else ''
+                lines.append(f'{histogram.name}_sum{suffix} {total_seconds:.6f}')
+                lines.append(f'{histogram.name}_count{suffix} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """{histogram: {'label=value,...': {count, p50_ms, p90_ms, p99_ms, max_ms}}}"""
+        result = {}
+        for histogram in self.histograms:
+            entries = {}
+            for series in histogram.series():
+                counts, total, _, max_seconds = series.snapshot()
+                key = ','.join(f'{k}={v}' for k, v in zip(histogram.labelnames, series.label_values)) or 'all'
+                # A bucket midpoint can overshoot the largest value actually seen
+                entries[key] = {
+                    'count': total,
+                    **{f'p{int(q * 100)}_ms': round(min(quantile(counts, total, q), max_seconds) * 1000, 2)
+                       if total else None for q in (0.5, 0.9, 0.99)},
+                    'max_ms': round(max_seconds * 1000, 2)
+                }
+            result[histogram.name] = entries
+        return result
+
+
+# Global registry and the hot-path histograms
+metrics = MetricsRegistry()
+request_latency = metrics.histogram(
+    'cipherh_http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route'))
+brain_latency = metrics.histogram(
+    'cipherh_brain_call_duration_seconds', 'Brain call latency, admission wait excluded', ('platform',))
+db_commit_latency = metrics.histogram(
+    'cipherh_db_commit_duration_seconds', 'SQLAlchemy session commit time, flush included')
+adapter_send_latency = metrics.histogram(
+    'cipherh_adapter_send_duration_seconds', 'Platform adapter send time by platform', ('platform', 'mode'))
+webhook_queue_lag = metrics.histogram(
+    'cipherh_webhook_queue_lag_seconds', 'Time from webhook receipt to first claim by an inbox worker', ('platform',))
+
+
+def _instrument_sessions():
+    """Time every SQLAlchemy session commit (before_commit runs before the final flush)"""
+    try:
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+    except ImportError:
+        return
+
+    @event.listens_for(Session, 'before_commit')
+    def _commit_started(session):
+        session.info['cipherh_commit_started'] = time.perf_counter()
+
+    def _commit_finished(session):
+        started = session.info.pop('cipherh_commit_started', None)
+        if started is not None:
+            db_commit_latency.labels().observe(time.perf_counter() - started)
+
+    event.listen(Session, 'after_commit', _commit_finished)
+    event.listen(Session, 'after_rollback', _commit_finished)
+
+
+if metrics.enabled:
+    _instrument_sessions()
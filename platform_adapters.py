@@ -5,10 +5,23 @@ Provides adapter classes for multi-platform integration (Facebook, TikTok, Zalo,
 Handles sending messages, formatting, and webhook processing.
 """
 
+import hashlib
+import json
 import logging
 import os
+import queue
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+
+from message_format import PLATFORM_FORMATS
+from metrics import adapter_send_latency
+from platform_transport import HTTPTransport, SMTPTransport, TransportRateLimited
 
 # Configure logging
 logging.basicConfig(
@@ -17,33 +30,306 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# Default send rates (messages/second) and bursts, per platform and per recipient
+DEFAULT_RATE_LIMITS = {
+    'facebook': {'rate_limit': 40, 'rate_burst': 80, 'recipient_rate_limit': 1, 'recipient_burst': 5},
+    'tiktok': {'rate_limit': 10, 'rate_burst': 20, 'recipient_rate_limit': 0.5, 'recipient_burst': 2},
+    'zalo': {'rate_limit': 20, 'rate_burst': 40, 'recipient_rate_limit': 1, 'recipient_burst': 3},
+    'telegram': {'rate_limit': 30, 'rate_burst': 30, 'recipient_rate_limit': 1, 'recipient_burst': 3},
+    'email': {'rate_limit': 10, 'rate_burst': 20, 'recipient_rate_limit': 0.2, 'recipient_burst': 2}
+}
+
+class TokenBucket:
+    """Thread-safe token bucket that schedules callers instead of rejecting them"""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """Take tokens now, going into debt if needed; returns seconds to wait"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            if capacity is not None:
+                self.capacity = float(capacity)
+                self.tokens = min(self.tokens, self.capacity)
+
+class RateLimiter:
+    """Per-platform and per-recipient token buckets with header-driven backoff"""
+    MAX_BACKOFF = 300.0
+    MAX_RECIPIENTS = 10000
+
+    def __init__(self, rate_limit, rate_burst, recipient_rate_limit, recipient_burst):
+        self.rate_limit = float(rate_limit)
+        self.rate_burst = float(rate_burst)
+        self.recipient_rate_limit = float(recipient_rate_limit)
+        self.recipient_burst = float(recipient_burst)
+        self.bucket = TokenBucket(self.rate_limit, self.rate_burst)
+        self.recipients = OrderedDict()
+        self.rate_factor = 1.0
+        self.backoff_until = 0.0
+        self.backoff_streak = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, rate_limit=None, rate_burst=None, recipient_rate_limit=None, recipient_burst=None):
+        with self._lock:
+            if rate_limit is not None:
+                self.rate_limit = float(rate_limit)
+            if rate_burst is not None:
+                self.rate_burst = float(rate_burst)
+            if recipient_rate_limit is not None:
+                self.recipient_rate_limit = float(recipient_rate_limit)
+            if recipient_burst is not None:
+                self.recipient_burst = float(recipient_burst)
+            self.recipients.clear()
+        self.bucket.set_rate(self.rate_limit * self.rate_factor, self.rate_burst)
+
+    def _recipient_bucket(self, recipient_id):
+        with self._lock:
+            bucket = self.recipients.get(recipient_id)
+            if bucket is None:
+                bucket = TokenBucket(self.recipient_rate_limit, self.recipient_burst)
+                self.recipients[recipient_id] = bucket
+                if len(self.recipients) > self.MAX_RECIPIENTS:
+                    self.recipients.popitem(last=False)
+            else:
+                self.recipients.move_to_end(recipient_id)
+            return bucket
+
+    def acquire(self, recipient_id):
+        """Block until a send to recipient_id is allowed; returns seconds waited"""
+        return self.acquire_many([recipient_id])
+
+    def acquire_many(self, recipient_ids):
+        """Block until one send to each of recipient_ids is allowed"""
+        wait = max(
+            self.bucket.reserve(len(recipient_ids)),
+            max((self._recipient_bucket(r).reserve() for r in recipient_ids), default=0.0),
+            self.backoff_until - time.monotonic()
+        )
+        if wait > 0:
+            with self._lock:
+                self.throttled_seconds += wait
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+    def observe(self, headers=None, status_code=None, retry_after=None):
+        """Adapt pacing to the upstream's rate-limit response"""
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        delay = retry_after if retry_after is not None else _parse_retry_after(headers)
+
+        if delay is None and str(headers.get('x-ratelimit-remaining')) == '0':
+            delay = _parse_reset(headers.get('x-ratelimit-reset'))
+
+        usage = _parse_usage(headers)
+        if delay is None and status_code == 429:
+            delay = min(self.MAX_BACKOFF, 2 ** self.backoff_streak)
+
+        with self._lock:
+            if usage is not None:
+                # Additive increase, multiplicative decrease on Graph API usage headers
+                if usage >= 80:
+                    self.rate_factor = max(0.1, self.rate_factor / 2)
+                elif usage < 50 and self.rate_factor < 1.0:
+                    self.rate_factor = min(1.0, self.rate_factor + 0.1)
+                self.bucket.set_rate(self.rate_limit * self.rate_factor)
+
+            if delay is not None:
+                self.backoff_streak += 1
+                self.backoff_until = max(self.backoff_until, time.monotonic() + min(delay, self.MAX_BACKOFF))
+            elif status_code is None or status_code < 400:
+                self.backoff_streak = 0
+        if delay is not None:
+            logging.warning(f'CipherH: Upstream rate limit hit, backing off {delay:.1f}s')
+
+    def get_status(self):
+        return {
+            'rate_limit': self.rate_limit,
+            'rate_burst': self.rate_burst,
+            'recipient_rate_limit': self.recipient_rate_limit,
+            'recipient_burst': self.recipient_burst,
+            'rate_factor': self.rate_factor,
+            'backoff_remaining': max(0.0, self.backoff_until - time.monotonic()),
+            'throttled_seconds': round(self.throttled_seconds, 3)
+        }
+
+def _parse_retry_after(headers):
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+def _parse_reset(value):
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    # Some platforms send an epoch timestamp, others a delta in seconds
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+def _parse_usage(headers):
+    usages = []
+    for key in ('x-app-usage', 'x-business-use-case-usage'):
+        raw = headers.get(key)
+        if not raw:
+            continue
+        try:
+            parsed = json.loads(raw) if isinstance(raw, str) else raw
+        except ValueError:
+            continue
+        if not isinstance(parsed, dict):
+            continue
+        entries = [parsed] if key == 'x-app-usage' else [e for v in parsed.values() if isinstance(v, list) for e in v]
+        for entry in entries:
+            if isinstance(entry, dict):
+                usages.extend(v for v in (entry.get(k) for k in ('call_count', 'total_time', 'total_cputime'))
+                              if isinstance(v, (int, float)))
+    return max(usages) if usages else None
+
 class PlatformAdapter(ABC):
     """Base class for platform adapters"""
+    MAX_RATE_LIMIT_RETRIES = 3
+    BATCH_SIZE = 1
+
     def __init__(self, platform_name):
         self.platform_name = platform_name
         self.active = False
         self.last_sync = None
+        self.transport = None
+        self.rate_limiter = RateLimiter(**DEFAULT_RATE_LIMITS[platform_name])
+        self.message_format = PLATFORM_FORMATS[platform_name]
+        # format_message(message, context=None) returns one string within the platform's limits,
+        # truncated if it is too long; format_parts() returns the parts to send, in order.
+        # Taken straight from the spec, so a short reply costs one call like the old slicing did.
+        self.format_message = self.message_format.format_one
+        self.format_parts = self.message_format.format
 
     @abstractmethod
     def send_message(self, recipient_id, message):
         pass
 
-    @abstractmethod
-    def format_message(self, message, context=None):
-        pass
-
     @abstractmethod
     def handle_webhook(self, data):
         pass
 
+    def build_request(self, recipient_id, message):
+        """Return (method, url, headers, body) for the platform's send API"""
+        raise NotImplementedError(f'{self.platform_name} has no HTTP send API')
+
+    def build_batch_request(self, recipient_ids, message):
+        """Return (method, url, headers, body) for one request sending to all recipient_ids,
+        or None if the platform has no batch API"""
+        return None
+
+    def parse_batch_response(self, recipient_ids, response):
+        """Per-recipient results from the response to build_batch_request"""
+        raise NotImplementedError(f'{self.platform_name} has no batch send API')
+
+    def conversation_key(self, data):
+        """Key that groups webhook events belonging to the same conversation"""
+        return data.get('sender', {}).get('id') or data.get('user_id')
+
+    def handle_webhooks(self, batch):
+        """Handle a burst of webhook payloads as one unit per conversation"""
+        conversations = OrderedDict()
+        for data in batch:
+            conversations.setdefault(self.conversation_key(data), []).append(data)
+        logging.info(f'CipherH: Received {len(batch)} {self.platform_name} webhooks '
+                     f'across {len(conversations)} conversations')
+        # Each event still goes through handle_webhook, so adapter overrides apply
+        return [
+            {'platform': self.platform_name, 'conversation': key, 'processed': True,
+             'events': len(events), 'results': [self.handle_webhook(data) for data in events]}
+            for key, events in conversations.items()
+        ]
+
+    def event_id(self, data):
+        """Stable id of a webhook event, used to drop upstream retries"""
+        canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def deliver(self, recipient_id, message):
+        """Hand a formatted message to the adapter's transport, paced by the rate limiter"""
+        if self.transport is None:
+            return {'status': 'prepared', 'platform': self.platform_name}
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.acquire(recipient_id)
+            try:
+                with adapter_send_latency.labels(self.platform_name, 'single').time():
+                    result = self.transport.send(self.platform_name, recipient_id, message)
+            except TransportRateLimited as e:
+                self.rate_limiter.observe(e.headers, 429, e.retry_after)
+                if attempt == self.MAX_RATE_LIMIT_RETRIES:
+                    raise
+                continue
+            if isinstance(result, dict):
+                self.rate_limiter.observe(result.get('headers'), result.get('status_code'))
+            return result
+
+    def send_batch(self, recipient_ids, message):
+        """Send one formatted message to a chunk of recipients; returns per-recipient results"""
+        if self.transport is None or not hasattr(self.transport, 'send_batch'):
+            results = []
+            for recipient_id in recipient_ids:
+                try:
+                    results.append({'recipient_id': recipient_id, **self.deliver(recipient_id, message)})
+                except Exception as e:
+                    results.append({'recipient_id': recipient_id, 'status': 'failed', 'error': str(e)})
+            return results
+
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.acquire_many(recipient_ids)
+            try:
+                with adapter_send_latency.labels(self.platform_name, 'batch').time():
+                    results = self.transport.send_batch(self.platform_name, recipient_ids, message)
+            except TransportRateLimited as e:
+                self.rate_limiter.observe(e.headers, 429, e.retry_after)
+                if attempt == self.MAX_RATE_LIMIT_RETRIES:
+                    raise
+                continue
+            for result in results:
+                self.rate_limiter.observe(result.get('headers'), result.get('status_code'))
+            return results
+
     def get_status(self):
         return {
             'platform': self.platform_name,
             'active': self.active,
-            'last_sync': self.last_sync
+            'last_sync': self.last_sync,
+            'rate_limit': self.rate_limiter.get_status(),
+            'transport': self.transport.get_stats() if hasattr(self.transport, 'get_stats') else None
         }
 
 class FacebookAdapter(PlatformAdapter):
+    # Graph API batch requests accept up to 50 operations
+    BATCH_SIZE = 50
+
     def __init__(self):
         super().__init__('facebook')
         self.access_token = os.getenv('FACEBOOK_ACCESS_TOKEN')
@@ -51,13 +337,59 @@ class FacebookAdapter(PlatformAdapter):
 
     def send_message(self, recipient_id, message):
         logging.info(f'CipherH: Sending Facebook message to {recipient_id}')
-        return {'status': 'prepared', 'platform': 'facebook'}
-
-    def format_message(self, message, context=None):
-        formatted = message
-        if len(message) > 2000:
-            formatted = message[:1997] + '...'
-        return formatted
+        return self.deliver(recipient_id, message)
+
+    def build_request(self, recipient_id, message):
+        url = f'https://graph.facebook.com/v18.0/{self.page_id or "me"}/messages?access_token={self.access_token}'
+        body = {'recipient': {'id': recipient_id}, 'messaging_type': 'RESPONSE', 'message': {'text': message}}
+        return 'POST', url, {}, body
+
+    def build_batch_request(self, recipient_ids, message):
+        # Graph API batch: one POST whose `batch` field holds a Send API call per recipient
+        operations = [{
+            'method': 'POST',
+            'relative_url': f'v18.0/{self.page_id or "me"}/messages',
+            'body': urlencode({
+                'recipient': json.dumps({'id': recipient_id}),
+                'messaging_type': 'RESPONSE',
+                'message': json.dumps({'text': message}, ensure_ascii=False)
+            })
+        } for recipient_id in recipient_ids]
+        body = urlencode({'access_token': self.access_token or '', 'include_headers': 'false',
+                          'batch': json.dumps(operations, ensure_ascii=False)})
+        return 'POST', 'https://graph.facebook.com/', {'Content-Type': 'application/x-www-form-urlencoded'}, body
+
+    def parse_batch_response(self, recipient_ids, response):
+        try:
+            items = json.loads(response['body'])
+        except ValueError:
+            items = None
+        if not isinstance(items, list) or len(items) != len(recipient_ids):
+            raise ConnectionError(f'Unexpected Graph API batch response: {response["body"][:200]}')
+        results = []
+        for recipient_id, item in zip(recipient_ids, items):
+            # A null item means Graph timed out that operation; it may or may not have been sent
+            code = item.get('code') if item else None
+            result = {'platform': 'facebook', 'recipient_id': recipient_id, 'status_code': code}
+            if code == 200:
+                results.append({**result, 'status': 'sent', 'body': item.get('body')})
+            else:
+                error = item.get('body') if item else 'No response for this operation'
+                results.append({**result, 'status': 'failed', 'error': str(error)[:200]})
+        return results
+
+    def event_id(self, data):
+        mids = [
+            event.get('message', {}).get('mid') or f"{event.get('sender', {}).get('id')}:{event.get('timestamp')}"
+            for entry in data.get('entry', []) for event in entry.get('messaging', [])
+        ]
+        return 'fb:' + ','.join(mids) if mids else super().event_id(data)
+
+    def conversation_key(self, data):
+        for entry in data.get('entry', []):
+            for event in entry.get('messaging', []):
+                return event.get('sender', {}).get('id')
+        return None
 
     def handle_webhook(self, data):
         logging.info('CipherH: Received Facebook webhook')
@@ -70,12 +402,7 @@ class TikTokAdapter(PlatformAdapter):
 
     def send_message(self, recipient_id, message):
         logging.info(f'CipherH: Sending TikTok message to {recipient_id}')
-        return {'status': 'prepared', 'platform': 'tiktok'}
-
-    def format_message(self, message, context=None):
-        if len(message) > 500:
-            message = message[:497] + '...'
-        return message
+        return self.deliver(recipient_id, message)
 
     def handle_webhook(self, data):
         logging.info('CipherH: Received TikTok webhook')
@@ -86,57 +413,177 @@ class ZaloAdapter(PlatformAdapter):
         super().__init__('zalo')
         self.app_id = os.getenv('ZALO_APP_ID')
         self.app_secret = os.getenv('ZALO_APP_SECRET')
+        self.access_token = os.getenv('ZALO_ACCESS_TOKEN')
 
     def send_message(self, recipient_id, message):
         logging.info(f'CipherH: Sending Zalo message to {recipient_id}')
-        return {'status': 'prepared', 'platform': 'zalo'}
+        return self.deliver(recipient_id, message)
 
-    def format_message(self, message, context=None):
-        formatted = message
-        if len(message) > 1000:
-            formatted = message[:997] + '...'
-        return formatted
+    def build_request(self, recipient_id, message):
+        if not self.access_token:
+            raise ValueError('ZALO_ACCESS_TOKEN is not set')
+        body = {'recipient': {'user_id': recipient_id}, 'message': {'text': message}}
+        return 'POST', 'https://openapi.zalo.me/v3.0/oa/message/cs', {'access_token': self.access_token}, body
+
+    def event_id(self, data):
+        msg_id = data.get('message', {}).get('msg_id')
+        return f'zalo:{msg_id}' if msg_id else super().event_id(data)
+
+    def conversation_key(self, data):
+        return data.get('sender', {}).get('id') or data.get('user_id_by_app')
 
     def handle_webhook(self, data):
         logging.info('CipherH: Received Zalo webhook')
         return {'platform': 'zalo', 'processed': True, 'data': data}
 
 class TelegramAdapter(PlatformAdapter):
+    # Bot API allows ~30 messages/second across chats
+    BATCH_SIZE = 30
+
     def __init__(self):
         super().__init__('telegram')
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
 
     def send_message(self, recipient_id, message):
         logging.info(f'CipherH: Sending Telegram message to {recipient_id}')
-        return {'status': 'prepared', 'platform': 'telegram'}
+        return self.deliver(recipient_id, message)
+
+    def build_request(self, recipient_id, message):
+        url = f'https://api.telegram.org/bot{self.bot_token}/sendMessage'
+        body = {'chat_id': recipient_id, 'text': message}
+        if self.message_format.parse_mode:
+            body['parse_mode'] = self.message_format.parse_mode
+        return 'POST', url, {}, body
+
+    def event_id(self, data):
+        update_id = data.get('update_id')
+        return f'tg:{update_id}' if update_id is not None else super().event_id(data)
 
-    def format_message(self, message, context=None):
-        formatted = message
-        if len(message) > 4096:
-            formatted = message[:4093] + '...'
-        return formatted
+    def conversation_key(self, data):
+        update = data.get('message') or data.get('edited_message') or data.get('callback_query', {}).get('message') or {}
+        return update.get('chat', {}).get('id')
 
     def handle_webhook(self, data):
         logging.info('CipherH: Received Telegram webhook')
         return {'platform': 'telegram', 'processed': True, 'data': data}
 
 class EmailAdapter(PlatformAdapter):
+    # Recipients sent over one SMTP connection before it is recycled
+    BATCH_SIZE = 100
+
     def __init__(self):
         super().__init__('email')
         self.smtp_config = None
+        if os.getenv('SMTP_HOST'):
+            self.smtp_config = {
+                'host': os.getenv('SMTP_HOST'),
+                'port': int(os.getenv('SMTP_PORT', '587')),
+                'username': os.getenv('SMTP_USERNAME'),
+                'password': os.getenv('SMTP_PASSWORD'),
+                'sender': os.getenv('SMTP_SENDER'),
+                'use_tls': os.getenv('SMTP_USE_TLS', '1') == '1'
+            }
 
     def send_message(self, recipient_id, message):
         logging.info(f'CipherH: Sending email to {recipient_id}')
-        return {'status': 'prepared', 'platform': 'email'}
-
-    def format_message(self, message, context=None):
-        formatted = f"""Xin chào,\n\n{message}\n\nBest regards,\nTrần Văn Khải (CipherH)\n\n---\nTin nhắn này được gửi tự động từ hệ thống CipherH AGI."""
-        return formatted
+        return self.deliver(recipient_id, message)
 
     def handle_webhook(self, data):
         logging.info('CipherH: Received email webhook')
         return {'platform': 'email', 'processed': True, 'data': data}
 
+class DeliveryQueueFull(Exception):
+    """Raised when a platform's outbound queue cannot accept more messages"""
+
+class DeliveryQueue:
+    """Bounded outbound queue with a worker pool per platform"""
+    def __init__(self, manager, maxsize=1000, workers_per_platform=4, history_size=10000):
+        self.manager = manager
+        self.maxsize = maxsize
+        self.workers_per_platform = workers_per_platform
+        self.history_size = history_size
+        self._queues = {}
+        self._workers = {}
+        self._deliveries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_queue(self, platform):
+        with self._lock:
+            if platform not in self._queues:
+                self._queues[platform] = queue.Queue(maxsize=self.maxsize)
+                self._workers[platform] = []
+                for n in range(self.workers_per_platform):
+                    worker = threading.Thread(
+                        target=self._worker_loop, args=(platform,),
+                        name=f'cipherh-delivery-{platform}-{n}', daemon=True
+                    )
+                    worker.start()
+                    self._workers[platform].append(worker)
+                logging.info(f'CipherH: Started {self.workers_per_platform} delivery workers for {platform}')
+            return self._queues[platform]
+
+    def _update(self, delivery_id, **fields):
+        with self._lock:
+            record = self._deliveries.get(delivery_id)
+            if record:
+                record.update(fields)
+
+    def enqueue(self, platform, recipient_id, message, context=None):
+        delivery_id = uuid.uuid4().hex
+        record = {
+            'delivery_id': delivery_id,
+            'platform': platform,
+            'recipient_id': recipient_id,
+            'status': 'queued',
+            'queued_at': datetime.utcnow().isoformat(),
+            'completed_at': None,
+            'result': None,
+            'error': None
+        }
+        outbound = self._get_queue(platform)
+        with self._lock:
+            self._deliveries[delivery_id] = record
+            while len(self._deliveries) > self.history_size:
+                self._deliveries.popitem(last=False)
+        try:
+            outbound.put_nowait((delivery_id, recipient_id, message, context))
+        except queue.Full:
+            self._update(delivery_id, status='rejected', error='queue full')
+            raise DeliveryQueueFull(f'Outbound queue for {platform} is full')
+        return delivery_id
+
+    def _worker_loop(self, platform):
+        outbound = self._queues[platform]
+        while True:
+            delivery_id, recipient_id, message, context = outbound.get()
+            self._update(delivery_id, status='sending')
+            try:
+                result = self.manager.send_message(platform, recipient_id, message, context)
+                if result is None:
+                    self._update(delivery_id, status='failed', error='send returned no result',
+                                 completed_at=datetime.utcnow().isoformat())
+                else:
+                    self._update(delivery_id, status='sent', result=result,
+                                 completed_at=datetime.utcnow().isoformat())
+            except Exception as e:
+                logging.error(f'CipherH: Delivery {delivery_id} via {platform} failed: {e}')
+                self._update(delivery_id, status='failed', error=str(e),
+                             completed_at=datetime.utcnow().isoformat())
+            finally:
+                outbound.task_done()
+
+    def get_status(self, delivery_id):
+        with self._lock:
+            record = self._deliveries.get(delivery_id)
+            return dict(record) if record else None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                platform: {'queued': q.qsize(), 'workers': len(self._workers[platform])}
+                for platform, q in self._queues.items()
+            }
+
 class PlatformManager:
     def __init__(self):
         self.adapters = {
@@ -146,20 +593,136 @@ class PlatformManager:
             'telegram': TelegramAdapter(),
             'email': EmailAdapter()
         }
+        self._reaper = None
+        self.delivery_queue = DeliveryQueue(
+            self,
+            maxsize=int(os.getenv('CIPHERH_DELIVERY_QUEUE_SIZE', '1000')),
+            workers_per_platform=int(os.getenv('CIPHERH_DELIVERY_WORKERS', '4'))
+        )
+        if os.getenv('CIPHERH_LIVE_TRANSPORT') == '1':
+            self.enable_live_transport()
         logging.info('CipherH: Platform manager initialized with all adapters')
 
     def get_adapter(self, platform_name):
         return self.adapters.get(platform_name)
 
+    def set_transport(self, transport, platform_name=None):
+        """Route sends through transport, for one platform or all of them"""
+        targets = [platform_name] if platform_name else list(self.adapters)
+        for name in targets:
+            adapter = self.get_adapter(name)
+            if adapter:
+                adapter.transport = transport
+
+    def build_request(self, platform, recipient_id, message):
+        return self.get_adapter(platform).build_request(recipient_id, message)
+
+    def build_batch_request(self, platform, recipient_ids, message):
+        return self.get_adapter(platform).build_batch_request(recipient_ids, message)
+
+    def parse_batch_response(self, platform, recipient_ids, response):
+        return self.get_adapter(platform).parse_batch_response(recipient_ids, response)
+
+    def enable_live_transport(self, http_pool_size=None, smtp_pool_size=None, idle_timeout=None):
+        """Send through pooled keep-alive HTTP connections and a pooled SMTP client"""
+        idle_timeout = idle_timeout or float(os.getenv('CIPHERH_POOL_IDLE_TIMEOUT', '60'))
+        http_transport = HTTPTransport(
+            self.build_request,
+            pool_size=http_pool_size or int(os.getenv('CIPHERH_HTTP_POOL_SIZE', '10')),
+            idle_timeout=idle_timeout,
+            batch_builder=self.build_batch_request,
+            batch_parser=self.parse_batch_response
+        )
+        for name in ('facebook', 'zalo', 'telegram'):
+            self.set_transport(http_transport, name)
+
+        smtp_config = self.adapters['email'].smtp_config
+        if smtp_config:
+            self.set_transport(SMTPTransport(
+                pool_size=smtp_pool_size or int(os.getenv('CIPHERH_SMTP_POOL_SIZE', '4')),
+                idle_timeout=idle_timeout,
+                **smtp_config
+            ), 'email')
+        self._start_idle_reaper(idle_timeout / 2)
+        logging.info('CipherH: Live transport enabled with pooled connections')
+
+    def _start_idle_reaper(self, interval):
+        """Close pooled connections past their idle timeout even when no send comes to evict them"""
+        if self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                transports = {id(a.transport): a.transport for a in self.adapters.values()
+                              if hasattr(a.transport, 'evict_idle')}
+                for transport in transports.values():
+                    try:
+                        transport.evict_idle()
+                    except Exception as e:
+                        logging.error(f'CipherH: Idle connection eviction failed: {e}')
+
+        self._reaper = threading.Thread(target=reap, name='cipherh-pool-reaper', daemon=True)
+        self._reaper.start()
+
+    def enqueue_message(self, platform, recipient_id, message, context=None):
+        """Queue a message for background delivery and return its delivery id"""
+        if not self.get_adapter(platform):
+            logging.error(f'CipherH: No adapter found for platform {platform}')
+            return None
+        return self.delivery_queue.enqueue(platform, recipient_id, message, context)
+
+    def get_delivery_status(self, delivery_id):
+        return self.delivery_queue.get_status(delivery_id)
+
     def send_message(self, platform, recipient_id, message, context=None):
         adapter = self.get_adapter(platform)
         if not adapter:
             logging.error(f'CipherH: No adapter found for platform {platform}')
             return None
-        formatted_message = adapter.format_message(message, context)
-        result = adapter.send_message(recipient_id, formatted_message)
-        logging.info(f'CipherH: Message sent via {platform}')
-        return result
+        parts = adapter.format_parts(message, context)
+        results = [adapter.send_message(recipient_id, part) for part in parts]
+        logging.info(f'CipherH: Message sent via {platform}' + (f' in {len(parts)} parts' if len(parts) > 1 else ''))
+        if len(results) == 1:
+            return results[0]
+        return {**results[-1], 'parts': results}
+
+    def send_many(self, platform, recipients, message, context=None):
+        """Format once and fan a message out to many recipients in platform-sized chunks.
+        results line up with recipients by position; a repeated recipient is sent to once per entry."""
+        adapter = self.get_adapter(platform)
+        if not adapter:
+            logging.error(f'CipherH: No adapter found for platform {platform}')
+            return None
+        parts = adapter.format_parts(message, context)
+        results = []
+        for start in range(0, len(recipients), adapter.BATCH_SIZE):
+            chunk = recipients[start:start + adapter.BATCH_SIZE]
+            # Parts go out in order; a recipient whose part failed gets no further parts.
+            # Results are tracked by position so duplicates keep one result each, in input order.
+            final, pending = [None] * len(chunk), list(range(len(chunk)))
+            for part in parts:
+                recipients_pending = [chunk[i] for i in pending]
+                try:
+                    part_results = adapter.send_batch(recipients_pending, part)
+                except Exception as e:
+                    logging.error(f'CipherH: Batch send via {platform} failed: {e}')
+                    part_results = [{'recipient_id': r, 'status': 'failed', 'error': str(e)} for r in recipients_pending]
+                for i, result in zip(pending, part_results):
+                    final[i] = result
+                pending = [i for i, result in zip(pending, part_results) if result.get('status') != 'failed']
+                if not pending:
+                    break
+            results.extend(final)
+        failed = sum(1 for r in results if r.get('status') == 'failed')
+        logging.info(f'CipherH: Bulk message sent via {platform} to {len(results) - failed}/{len(results)} recipients')
+        return {
+            'platform': platform,
+            'total': len(results),
+            'sent': len(results) - failed,
+            'failed': failed,
+            'results': results
+        }
 
     def handle_webhook(self, platform, data):
         adapter = self.get_adapter(platform)
@@ -168,12 +731,47 @@ class PlatformManager:
             return None
         return adapter.handle_webhook(data)
 
+    def handle_webhooks(self, platform, batch):
+        adapter = self.get_adapter(platform)
+        if not adapter:
+            logging.error(f'CipherH: No adapter found for webhook from {platform}')
+            return None
+        return adapter.handle_webhooks(batch)
+
     def get_all_statuses(self):
         return {platform: adapter.get_status() for platform, adapter in self.adapters.items()}
 
+    def configure_rate_limits(self, platform_name, config):
+        """Apply rate_limit/rate_burst/recipient_* settings from a config dict"""
+        adapter = self.get_adapter(platform_name)
+        if not adapter or not config:
+            return False
+        adapter.rate_limiter.configure(
+            rate_limit=config.get('rate_limit'),
+            rate_burst=config.get('rate_burst'),
+            recipient_rate_limit=config.get('recipient_rate_limit'),
+            recipient_burst=config.get('recipient_burst')
+        )
+        logging.info(f'CipherH: Updated {platform_name} rate limits')
+        return True
+
+    def apply_config(self, config):
+        """Apply a PlatformConfig row: its rate limit columns (defaults where unset) and its active flag"""
+        platform_name = config.platform_name
+        if not self.get_adapter(platform_name):
+            return False
+        limits = {key: getattr(config, key, None) for key in DEFAULT_RATE_LIMITS[platform_name]}
+        limits = {key: DEFAULT_RATE_LIMITS[platform_name][key] if value is None else value
+                  for key, value in limits.items()}
+        if config.active:
+            return self.activate_platform(platform_name, limits)
+        self.configure_rate_limits(platform_name, limits)
+        return self.deactivate_platform(platform_name)
+
     def activate_platform(self, platform_name, config=None):
         adapter = self.get_adapter(platform_name)
         if adapter:
+            self.configure_rate_limits(platform_name, config)
             adapter.active = True
             adapter.last_sync = datetime.now()
             logging.info(f'CipherH: Activated {platform_name} platform')
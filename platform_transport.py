@@ -0,0 +1,415 @@
+"""
+CipherH Platform Transport
+
+Provides the transport layer that platform adapters use to deliver messages.
+HTTPTransport and SMTPTransport keep pooled keep-alive connections per host;
+FakeTransport records deliveries locally so adapters can run without a network.
+"""
+
+import http.client
+import json
+import logging
+import select
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from email.message import EmailMessage
+from urllib.parse import urlsplit
+
+
+class TransportRateLimited(Exception):
+    """Raised by a transport when the upstream answers 429 Too Many Requests"""
+    def __init__(self, message, retry_after=None, headers=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+
+class FakeTransport:
+    """Local transport that records deliveries instead of calling platform APIs"""
+    def __init__(self, delay=0.0, fail_recipients=None, headers=None, rate_limited=0):
+        self.delay = delay
+        self.fail_recipients = set(fail_recipients or ())
+        self.headers = headers or {}
+        self.rate_limited = rate_limited
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, platform, recipient_id, payload):
+        if self.delay:
+            time.sleep(self.delay)
+        return self._record(platform, recipient_id, payload)
+
+    def send_batch(self, platform, recipient_ids, payload):
+        """Deliver to several recipients in one simulated round trip"""
+        if self.delay:
+            time.sleep(self.delay)
+        results = []
+        for recipient_id in recipient_ids:
+            try:
+                results.append(self._record(platform, recipient_id, payload))
+            except ConnectionError as e:
+                results.append({'status': 'failed', 'platform': platform,
+                                'recipient_id': recipient_id, 'error': str(e)})
+        return results
+
+    def _record(self, platform, recipient_id, payload):
+        if recipient_id in self.fail_recipients:
+            raise ConnectionError(f'Fake delivery to {recipient_id} on {platform} failed')
+        with self._lock:
+            if self.rate_limited > 0:
+                self.rate_limited -= 1
+                raise TransportRateLimited(f'Fake {platform} rate limit', headers=self.headers)
+            self.sent.append({
+                'platform': platform,
+                'recipient_id': recipient_id,
+                'payload': payload,
+                'sent_at': datetime.utcnow().isoformat()
+            })
+        logging.debug(f'CipherH: Fake transport delivered {platform} message to {recipient_id}')
+        return {
+            'status': 'sent',
+            'platform': platform,
+            'recipient_id': recipient_id,
+            'status_code': 200,
+            'headers': dict(self.headers)
+        }
+
+    def reset(self):
+        with self._lock:
+            self.sent = []
+
+
+class ConnectionPool:
+    """Thread-safe pool of reusable connections with idle eviction and health checks"""
+    def __init__(self, factory, max_size=10, idle_timeout=60.0, health_check=None,
+                 close=None, acquire_timeout=30.0, health_check_after=0.0):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        # Only connections idle longer than this are probed before reuse
+        self.health_check_after = health_check_after
+        self.close_fn = close or (lambda conn: conn.close())
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'unhealthy': 0}
+
+    def _close(self, conn):
+        try:
+            self.close_fn(conn)
+        except Exception as e:
+            logging.debug(f'CipherH: Error closing pooled connection: {e}')
+
+    def _evict_idle(self, now):
+        """Drop connections idle past idle_timeout; caller holds the lock"""
+        expired = [(conn, t) for conn, t in self._idle if now - t > self.idle_timeout]
+        if expired:
+            self._idle = [(conn, t) for conn, t in self._idle if now - t <= self.idle_timeout]
+            self.stats['evicted'] += len(expired)
+        return [conn for conn, _ in expired]
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                stale = self._evict_idle(time.monotonic())
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._in_use += 1
+                    reused = True
+                    break
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    conn, idle_since, reused = None, None, False
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Timed out waiting for a pooled connection')
+                self._cond.wait(remaining)
+        for old in stale:
+            self._close(old)
+
+        if (reused and self.health_check and time.monotonic() - idle_since > self.health_check_after
+                and not self.health_check(conn)):
+            with self._cond:
+                self.stats['unhealthy'] += 1
+            self._close(conn)
+            reused = False
+        if not reused:
+            try:
+                conn = self.factory()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.stats['created'] += 1
+        else:
+            with self._cond:
+                self.stats['reused'] += 1
+        return conn
+
+    def release(self, conn, reusable=True):
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not reusable:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, reusable=False)
+            raise
+        self.release(conn)
+
+    def evict_idle(self):
+        with self._cond:
+            stale = self._evict_idle(time.monotonic())
+        for conn in stale:
+            self._close(conn)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def get_stats(self):
+        with self._cond:
+            return {**self.stats, 'in_use': self._in_use, 'idle': len(self._idle), 'max_size': self.max_size}
+
+
+class HTTPTransport:
+    """Sends platform API requests over keep-alive HTTPS connections pooled per host"""
+    # Safe to resend when a reused connection drops mid-request; a POST may already have been applied
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+    def __init__(self, request_builder, pool_size=10, idle_timeout=60.0, timeout=10.0,
+                 batch_builder=None, batch_parser=None):
+        self.request_builder = request_builder
+        self.batch_builder = batch_builder
+        self.batch_parser = batch_parser
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._ssl_context = ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, scheme, host):
+        key = (scheme, host)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                if scheme == 'https':
+                    factory = lambda: http.client.HTTPSConnection(host, timeout=self.timeout, context=self._ssl_context)
+                else:
+                    factory = lambda: http.client.HTTPConnection(host, timeout=self.timeout)
+                pool = ConnectionPool(factory, max_size=self.pool_size, idle_timeout=self.idle_timeout,
+                                      health_check=self._is_healthy)
+                self._pools[key] = pool
+            return pool
+
+    @staticmethod
+    def _is_healthy(conn):
+        """An idle keep-alive socket that is readable was closed (or poisoned) by the server"""
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+        pool = self._pool(parts.scheme, parts.netloc)
+
+        # Connections the server closed while idle are caught by the pool's health check before
+        # anything is sent. A drop after that is retried once on a fresh connection, for idempotent
+        # methods only: the server may have acted on a POST before closing.
+        for attempt in range(2):
+            conn = pool.acquire()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                pool.release(conn, reusable=False)
+                if attempt or method not in self.IDEMPOTENT_METHODS:
+                    raise
+                continue
+            except Exception:
+                pool.release(conn, reusable=False)
+                raise
+            pool.release(conn, reusable=not response.will_close)
+            return {
+                'status_code': response.status,
+                'headers': dict(response.getheaders()),
+                'body': data.decode('utf-8', errors='replace')
+            }
+
+    def send(self, platform, recipient_id, payload):
+        method, url, headers, body = self.request_builder(platform, recipient_id, payload)
+        response = self.request(method, url, body=body, headers=headers)
+        if response['status_code'] == 429:
+            raise TransportRateLimited(f'{platform} rate limit reached', headers=response['headers'])
+        if response['status_code'] >= 400:
+            raise ConnectionError(f'{platform} send failed with HTTP {response["status_code"]}: {response["body"][:200]}')
+        return {'status': 'sent', 'platform': platform, 'recipient_id': recipient_id, **response}
+
+    def send_batch(self, platform, recipient_ids, payload):
+        """One batch API request for platforms that have one, else one request per recipient"""
+        built = self.batch_builder(platform, recipient_ids, payload) if self.batch_builder else None
+        if built is None:
+            return self._send_each(platform, recipient_ids, payload)
+        method, url, headers, body = built
+        response = self.request(method, url, body=body, headers=headers)
+        if response['status_code'] == 429:
+            raise TransportRateLimited(f'{platform} rate limit reached', headers=response['headers'])
+        if response['status_code'] >= 400:
+            raise ConnectionError(f'{platform} batch failed with HTTP {response["status_code"]}: {response["body"][:200]}')
+        return self.batch_parser(platform, recipient_ids, response)
+
+    def _send_each(self, platform, recipient_ids, payload):
+        results = []
+        for i, recipient_id in enumerate(recipient_ids):
+            try:
+                results.append(self.send(platform, recipient_id, payload))
+            except TransportRateLimited as e:
+                # Retrying the whole chunk would resend to recipients already served
+                results.extend({'status': 'failed', 'platform': platform, 'recipient_id': r,
+                                'status_code': 429, 'headers': e.headers, 'error': str(e)}
+                               for r in recipient_ids[i:])
+                break
+            except (ConnectionError, OSError) as e:
+                results.append({'status': 'failed', 'platform': platform,
+                                'recipient_id': recipient_id, 'error': str(e)})
+        return results
+
+    def evict_idle(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.evict_idle()
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close_all()
+
+    def get_stats(self):
+        with self._lock:
+            return {f'{scheme}://{host}': pool.get_stats() for (scheme, host), pool in self._pools.items()}
+
+
+class SMTPTransport:
+    """Sends email over pooled, authenticated SMTP connections"""
+    def __init__(self, host, port=587, username=None, password=None, sender=None,
+                 use_tls=True, subject='CipherH', pool_size=4, idle_timeout=60.0, timeout=10.0,
+                 health_check_after=5.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender or username
+        self.use_tls = use_tls
+        self.subject = subject
+        self.timeout = timeout
+        self.pool = ConnectionPool(
+            self._connect, max_size=pool_size, idle_timeout=idle_timeout,
+            health_check=self._is_healthy, close=self._quit,
+            # A NOOP costs a round trip; a connection used moments ago is assumed alive
+            health_check_after=health_check_after
+        )
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            conn.starttls(context=ssl.create_default_context())
+        if self.username:
+            conn.login(self.username, self.password)
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            return conn.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _quit(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def _message(self, recipient_id, payload):
+        msg = EmailMessage()
+        msg['From'] = self.sender
+        msg['To'] = recipient_id
+        msg['Subject'] = self.subject
+        msg.set_content(payload)
+        return msg
+
+    def send(self, platform, recipient_id, payload):
+        with self.pool.connection() as conn:
+            conn.send_message(self._message(recipient_id, payload))
+        return {'status': 'sent', 'platform': platform, 'recipient_id': recipient_id}
+
+    def send_batch(self, platform, recipient_ids, payload):
+        """Send to every recipient over a single pooled connection"""
+        results = []
+        conn = self.pool.acquire()
+        try:
+            for i, recipient_id in enumerate(recipient_ids):
+                try:
+                    conn.send_message(self._message(recipient_id, payload))
+                    results.append({'status': 'sent', 'platform': platform, 'recipient_id': recipient_id})
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                    # The server refused this message; the connection is still usable
+                    results.append({'status': 'failed', 'platform': platform,
+                                    'recipient_id': recipient_id, 'error': str(e)})
+                except (smtplib.SMTPException, OSError) as e:
+                    # The connection broke: recipients already accepted keep their 'sent' result
+                    # so a retry does not mail them twice; the rest fail
+                    results.extend({'status': 'failed', 'platform': platform, 'recipient_id': r,
+                                    'error': str(e)} for r in recipient_ids[i:])
+                    self.pool.release(conn, reusable=False)
+                    return results
+        except BaseException:
+            self.pool.release(conn, reusable=False)
+            raise
+        self.pool.release(conn)
+        return results
+
+    def evict_idle(self):
+        self.pool.evict_idle()
+
+    def close(self):
+        self.pool.close_all()
+
+    def get_stats(self):
+        return {f'smtp://{self.host}:{self.port}': self.pool.get_stats()}
@@ -0,0 +1,281 @@
+"""
+CipherH Request Profiler
+
+Opt-in sampling profiler for production requests. Set
+CIPHERH_PROFILER=1 to profile a fraction of requests
+(CIPHERH_PROFILE_RATE, default 0.01). A request can also force a
+profile with an X-CipherH-Profile header whose value matches
+CIPHERH_PROFILE_TOKEN; without a configured token the header is ignored.
+
+While a request is profiled, a sampler thread reads its thread's stack
+every CIPHERH_PROFILE_INTERVAL_MS milliseconds (default 5). The wall
+time between samples is charged to the stack that was running. On the
+ASGI hot path, the blocking calls run on bridge threads and are sampled
+there. The rest of the request, time spent awaiting the brain or the
+network on the event loop, is charged to a single '[awaiting]' frame.
+
+Each profile is written as flamegraph-ready collapsed stacks
+("root;frame;frame <microseconds>"), with a JSON sidecar for its
+metadata. Files go to a ring directory (CIPHERH_PROFILE_DIR) that keeps
+only the newest CIPHERH_PROFILE_KEEP profiles. The admin panel lists
+and serves them.
+
+When CIPHERH_PROFILER is unset, no request hook is registered and no
+sampler thread runs.
+"""
+
+import contextvars
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+PROFILE_HEADER = 'X-CipherH-Profile'
+PROFILE_ID_RE = re.compile(r'^[0-9T]+-\d+-\d+$')
+MAX_STACKS = 2000
+MAX_DEPTH = 128
+
+# The profile of the request running in this context (ASGI hot path)
+current_profile = contextvars.ContextVar('cipherh_profile', default=None)
+
+
+class Profile:
+    """Collapsed stacks of one request, weighted by wall-clock microseconds"""
+    def __init__(self, method, route, path, trigger):
+        self.method = method
+        self.route = route
+        self.path = path
+        self.trigger = trigger
+        self.root = f'{method} {route}'
+        self.started = time.perf_counter()
+        self.started_at = datetime.utcnow()
+        self.stacks = {}
+        self.samples = 0
+        self.sampled_us = 0
+
+    def add(self, stack, micros):
+        if stack not in self.stacks and len(self.stacks) >= MAX_STACKS:
+            stack = f'{self.root};[truncated]'
+        self.stacks[stack] = self.stacks.get(stack, 0) + micros
+
+    def collapsed(self):
+        return ''.join(f'{stack} {micros}\n' for stack, micros in
+                       sorted(self.stacks.items(), key=lambda item: -item[1]) if micros > 0)
+
+
+class _Registration:
+    __slots__ = ('profile', 'prefix', 'last', 'stack')
+
+    def __init__(self, profile, prefix):
+        self.profile = profile
+        self.prefix = prefix
+        self.last = time.perf_counter()
+        self.stack = None
+
+
+class RequestProfiler:
+    """Samples the stacks of selected requests and keeps the results in an on-disk ring"""
+    def __init__(self, directory, rate=0.01, interval=0.005, keep=100, max_active=8):
+        self.enabled = os.getenv('CIPHERH_PROFILER', '0') == '1'
+        self.directory = directory
+        self.rate = rate
+        self.interval = interval
+        self.keep = keep
+        self.max_active = max_active
+        self.token = os.getenv('CIPHERH_PROFILE_TOKEN') or None
+        self._threads = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sampler = None
+        self._seq = 0
+        self._active = 0
+        self.stats = {'profiled': 0, 'skipped_busy': 0, 'samples': 0, 'written': 0, 'evicted': 0}
+
+    def select(self, requested=None):
+        """'header' or 'sampled' if this request should be profiled, else None.
+        requested is the value of the X-CipherH-Profile header, if any."""
+        if requested and self.token and hmac.compare_digest(requested.encode(), self.token.encode()):
+            return 'header'
+        if random.random() < self.rate:
+            return 'sampled'
+        return None
+
+    def begin(self, method, route, path, requested=None):
+        """Start a profile for a request, or return None if it is not selected"""
+        trigger = self.select(requested)
+        if trigger is None:
+            return None
+        with self._lock:
+            # Bounds the sampler's work when a header is sent on every request
+            if self._active >= self.max_active:
+                self.stats['skipped_busy'] += 1
+                return None
+            self._active += 1
+        self.stats['profiled'] += 1
+        self._ensure_sampler()
+        return Profile(method, route, path, trigger)
+
+    def _ensure_sampler(self):
+        if self._sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._run, name='cipherh-profiler', daemon=True)
+                    self._sampler.start()
+                    logging.info(f'CipherH: Request profiler started (rate {self.rate}, '
+                                 f'{self.interval * 1000:g} ms interval)')
+
+    def attach(self, profile, prefix=None):
+        """Sample the calling thread into profile until detach()"""
+        with self._lock:
+            self._threads[threading.get_ident()] = _Registration(profile, prefix or profile.root)
+        self._wake.set()
+
+    def detach(self):
+        """Stop sampling the calling thread; the time since the last sample goes to its last stack"""
+        with self._lock:
+            registration = self._threads.pop(threading.get_ident(), None)
+            if registration is None:
+                return
+            elapsed = int((time.perf_counter() - registration.last) * 1000000)
+            profile = registration.profile
+            profile.add(registration.stack or registration.prefix, elapsed)
+            profile.sampled_us += elapsed
+
+    def _label(self, frame):
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            module = frame.f_globals.get('__name__', '?')
+            label = f"{module}:{getattr(code, 'co_qualname', code.co_name)}".replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def _stack(self, frame, prefix):
+        labels = []
+        while frame is not None and len(labels) < MAX_DEPTH:
+            labels.append(self._label(frame))
+            frame = frame.f_back
+        labels.append(prefix)
+        return ';'.join(reversed(labels))
+
+    def _sample(self):
+        frames = sys._current_frames()
+        now = time.perf_counter()
+        for thread_id, registration in self._threads.items():
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            elapsed = int((now - registration.last) * 1000000)
+            registration.last = now
+            registration.stack = self._stack(frame, registration.prefix)
+            profile = registration.profile
+            profile.add(registration.stack, elapsed)
+            profile.sampled_us += elapsed
+            profile.samples += 1
+            self.stats['samples'] += 1
+
+    def _run(self):
+        while True:
+            if not self._threads:
+                # Nothing to sample: sleep until a request attaches
+                self._wake.wait()
+                self._wake.clear()
+            time.sleep(self.interval)
+            with self._lock:
+                self._sample()
+
+    def finish(self, profile, status=None, residual=False):
+        """Write a finished profile to the ring. residual=True charges unsampled time to '[awaiting]'."""
+        duration_us = int((time.perf_counter() - profile.started) * 1000000)
+        if residual and duration_us > profile.sampled_us:
+            profile.add(f'{profile.root};[awaiting]', duration_us - profile.sampled_us)
+        with self._lock:
+            self._active -= 1
+            self._seq += 1
+            seq = self._seq
+        profile_id = f"{profile.started_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}-{seq}"
+        meta = {
+            'id': profile_id,
+            'method': profile.method,
+            'route': profile.route,
+            'path': profile.path,
+            'status': status,
+            'trigger': profile.trigger,
+            'started_at': profile.started_at.isoformat(),
+            'duration_ms': round(duration_us / 1000, 2),
+            'samples': profile.samples,
+            'stacks': len(profile.stacks)
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, profile_id)
+            for suffix, content in (('.folded', profile.collapsed()), ('.json', json.dumps(meta))):
+                tmp = f'{base}{suffix}.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                os.replace(tmp, base + suffix)
+            self.stats['written'] += 1
+            self._evict()
+        except OSError as e:
+            logging.error(f'CipherH: Writing profile {profile_id} failed: {e}')
+        return meta
+
+    def _evict(self):
+        ids = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith('.json'))
+        for profile_id in ids[:-self.keep] if len(ids) > self.keep else []:
+            for suffix in ('.json', '.folded'):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+            self.stats['evicted'] += 1
+
+    def list_profiles(self, route=None, limit=None):
+        """Metadata of stored profiles, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if route and meta.get('route') != route:
+                continue
+            profiles.append(meta)
+            if limit and len(profiles) >= limit:
+                break
+        return profiles
+
+    def read_collapsed(self, profile_id):
+        """Collapsed stacks of a stored profile, or None if it is unknown or evicted"""
+        if not PROFILE_ID_RE.match(profile_id or ''):
+            return None
+        try:
+            with open(os.path.join(self.directory, profile_id + '.folded'), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_stats(self):
+        return {**self.stats, 'enabled': self.enabled, 'rate': self.rate,
+                'interval_ms': self.interval * 1000, 'keep': self.keep, 'active': self._active}
+
+
+# Global instance
+request_profiler = RequestProfiler(
+    os.getenv('CIPHERH_PROFILE_DIR', 'profiles'),
+    rate=float(os.getenv('CIPHERH_PROFILE_RATE', '0.01')),
+    interval=float(os.getenv('CIPHERH_PROFILE_INTERVAL_MS', '5')) / 1000,
+    keep=int(os.getenv('CIPHERH_PROFILE_KEEP', '100'))
+)
@@ -0,0 +1,152 @@
+"""
+CipherH Response Cache
+
+Caches brain replies for near-identical messages: greetings, FAQs. The
+key is the platform, the persona version and the normalized message.
+Normalization lowercases the text, folds Vietnamese diacritics
+("Xin chào!" and "xin chao" share an entry) and collapses punctuation
+and whitespace. Folding can merge distinct words ("bán"/"bạn"), which is
+acceptable for the short stock messages that actually repeat. Entries
+expire after a TTL, and the least recently used ones are evicted to
+stay under a byte budget. Replies are not keyed per user, so callers
+opt out for personalised requests. Enabled with CIPHERH_RESPONSE_CACHE=1.
+"""
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Per-entry bookkeeping (key tuple, OrderedDict node, timestamps) in bytes
+ENTRY_OVERHEAD = 200
+
+_PUNCT_RE = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def fold_vietnamese(text):
+    """Strip diacritics, including the đ/Đ stroke, which NFD does not decompose"""
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_message(text):
+    folded = fold_vietnamese(text or '').lower()
+    return _PUNCT_RE.sub(' ', folded).strip()
+
+
+def cache_requested(data, headers):
+    """Per-request opt-out: {"cache": false} or Cache-Control: no-cache/no-store"""
+    if isinstance(data, dict) and data.get('cache') is False:
+        return False
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    return 'no-cache' not in cache_control and 'no-store' not in cache_control
+
+
+def _persona_version():
+    version = os.getenv('CIPHERH_PERSONA_VERSION')
+    if version:
+        return version
+    try:
+        from app import cipher_personality
+    except ImportError:
+        return '0'
+    return str(getattr(cipher_personality, 'version', '0'))
+
+
+class ResponseCache:
+    """TTL + LRU cache of replies bounded by an approximate byte budget"""
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600.0, max_message_chars=500):
+        self.enabled = os.getenv('CIPHERH_RESPONSE_CACHE') == '1'
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_message_chars = max_message_chars
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def key_for(self, message, platform):
+        if not message or len(message) > self.max_message_chars:
+            # Long messages are effectively unique; don't spend the budget on them
+            return None
+        normalized = normalize_message(message)
+        return (platform, _persona_version(), normalized) if normalized else None
+
+    @staticmethod
+    def _size(key, response):
+        return ENTRY_OVERHEAD + len(key[2].encode('utf-8')) + len(response.encode('utf-8'))
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            response, expires_at, size = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._bytes -= size
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return response
+
+    def put(self, key, response):
+        if not isinstance(response, str) or not response:
+            return
+        size = self._size(key, response)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[key] = (response, time.monotonic() + self.ttl, size)
+            self._bytes += size
+            self.stats['stores'] += 1
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def process(self, message, platform, user_id, processor, use_cache=True):
+        """Return processor(message, platform, user_id), served from cache when possible"""
+        key = self.key_for(message, platform) if self.enabled and use_cache else None
+        if key is None:
+            self.stats['bypassed'] += 1
+            return processor(message, platform, user_id)
+        response = self.get(key)
+        if response is None:
+            response = processor(message, platform, user_id)
+            self.put(key, response)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else None
+            }
+
+
+# Global instance
+response_cache = ResponseCache(
+    max_bytes=int(os.getenv('CIPHERH_RESPONSE_CACHE_MB', '16')) * 1024 * 1024,
+    ttl=float(os.getenv('CIPHERH_RESPONSE_CACHE_TTL', '3600'))
+)
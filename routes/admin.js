@@ -13,7 +13,7 @@ document.addEventListener("DOMContentLoaded", () => {
     console.log("CipherH Admin: Initializing...");
     initializeAdminSocket();
     initializeAdminUI();
-    loadAdminData();
+    if (!adminSocket) loadAdminData();
     setupAdminUpdates();
 });
 
@@ -26,6 +26,11 @@ function initializeAdminSocket() {
     adminSocket.on("connect", () => {
         console.log("Socket connected");
         updateConnectionStatus("connected");
+        // Full snapshot once, then the server pushes only changed keys
+        adminSocket.emit("stats_subscribe", {}, snapshot => {
+            adminStats = snapshot;
+            updateAdminDashboard(snapshot);
+        });
     });
 
     adminSocket.on("disconnect", () => {
@@ -34,6 +39,10 @@ function initializeAdminSocket() {
     });
 
     adminSocket.on("admin_update", handleAdminUpdate);
+    adminSocket.on("stats_delta", delta => {
+        Object.assign(adminStats, delta);
+        updateAdminDashboard(adminStats);
+    });
     adminSocket.on("system_alert", handleSystemAlert);
 }
 
@@ -318,13 +327,10 @@ function showAdminNotification(msg, type = "info", duration = 5000) {
 
 /* ================= PERIODIC ================= */
 function setupAdminUpdates() {
-    refreshInterval = setInterval(loadAdminData, 120000);
-    setInterval(checkConnectionStatus, 10000);
-}
-
-function checkConnectionStatus() {
-    if (!adminSocket) return;
-    updateConnectionStatus(adminSocket.connected ? "connected" : "disconnected");
+    // Stats are pushed over the socket; poll only while it is down
+    refreshInterval = setInterval(() => {
+        if (!adminSocket?.connected) loadAdminData();
+    }, 120000);
 }
 
 function updateConnectionStatus(status) {
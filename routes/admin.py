@@ -3,9 +3,16 @@ Admin routes for CipherH monitoring and management
 Vô Ảnh – CipherH Admin Panel
 """
 
-from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for
+from flask import (Blueprint, render_template, request, jsonify, flash, redirect, url_for,
+                   current_app, Response, stream_with_context)
 from datetime import datetime, timedelta
+import base64
+import binascii
+import csv
+import io
+import json
 import logging
+import zlib
 
 # ==============================
 # Database & Models
@@ -16,6 +23,7 @@ try:
 except ImportError:
     from extensions import db  # fallback nếu chạy độc lập
     from models import User, Interaction, Memory, PlatformConfig
+from stats_publisher import stats_publisher
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 logger = logging.getLogger('cipherh_admin')
@@ -29,34 +37,17 @@ logger.setLevel(logging.INFO)
 def dashboard():
     """Admin dashboard"""
     try:
-        total_users = User.query.count()
-        total_interactions = Interaction.query.count()
-        total_memories = Memory.query.count()
-
-        yesterday = datetime.utcnow() - timedelta(days=1)
-        recent_interactions = Interaction.query.filter(
-            Interaction.timestamp >= yesterday
-        ).count()
-        recent_users = User.query.filter(
-            User.last_interaction >= yesterday
-        ).count()
-
-        from sqlalchemy import func
-        platform_stats = db.session.query(
-            Interaction.platform,
-            func.count(Interaction.id).label('count')
-        ).group_by(Interaction.platform).all()
+        from live_stats import live_stats
+        live_stats.ensure_started(current_app._get_current_object())
+        snapshot = live_stats.snapshot()
 
         stats = {
-            'total_users': total_users,
-            'total_interactions': total_interactions,
-            'total_memories': total_memories,
-            'recent_interactions': recent_interactions,
-            'recent_users': recent_users,
-            'platform_stats': [
-                {'platform': stat.platform, 'count': stat.count}
-                for stat in platform_stats
-            ]
+            'total_users': snapshot['totals']['users'],
+            'total_interactions': snapshot['totals']['interactions'],
+            'total_memories': snapshot['totals']['memories'],
+            'recent_interactions': snapshot['recent']['interactions_24h'],
+            'recent_users': snapshot['recent']['active_users_24h'],
+            'platform_stats': snapshot['platforms']
         }
 
         return render_template('admin.html', stats=stats)
@@ -66,6 +57,96 @@ def dashboard():
         return render_template('admin.html', error=str(e))
 
 
+# ==============================
+# Keyset Pagination
+# ==============================
+PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+
+class InvalidCursor(ValueError):
+    """A pagination cursor that was not produced by _encode_cursor"""
+
+
+class KeysetPage:
+    """One page of keyset-paginated rows; exposes .items like Flask-SQLAlchemy's Pagination"""
+    def __init__(self, items, next_cursor, approx_total, per_page):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.approx_total = approx_total
+        self.per_page = per_page
+
+
+def _encode_cursor(sort_value, row_id):
+    raw = json.dumps([sort_value.isoformat() if sort_value else None, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return (datetime.fromisoformat(sort_value) if sort_value is not None else None), int(row_id)
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise InvalidCursor(f'Invalid cursor: {e}')
+
+
+def _keyset_paginate(query, sort_col, id_col, total_key, nullable=False):
+    """Page newest-first on (sort_col, id_col); every page costs the same as the first.
+
+    With nullable=True, rows whose sort_col is NULL come after all others, as a
+    second range paged on id alone, so both ranges can use an index."""
+    from sqlalchemy import and_, or_
+    from live_stats import live_stats
+
+    per_page = max(1, min(request.args.get('per_page', PER_PAGE, type=int), MAX_PER_PAGE))
+    cursor = request.args.get('cursor')
+    sort_value, row_id = _decode_cursor(cursor) if cursor else (None, None)
+
+    rows = []
+    if sort_value is not None or not cursor:
+        ranged = query.filter(sort_col.isnot(None)) if nullable else query
+        if cursor:
+            ranged = ranged.filter(or_(
+                sort_col < sort_value,
+                and_(sort_col == sort_value, id_col < row_id)
+            ))
+        rows = ranged.order_by(sort_col.desc(), id_col.desc()).limit(per_page + 1).all()
+    if nullable and len(rows) <= per_page:
+        # The NULL range, entered from its start or from a cursor inside it
+        null_rows = query.filter(sort_col.is_(None))
+        if cursor and sort_value is None:
+            null_rows = null_rows.filter(id_col < row_id)
+        rows += null_rows.order_by(id_col.desc()).limit(per_page + 1 - len(rows)).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last[1], last[2])
+
+    # Approximate total from the live counters instead of a COUNT(*) per page
+    live_stats.ensure_started(current_app._get_current_object())
+    approx_total = live_stats.snapshot()['totals'][total_key]
+    return KeysetPage([row[0] for row in rows], next_cursor, approx_total, per_page)
+
+
+def _bad_cursor(error):
+    if request.args.get('format') == 'json':
+        return jsonify({'error': str(error)}), 400
+    return render_template('admin.html', error=str(error)), 400
+
+
+def _page_json(page, serialize):
+    return jsonify({
+        'items': [serialize(item) for item in page.items],
+        'next_cursor': page.next_cursor,
+        'has_next': page.has_next,
+        'approx_total': page.approx_total,
+        'per_page': page.per_page
+    })
+
+
 # ==============================
 # Interactions View
 # ==============================
@@ -73,21 +154,75 @@ def dashboard():
 def interactions():
     """View recent interactions"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = 50
-        interactions = Interaction.query.join(User).order_by(
-            Interaction.timestamp.desc()
-        ).paginate(page=page, per_page=per_page, error_out=False)
+        from sqlalchemy.orm import contains_eager
+        interactions = _keyset_paginate(
+            db.session.query(Interaction, Interaction.timestamp, Interaction.id)
+            .join(User).options(contains_eager(Interaction.user)),
+            Interaction.timestamp, Interaction.id, 'interactions'
+        )
 
+        if request.args.get('format') == 'json':
+            return _page_json(interactions, lambda i: {
+                'id': i.id,
+                'timestamp': i.timestamp.isoformat(),
+                'platform': i.platform,
+                'username': i.user.username,
+                'message': i.message,
+                'cipher_response': i.cipher_response
+            })
         return render_template(
             'admin.html', view='interactions', interactions=interactions
         )
 
+    except InvalidCursor as e:
+        return _bad_cursor(e)
     except Exception as e:
         logger.error(f"Admin interactions error: {e}")
         return render_template('admin.html', error=str(e))
 
 
+@bp.route('/api/interactions/search')
+def search_interactions():
+    """Full-text search over interaction messages and replies"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        from interaction_search import interaction_search, utc_timestamp
+        bounds = {}
+        for name in ('since', 'until'):
+            value = request.args.get(name)
+            if value:
+                try:
+                    bounds[name] = utc_timestamp(value)
+                except ValueError:
+                    return jsonify({'error': f'{name} must be an ISO date or datetime'}), 400
+
+        interaction_search.start(current_app._get_current_object())
+        results = interaction_search.search(
+            query,
+            platform=request.args.get('platform') or None,
+            user_id=request.args.get('user_id', type=int),
+            limit=max(1, min(request.args.get('limit', PER_PAGE, type=int), MAX_PER_PAGE)),
+            order=request.args.get('order', 'recent'),
+            **bounds
+        )
+        usernames = dict(db.session.query(User.id, User.username)
+                         .filter(User.id.in_({r['user_id'] for r in results}))) if results else {}
+        for result in results:
+            result['username'] = usernames.get(result['user_id'])
+
+        return jsonify({
+            'query': query,
+            'results': results,
+            'search_ms': interaction_search.stats['last_search_ms']
+        })
+
+    except Exception as e:
+        logger.error(f"Interaction search error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 # ==============================
 # Users View
 # ==============================
@@ -95,14 +230,26 @@ def interactions():
 def users():
     """View user list"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = 50
-        users = User.query.order_by(
-            User.last_interaction.desc()
-        ).paginate(page=page, per_page=per_page, error_out=False)
+        # Users that never interacted come last, in their own NULL range
+        users = _keyset_paginate(
+            db.session.query(User, User.last_interaction, User.id),
+            User.last_interaction, User.id, 'users', nullable=True
+        )
 
+        if request.args.get('format') == 'json':
+            return _page_json(users, lambda u: {
+                'id': u.id,
+                'platform_type': u.platform_type,
+                'platform_id': u.platform_id,
+                'username': u.username,
+                'display_name': u.display_name,
+                'interaction_count': u.interaction_count,
+                'last_interaction': u.last_interaction.isoformat() if u.last_interaction else None
+            })
         return render_template('admin.html', view='users', users=users)
 
+    except InvalidCursor as e:
+        return _bad_cursor(e)
     except Exception as e:
         logger.error(f"Admin users error: {e}")
         return render_template('admin.html', error=str(e))
@@ -115,14 +262,24 @@ def users():
 def memories():
     """View CipherH's memories"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = 50
-        memories = Memory.query.order_by(
-            Memory.created_at.desc()
-        ).paginate(page=page, per_page=per_page, error_out=False)
+        memories = _keyset_paginate(
+            db.session.query(Memory, Memory.created_at, Memory.id),
+            Memory.created_at, Memory.id, 'memories', nullable=True
+        )
 
+        if request.args.get('format') == 'json':
+            return _page_json(memories, lambda m: {
+                'id': m.id,
+                'memory_type': m.memory_type,
+                'content': m.content,
+                'confidence': m.confidence,
+                'notion_id': m.notion_id,
+                'created_at': m.created_at.isoformat() if m.created_at else None
+            })
         return render_template('admin.html', view='memories', memories=memories)
 
+    except InvalidCursor as e:
+        return _bad_cursor(e)
     except Exception as e:
         logger.error(f"Admin memories error: {e}")
         return render_template('admin.html', error=str(e))
@@ -178,6 +335,9 @@ def toggle_platform(platform_name):
         config.last_sync = datetime.utcnow()
         db.session.commit()
 
+        from platform_adapters import platform_manager
+        platform_manager.apply_config(config)
+
         return jsonify({'status': 'success', 'platform': platform_name, 'active': config.active})
 
     except Exception as e:
@@ -185,6 +345,18 @@ def toggle_platform(platform_name):
         return jsonify({'error': str(e)}), 500
 
 
+@bp.record_once
+def _load_platform_configs(state):
+    # Rate limits and active flags live in PlatformConfig; apply them before the first send
+    from platform_adapters import platform_manager
+    try:
+        with state.app.app_context():
+            for config in PlatformConfig.query.all():
+                platform_manager.apply_config(config)
+    except Exception as e:
+        logger.error(f"Loading platform configs failed: {e}")
+
+
 # ==============================
 # Memory Create API
 # ==============================
@@ -202,101 +374,331 @@ def create_memory():
             confidence=data.get('confidence', 1.0)
         )
         db.session.add(memory)
+        db.session.flush()
+
+        # Outbox row commits with the memory; the syncer stores it to Notion
+        from memory_outbox import memory_syncer
+        memory_syncer.enqueue(memory)
         db.session.commit()
+        memory_syncer.start(current_app._get_current_object())
+        memory_syncer.wake()
 
-        # Store to Notion if available
-        from app import notion_vault
-        notion_id = notion_vault.store_insight(
-            data['content'], memory.confidence, memory.memory_type
-        )
-        if notion_id:
-            memory.notion_id = notion_id
-            db.session.commit()
+        from memory_index import memory_index
+        try:
+            memory_index.add(memory.id, memory.content)
+        except Exception as e:
+            # The memory is committed; the index's background catch_up() picks it up
+            logger.error(f"Memory index add error: {e}")
 
         return jsonify({
             'status': 'success',
             'memory_id': memory.id,
-            'notion_id': notion_id
+            'notion_id': None,
+            'sync_status': 'pending'
         })
 
     except Exception as e:
         logger.error(f"Create memory error: {e}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/memory/search')
+def search_memories():
+    """Top-k memories most similar to ?q= from the local vector index"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        k = min(max(request.args.get('k', 5, type=int), 1), 50)
+
+        from memory_index import memory_index
+        results = memory_index.lookup(query, k, request.args.get('nprobe', type=int))
+        return jsonify({
+            'query': query,
+            'results': [{
+                'id': m.id,
+                'memory_type': m.memory_type,
+                'content': m.content,
+                'confidence': m.confidence,
+                'score': score
+            } for m, score in results],
+            'search_ms': memory_index.stats['last_search_ms']
+        })
+
+    except Exception as e:
+        logger.error(f"Memory search error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 # ==============================
 # System Status API
 # ==============================
+def collect_system_status():
+    """Build the admin status snapshot; called once per push interval, not per client"""
+    from app import cipher_personality, notion_vault, openai_brain
+    from platform_adapters import platform_manager
+    from user_cache import user_cache
+    from webhook_inbox import webhook_inbox
+    from broadcast import broadcaster
+    from response_cache import response_cache
+    from brain_admission import brain_admission
+    from conversation_context import conversation_context
+    from memory_outbox import memory_syncer
+    from memory_index import memory_index
+    from interaction_search import interaction_search
+    from metrics import metrics
+    from profiler import request_profiler
+
+    from live_stats import live_stats
+    live_stats.ensure_started(current_app._get_current_object())
+    snapshot = live_stats.snapshot()
+    totals = snapshot['totals']
+
+    db_stats = {
+        'users': totals['users'],
+        'interactions': totals['interactions'],
+        'memories': totals['memories'],
+        'platform_configs': totals['platform_configs']
+    }
+    recent_stats = snapshot['recent']
+
+    return {
+        'timestamp': datetime.utcnow().isoformat(),
+        'cipher_personality': {
+            'name': cipher_personality.real_name,
+            'birth_date': cipher_personality.birth_date,
+            'active': True
+        },
+        'notion_vault': notion_vault.get_vault_status(),
+        'openai_brain': openai_brain.get_brain_status(),
+        'platforms': platform_manager.get_all_statuses(),
+        'database': db_stats,
+        'recent_activity': recent_stats,
+        'platform_stats': snapshot['platforms'],
+        'stats_reconciled_at': snapshot['reconciled_at'],
+        'user_cache': user_cache.get_stats(),
+        'webhook_inbox': webhook_inbox.get_stats() if webhook_inbox.enabled else {'enabled': False},
+        'broadcast': broadcaster.get_stats(),
+        'stats_publisher': stats_publisher.get_stats(),
+        'response_cache': response_cache.get_stats(),
+        'brain_admission': brain_admission.get_stats(),
+        'conversation_context': conversation_context.get_stats(),
+        'memory_sync': memory_syncer.get_stats(),
+        'memory_index': memory_index.get_stats(),
+        'interaction_search': interaction_search.get_stats(),
+        'latency': metrics.summary(),
+        'profiler': request_profiler.get_stats()
+    }
+
+
+stats_publisher.register('admin', collect_system_status, namespace='/admin')
+
+
 @bp.route('/api/system/status')
 def system_status():
     """Get detailed system status for admin monitoring"""
     try:
-        from app import cipher_personality, notion_vault, openai_brain
-        from platform_adapters import platform_manager
+        stats_publisher.start(current_app._get_current_object())
+        return jsonify(stats_publisher.current('admin'))
 
-        db_stats = {
-            'users': User.query.count(),
-            'interactions': Interaction.query.count(),
-            'memories': Memory.query.count(),
-            'platform_configs': PlatformConfig.query.count()
-        }
+    except Exception as e:
+        logger.error(f"System status error: {e}")
+        return jsonify({'error': str(e)}), 500
 
-        yesterday = datetime.utcnow() - timedelta(days=1)
-        recent_stats = {
-            'interactions_24h': Interaction.query.filter(
-                Interaction.timestamp >= yesterday
-            ).count(),
-            'active_users_24h': User.query.filter(
-                User.last_interaction >= yesterday
-            ).count()
-        }
 
-        status = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'cipher_personality': {
-                'name': cipher_personality.real_name,
-                'birth_date': cipher_personality.birth_date,
-                'active': True
-            },
-            'notion_vault': notion_vault.get_vault_status(),
-            'openai_brain': openai_brain.get_brain_status(),
-            'platforms': platform_manager.get_all_statuses(),
-            'database': db_stats,
-            'recent_activity': recent_stats
-        }
+# ==============================
+# Request Profiles API
+# ==============================
+@bp.route('/api/profiles')
+def list_profiles():
+    """List stored request profiles, newest first (route=, limit=)"""
+    try:
+        from profiler import request_profiler
+        return jsonify({
+            'profiler': request_profiler.get_stats(),
+            'profiles': request_profiler.list_profiles(
+                route=request.args.get('route') or None,
+                limit=max(1, min(request.args.get('limit', PER_PAGE, type=int), MAX_PER_PAGE))
+            )
+        })
+
+    except Exception as e:
+        logger.error(f"Profile list error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 
-        return jsonify(status)
+@bp.route('/api/profiles/<profile_id>')
+def download_profile(profile_id):
+    """Download a profile as collapsed stacks (flamegraph.pl, speedscope, inferno)"""
+    try:
+        from profiler import request_profiler
+        collapsed = request_profiler.read_collapsed(profile_id)
+        if collapsed is None:
+            return jsonify({'error': 'Profile not found'}), 404
+        return Response(collapsed, mimetype='text/plain; charset=utf-8', headers={
+            'Content-Disposition': f'attachment; filename=cipherh-profile-{profile_id}.folded'
+        })
 
     except Exception as e:
-        logger.error(f"System status error: {e}")
+        logger.error(f"Profile download error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 # ==============================
 # Vault Sync API
 # ==============================
+@bp.record_once
+def _start_memory_workers(state):
+    # Drain outbox rows left pending by a restart without waiting for the next write
+    from memory_outbox import memory_syncer
+    memory_syncer.start(state.app)
+    # Index memories created while the index was offline; also registers its delete hooks
+    from memory_index import memory_index
+    memory_index.start(state.app)
+
+
 @bp.route('/api/vault/sync', methods=['POST'])
 def sync_vault():
     """Manually trigger vault synchronization"""
     try:
-        from app import notion_vault
-        notion_vault.update_memory_index()
-        return jsonify({'status': 'success', 'message': 'Vault synchronization completed'})
+        from memory_outbox import memory_syncer
+        memory_syncer.start(current_app._get_current_object())
+        memory_syncer.request_reindex()
+        return jsonify({'status': 'success', 'message': 'Vault synchronization scheduled'})
 
     except Exception as e:
         logger.error(f"Vault sync error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+# ==============================
+# Analytics Export Streaming
+# ==============================
+EXPORT_FIELDS = [
+    'timestamp', 'platform', 'user_id', 'username', 'message_length',
+    'response_length', 'sentiment_score', 'context_tags'
+]
+EXPORT_CHUNK_SIZE = 1000
+
+
+def _export_rows(since_date, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield export records from a server-side cursor, chunk_size rows at a time"""
+    from sqlalchemy import func
+    rows = db.session.query(
+        Interaction.timestamp,
+        Interaction.platform,
+        User.platform_id,
+        User.username,
+        func.length(Interaction.message),
+        func.length(Interaction.cipher_response),
+        Interaction.sentiment_score,
+        Interaction.context_tags
+    ).join(User).filter(
+        Interaction.timestamp >= since_date
+    ).order_by(Interaction.timestamp.desc()).yield_per(chunk_size)
+
+    for timestamp, platform, user_id, username, message_length, response_length, sentiment, tags in rows:
+        yield {
+            'timestamp': timestamp.isoformat(),
+            'platform': platform,
+            'user_id': user_id,
+            'username': username,
+            'message_length': message_length or 0,
+            'response_length': response_length or 0,
+            'sentiment_score': sentiment,
+            'context_tags': tags
+        }
+
+
+def _ndjson_chunks(records, chunk_size=EXPORT_CHUNK_SIZE):
+    lines = []
+    try:
+        for record in records:
+            lines.append(json.dumps(record, ensure_ascii=False))
+            if len(lines) >= chunk_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+    except Exception as e:
+        # Rows read so far, then a trailer no record can be mistaken for
+        lines.append(json.dumps({'error': 'export truncated', 'detail': str(e)}))
+        yield '\n'.join(lines) + '\n'
+        raise
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def _csv_chunks(records, chunk_size=EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    try:
+        for n, record in enumerate(records, 1):
+            writer.writerow(record)
+            if n % chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except Exception as e:
+        buffer.write(f'# ERROR: export truncated: {e}\r\n')
+        yield buffer.getvalue()
+        raise
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+    except Exception:
+        # Push out the error trailer but leave the gzip footer off, so gunzip reports the truncation too
+        yield compressor.flush(zlib.Z_SYNC_FLUSH)
+        raise
+    yield compressor.flush()
+
+
+def _stream_export(chunks):
+    try:
+        yield from chunks
+    except Exception as e:
+        # Headers are already sent: after the error trailer, re-raise so the server aborts the
+        # response without the final chunk and the client sees an incomplete transfer, not a 200 EOF
+        logger.error(f"Analytics export stream error: {e}")
+        raise
+
+
 # ==============================
 # Analytics Export API
 # ==============================
 @bp.route('/api/analytics/export')
 def export_analytics():
-    """Export analytics data"""
+    """Export analytics data (format=json|ndjson|csv, gzip=1 to compress streams)"""
     try:
         days = request.args.get('days', 30, type=int)
         since_date = datetime.utcnow() - timedelta(days=days)
+        export_format = request.args.get('format', 'json')
+
+        if export_format in ('ndjson', 'csv'):
+            records = _export_rows(since_date)
+            if export_format == 'csv':
+                chunks, mimetype = _csv_chunks(records), 'text/csv'
+            else:
+                chunks, mimetype = _ndjson_chunks(records), 'application/x-ndjson'
+
+            filename = f'cipherh-analytics-{days}d.{export_format}'
+            headers = {'Content-Disposition': f'attachment; filename={filename}'}
+            if request.args.get('gzip', type=int):
+                chunks = _gzip_chunks(chunks)
+                headers['Content-Encoding'] = 'gzip'
+
+            return Response(
+                stream_with_context(_stream_export(chunks)),
+                mimetype=mimetype, headers=headers
+            )
 
         interactions = db.session.query(Interaction, User).join(User).filter(
             Interaction.timestamp >= since_date
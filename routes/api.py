@@ -1,15 +1,28 @@
 """
 API routes for CipherH multi-platform integration
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from app import db, socketio
 from models import User, Interaction, PlatformConfig
-from platform_adapters import platform_manager
+from platform_adapters import platform_manager, DeliveryQueueFull
+from interaction_writer import interaction_writer, new_ulid
+from user_cache import user_cache
+from live_stats import live_stats
+from webhook_inbox import webhook_inbox
+from broadcast import broadcaster
+from streaming import ReplyStream, sse_event, stream_cipher_message
+from response_cache import cache_requested
+from brain_admission import admitted_reply
+from conversation_context import conversation_context
+from interaction_search import interaction_search
 from datetime import datetime
+from sqlalchemy import update
 import logging
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
+MAX_BULK_RECIPIENTS = 10000
+
 # Import the core message processor
 try:
     from app import process_cipher_message
@@ -20,6 +33,13 @@ except ImportError:
         return f"[Fallback] Received '{message}' from {user_id} on {platform}."
 
 
+@bp.record_once
+def _start_webhook_inbox(state):
+    # Drain entries left pending by a crash or restart without waiting for new traffic
+    if webhook_inbox.enabled:
+        webhook_inbox.start(state.app, platform_manager.handle_webhook, platform_manager.handle_webhooks)
+
+
 @bp.route('/webhook/<platform>', methods=['POST'])
 def platform_webhook(platform):
     """Generic webhook endpoint for all platforms"""
@@ -31,6 +51,16 @@ def platform_webhook(platform):
         if not data:
             return jsonify({'error': 'Empty data received'}), 400
 
+        if webhook_inbox.enabled:
+            # Acknowledge first: persist the raw payload, process it in the background
+            adapter = platform_manager.get_adapter(platform)
+            if not adapter:
+                return jsonify({'error': f'Platform {platform} not supported'}), 400
+            inbox_id, duplicate = webhook_inbox.append(
+                platform, adapter.event_id(data), request.get_data(as_text=True)
+            )
+            return jsonify({'status': 'duplicate' if duplicate else 'accepted', 'inbox_id': inbox_id})
+
         result = platform_manager.handle_webhook(platform, data)
 
         if result:
@@ -75,6 +105,15 @@ def send_platform_message(platform_name):
         message = data['message']
         context = data.get('context')
 
+        if data.get('async'):
+            try:
+                delivery_id = platform_manager.enqueue_message(platform_name, recipient_id, message, context)
+            except DeliveryQueueFull:
+                return jsonify({'error': f'Delivery queue for {platform_name} is full'}), 503
+            if delivery_id:
+                return jsonify({'status': 'queued', 'platform': platform_name, 'delivery_id': delivery_id}), 202
+            return jsonify({'error': f'Platform {platform_name} not supported'}), 400
+
         result = platform_manager.send_message(platform_name, recipient_id, message, context)
         if result:
             return jsonify({'status': 'sent', 'platform': platform_name, 'result': result})
@@ -85,6 +124,122 @@ def send_platform_message(platform_name):
         return jsonify({'error': 'Message sending failed'}), 500
 
 
+@bp.route('/platforms/<platform_name>/send_many', methods=['POST'])
+def send_platform_bulk(platform_name):
+    """Send one message to many recipients through a specific platform"""
+    try:
+        data = request.get_json()
+        if not data or not data.get('recipient_ids') or 'message' not in data:
+            return jsonify({'error': 'recipient_ids and message are required'}), 400
+
+        recipient_ids = data['recipient_ids']
+        if not isinstance(recipient_ids, list):
+            return jsonify({'error': 'recipient_ids must be a list'}), 400
+        if len(recipient_ids) > MAX_BULK_RECIPIENTS:
+            return jsonify({'error': f'At most {MAX_BULK_RECIPIENTS} recipients per request'}), 400
+
+        result = platform_manager.send_many(platform_name, recipient_ids, data['message'], data.get('context'))
+        if result is None:
+            return jsonify({'error': f'Platform {platform_name} not supported'}), 400
+        return jsonify({'status': 'sent' if not result['failed'] else 'partial', **result})
+
+    except Exception as e:
+        logging.error(f"Bulk send error for {platform_name}: {e}", exc_info=True)
+        return jsonify({'error': 'Bulk message sending failed'}), 500
+
+
+@bp.route('/deliveries/<delivery_id>', methods=['GET'])
+def get_delivery(delivery_id):
+    """Get the status of a queued outbound delivery"""
+    try:
+        status = platform_manager.get_delivery_status(delivery_id)
+        if not status:
+            return jsonify({'error': 'Delivery not found'}), 404
+        return jsonify(status)
+
+    except Exception as e:
+        logging.error(f"Get delivery error for {delivery_id}: {e}", exc_info=True)
+        return jsonify({'error': 'Failed to get delivery status'}), 500
+
+
+def _record_interaction(user, user_id, platform, message, cipher_response):
+    """Persist one exchange and publish it to stats and live feeds.
+    Returns the interaction id; under write-behind it is pre-allocated (None if the database has no sequence)."""
+    first_interaction = not user.interaction_count
+    now = datetime.utcnow()
+    user_db_id = user.id
+    turn = {
+        'id': None,
+        'message': message,
+        'cipher_response': cipher_response,
+        'timestamp': now,
+        'sentiment_score': None,
+        'context_tags': []
+    }
+    interaction_search.start(current_app._get_current_object())
+
+    if interaction_writer.enabled:
+        def saved(saved_id):
+            # Runs on the flusher once the row exists; only then can the index serve it
+            turn['id'] = saved_id
+            interaction_search.add(saved_id, user_db_id, platform, message, cipher_response, now)
+
+        # Write-behind: interaction and user activity are flushed in batches
+        interaction_writer.start(current_app._get_current_object())
+        interaction_id = turn['id'] = interaction_writer.record(
+            user_db_id, platform, message, cipher_response, timestamp=now, on_saved=saved
+        )
+        user_cache.record_activity(user_id, platform, now)
+    else:
+        # Update user activity in SQL, so concurrent requests and workers never lose an increment
+        db.session.execute(
+            update(User).where(User.id == user_db_id)
+            .values(interaction_count=User.interaction_count + 1, last_interaction=now)
+            .execution_options(synchronize_session=False)
+        )
+
+        # Store interaction
+        interaction = Interaction(
+            user_id=user.id,
+            platform=platform,
+            message=message,
+            cipher_response=cipher_response,
+            timestamp=now
+        )
+        db.session.add(interaction)
+        db.session.commit()
+        interaction_id = turn['id'] = interaction.id
+        user_cache.record_activity(user_id, platform, now)
+        interaction_search.add(interaction_id, user_db_id, platform, message, cipher_response, now)
+
+    conversation_context.append(user_db_id, turn)
+
+    live_stats.record_interaction(user.id, platform, first_interaction=first_interaction)
+
+    # Real-time update, coalesced into periodic frames
+    broadcaster.publish({
+        'platform': platform,
+        'user': user_id,
+        'message': message[:100] + '...' if len(message) > 100 else message,
+        'timestamp': datetime.utcnow().isoformat()
+    })
+    return interaction_id
+
+
+def _conversation_user(data):
+    return user_cache.find_or_create(
+        data['user_id'], data['platform'],
+        username=data.get('username', data['user_id']),
+        display_name=data.get('display_name', data['user_id'])
+    )
+
+
+def persist_conversation(data, cipher_response):
+    """Find the user and record one finished exchange; returns the interaction id"""
+    user = _conversation_user(data)
+    return _record_interaction(user, data['user_id'], data['platform'], data['message'], cipher_response)
+
+
 @bp.route('/conversation', methods=['POST'])
 def process_conversation():
     """Process a conversation message from any platform"""
@@ -99,47 +254,30 @@ def process_conversation():
         platform = data['platform']
 
         # Find or create user
-        user = User.query.filter_by(platform_id=user_id, platform_type=platform).first()
-        if not user:
-            user = User(
-                platform_id=user_id,
-                platform_type=platform,
-                username=data.get('username', user_id),
-                display_name=data.get('display_name', user_id)
-            )
-            db.session.add(user)
-            db.session.commit()
-
-        # Update user activity
-        user.last_interaction = datetime.utcnow()
-        user.interaction_count += 1
+        user = _conversation_user(data)
 
         # Process message through CipherH
-        cipher_response = process_cipher_message(message, platform, user_id)
-
-        # Store interaction
-        interaction = Interaction(
-            user_id=user.id,
-            platform=platform,
-            message=message,
-            cipher_response=cipher_response
+        cipher_response, shed_reason = admitted_reply(
+            message, platform, user_id, process_cipher_message,
+            use_cache=cache_requested(data, request.headers)
         )
-        db.session.add(interaction)
-        db.session.commit()
-
-        # Emit real-time update
-        socketio.emit('new_interaction', {
-            'platform': platform,
-            'user': user_id,
-            'message': message[:100] + '...' if len(message) > 100 else message,
-            'timestamp': datetime.utcnow().isoformat()
-        })
+        if shed_reason:
+            # Overloaded: answer fast with the fallback and skip persistence
+            return jsonify({
+                'response': cipher_response,
+                'user_id': user_id,
+                'platform': platform,
+                'interaction_id': None,
+                'degraded': shed_reason
+            })
+
+        interaction_id = _record_interaction(user, user_id, platform, message, cipher_response)
 
         return jsonify({
             'response': cipher_response,
             'user_id': user_id,
             'platform': platform,
-            'interaction_id': interaction.id
+            'interaction_id': interaction_id
         })
 
     except Exception as e:
@@ -148,27 +286,129 @@ def process_conversation():
         return jsonify({'error': 'Conversation processing failed'}), 500
 
 
+@bp.route('/conversation/stream', methods=['POST'])
+def stream_conversation():
+    """Process a conversation message, streaming the reply as Server-Sent Events"""
+    try:
+        data = request.get_json()
+        required_fields = ['message', 'user_id', 'platform']
+        if not data or not all(field in data for field in required_fields):
+            return jsonify({'error': 'message, user_id, and platform are required'}), 400
+
+        message = data['message']
+        user_id = data['user_id']
+        platform = data['platform']
+        user = _conversation_user(data)
+
+        reply = ReplyStream(
+            stream_cipher_message(message, platform, user_id, use_cache=cache_requested(data, request.headers)),
+            on_complete=lambda text: _record_interaction(user, user_id, platform, message, text)
+        )
+
+        def generate():
+            chunks = iter(reply)
+            try:
+                yield sse_event('start', {'user_id': user_id, 'platform': platform})
+                for chunk in chunks:
+                    yield sse_event('chunk', {'text': chunk})
+                done = {'response': reply.text, 'interaction_id': reply.finish(), **reply.get_timing()}
+                if reply.shed_reason:
+                    # Overloaded: the fallback was streamed and is not persisted
+                    done['degraded'] = reply.shed_reason
+                yield sse_event('done', done)
+            except Exception as e:
+                logging.error(f"Streaming conversation error: {e}", exc_info=True)
+                db.session.rollback()
+                yield sse_event('error', {'error': 'Conversation processing failed'})
+            finally:
+                # Client went away mid-stream: the partial reply is persisted once
+                chunks.close()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    except Exception as e:
+        logging.error(f"Streaming conversation error: {e}", exc_info=True)
+        db.session.rollback()
+        return jsonify({'error': 'Conversation processing failed'}), 500
+
+
+def _stream_to_socket(app, sid, data):
+    stream_id = data['stream_id']
+    with app.app_context():
+        try:
+            user = _conversation_user(data)
+            reply = ReplyStream(
+                stream_cipher_message(data['message'], data['platform'], data['user_id'],
+                                      use_cache=data.get('cache') is not False),
+                on_complete=lambda text: _record_interaction(
+                    user, data['user_id'], data['platform'], data['message'], text)
+            )
+            for chunk in reply:
+                socketio.emit('cipher_response', {'stream_id': stream_id, 'delta': chunk, 'done': False}, to=sid)
+            done = {
+                'stream_id': stream_id,
+                'message': reply.text,
+                'done': True,
+                'interaction_id': reply.finish(),
+                'timestamp': datetime.utcnow().isoformat()
+            }
+            if reply.shed_reason:
+                done['degraded'] = reply.shed_reason
+            socketio.emit('cipher_response', done, to=sid)
+        except Exception as e:
+            logging.error(f"Socket stream error: {e}", exc_info=True)
+            db.session.rollback()
+            socketio.emit('cipher_response', {'stream_id': stream_id, 'error': 'Conversation processing failed', 'done': True}, to=sid)
+        finally:
+            db.session.remove()
+
+
+@socketio.on('chat_stream')
+def handle_chat_stream(data):
+    """Stream a reply back to the sender as cipher_response chunks"""
+    data = dict(data or {})
+    if not data.get('message'):
+        return {'error': 'message is required'}
+    data.setdefault('platform', 'web')
+    data.setdefault('user_id', f'web-{request.sid}')
+    data['stream_id'] = new_ulid()
+    socketio.start_background_task(_stream_to_socket, current_app._get_current_object(), request.sid, data)
+    return {'stream_id': data['stream_id']}
+
+
+def load_recent_turns(user_db_id, limit):
+    """Last `limit` turns of a user from the database, oldest first"""
+    if interaction_writer.enabled:
+        # Buffered rows must be visible before the context cache trusts the DB
+        interaction_writer.flush()
+    interactions = Interaction.query.filter_by(user_id=user_db_id)\
+                                   .order_by(Interaction.timestamp.desc())\
+                                   .limit(limit).all()
+    return [{
+        'id': i.id,
+        'message': i.message,
+        'cipher_response': i.cipher_response,
+        'timestamp': i.timestamp,
+        'sentiment_score': i.sentiment_score,
+        'context_tags': i.context_tags.split(',') if i.context_tags else []
+    } for i in reversed(interactions)]
+
+
 @bp.route('/users/<platform>/<user_id>/history', methods=['GET'])
 def get_user_history(platform, user_id):
     """Get conversation history for a specific user"""
     try:
-        user = User.query.filter_by(platform_id=user_id, platform_type=platform).first()
+        user = user_cache.find(user_id, platform)
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
         limit = request.args.get('limit', 10, type=int)
-        interactions = Interaction.query.filter_by(user_id=user.id)\
-                                       .order_by(Interaction.timestamp.desc())\
-                                       .limit(limit).all()
-
-        history = [{
-            'id': i.id,
-            'message': i.message,
-            'cipher_response': i.cipher_response,
-            'timestamp': i.timestamp.isoformat(),
-            'sentiment_score': i.sentiment_score,
-            'context_tags': i.context_tags.split(',') if i.context_tags else []
-        } for i in interactions]
+        turns = conversation_context.recent(user.id, limit, load_recent_turns)
+        history = [{**turn, 'timestamp': turn['timestamp'].isoformat()} for turn in turns]
 
         return jsonify({
             'user': {
@@ -195,6 +435,14 @@ def get_analytics_summary():
         from datetime import timedelta
 
         days = request.args.get('days', 7, type=int)
+        if days < 1:
+            return jsonify({'error': 'days must be at least 1'}), 400
+
+        if not request.args.get('exact', type=int):
+            # Daily rollups plus the open tail; active_users is a HyperLogLog estimate
+            from analytics_rollup import rollup_engine
+            return jsonify(rollup_engine.summary(days))
+
         since_date = datetime.utcnow() - timedelta(days=days)
 
         total_interactions = Interaction.query.filter(
@@ -17,7 +17,7 @@ function initializeApp() {
 
     initializeSocket();
     initializeUI();
-    loadSystemStats();
+    if (!socket) loadSystemStats();
     setupPeriodicUpdates();
 
     if (window.feather) feather.replace();
@@ -37,6 +37,13 @@ function initializeSocket() {
         connectionStatus = 'connected';
         updateConnectionStatus('connected');
         showNotification('Đã kết nối CipherH', 'success');
+        // Empty list = all platforms; the server re-sends nothing on its own after a reconnect
+        socket.emit('subscribe', { platforms: [] });
+        // Full snapshot once, then only changed keys are pushed
+        socket.emit('stats_subscribe', {}, snapshot => {
+            systemStats = snapshot;
+            updateStatsDisplay(snapshot);
+        });
     });
 
     socket.on('disconnect', () => {
@@ -46,8 +53,16 @@ function initializeSocket() {
     });
 
     socket.on('cipher_response', data => handleCipherResponse(data));
-    socket.on('new_interaction', data => handleNewInteraction(data));
+    socket.on('interaction_batch', (data, ack) => {
+        // Ack first so the server keeps sending while this frame renders
+        if (typeof ack === 'function') ack();
+        handleInteractionBatch(data);
+    });
     socket.on('system_update', data => handleSystemUpdate(data));
+    socket.on('stats_delta', delta => {
+        Object.assign(systemStats, delta);
+        updateStatsDisplay(systemStats);
+    });
     socket.on('connect_error', err => {
         console.error('Socket connect error:', err);
         showNotification('Không thể kết nối server', 'danger');
@@ -55,6 +70,7 @@ function initializeSocket() {
 }
 
 function handleCipherResponse(data) {
+    if (data.stream_id) return handleStreamChunk(data);
     console.log('💬 CipherH response:', data);
     if (typeof addMessageToChat === 'function')
         addMessageToChat(data.message, 'cipher', data.timestamp);
@@ -62,10 +78,42 @@ function handleCipherResponse(data) {
     if (data.sentiment) updateSentimentDisplay(data.sentiment);
 }
 
-function handleNewInteraction(data) {
-    updateInteractionStats(data);
-    if (typeof addToRecentActivity === 'function') addToRecentActivity(data);
-    showNotification(`Tương tác mới từ ${data.platform}`, 'info');
+/** STREAMING REPLIES **/
+function handleStreamChunk(data) {
+    const container = document.getElementById('chat-messages');
+    if (!container) return;
+
+    let el = container.querySelector(`[data-stream-id="${data.stream_id}"]`);
+    if (!el) {
+        el = document.createElement('div');
+        el.className = 'message message-cipher streaming';
+        el.dataset.streamId = data.stream_id;
+        container.appendChild(el);
+    }
+
+    if (data.delta) el.textContent += data.delta;
+    if (data.done) {
+        el.classList.remove('streaming');
+        if (data.error) el.textContent = data.error;
+        else if (data.message) el.textContent = data.message;
+    }
+    container.scrollTop = container.scrollHeight;
+}
+
+function sendStreamingMessage(message, platform = 'web') {
+    if (!socket?.connected) return false;
+    socket.emit('chat_stream', { message, platform });
+    return true;
+}
+
+function handleInteractionBatch(frame) {
+    if (typeof updateInteractionStats === 'function') updateInteractionStats(frame);
+    if (typeof addToRecentActivity === 'function') frame.sample.forEach(addToRecentActivity);
+
+    const platforms = Object.keys(frame.by_platform).join(', ');
+    showNotification(frame.count === 1
+        ? `Tương tác mới từ ${platforms}`
+        : `${frame.count} tương tác mới từ ${platforms}`, 'info');
 }
 
 function handleSystemUpdate(data) {
@@ -121,7 +169,7 @@ function initializeTheme() {
 /** SYSTEM STATS **/
 async function loadSystemStats() {
     try {
-        const res = await fetch('/api/status');
+        const res = await fetch('/status');
         const data = await res.json();
         systemStats = data;
         updateStatsDisplay(data);
@@ -210,7 +258,8 @@ function copyToClipboard(text) {
 
 /** PERIODIC UPDATE **/
 function setupPeriodicUpdates() {
-    setInterval(() => connectionStatus === 'connected' && loadSystemStats(), 30000);
+    // Stats are pushed over the socket; poll only while it is down
+    setInterval(() => connectionStatus !== 'connected' && loadSystemStats(), 30000);
 }
 
 /** ERROR HANDLERS **/
@@ -222,5 +271,5 @@ window.addEventListener('unhandledrejection', e => {
     console.error('Promise rejection:', e.reason);
 });
 
-window.CipherH = { showNotification, refreshPage, syncVault, loadSystemStats };
+window.CipherH = { showNotification, refreshPage, syncVault, loadSystemStats, sendStreamingMessage };
 console.log('🚀 CipherH: app.js loaded');
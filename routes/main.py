@@ -2,13 +2,60 @@
 Main routes for CipherH web interface
 """
 
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, render_template, request, jsonify, current_app, Response, stream_with_context, g
 from app import db
-from models import Interaction, User, Memory
+from live_stats import live_stats
+from stats_publisher import stats_publisher
+from streaming import ReplyStream, sse_event, stream_cipher_message
+from response_cache import response_cache, cache_requested
+from brain_admission import admitted_reply, brain_admission
+from metrics import metrics, request_latency
+from profiler import PROFILE_HEADER, request_profiler
 import logging
+import time
 
 bp = Blueprint('main', __name__)
 
+
+@bp.before_app_request
+def _start_request_timer():
+    g.cipherh_request_started = time.perf_counter()
+
+
+@bp.teardown_app_request
+def _record_request_latency(exc):
+    started = g.pop('cipherh_request_started', None)
+    if started is not None:
+        # The rule template, not the path, keeps route cardinality bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.labels(request.method, route).observe(time.perf_counter() - started)
+
+
+if request_profiler.enabled:
+    # Registered only when profiling is on, so it costs nothing otherwise
+    @bp.before_app_request
+    def _start_profile():
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        profile = request_profiler.begin(request.method, route, request.path,
+                                         request.headers.get(PROFILE_HEADER))
+        if profile is not None:
+            g.cipherh_profile = profile
+            request_profiler.attach(profile)
+
+    @bp.after_app_request
+    def _record_profile_status(response):
+        if 'cipherh_profile' in g:
+            g.cipherh_profile_status = response.status_code
+        return response
+
+    @bp.teardown_app_request
+    def _finish_profile(exc):
+        profile = g.pop('cipherh_profile', None)
+        if profile is not None:
+            request_profiler.detach()
+            request_profiler.finish(profile, status=g.pop('cipherh_profile_status', 500 if exc else None))
+
+
 # =========================================================
 # ROUTES
 # =========================================================
@@ -17,8 +64,10 @@ bp = Blueprint('main', __name__)
 def index():
     """Main landing page"""
     try:
-        recent_interactions = Interaction.query.count()
-        active_users = User.query.filter(User.interaction_count > 0).count()
+        live_stats.ensure_started(current_app._get_current_object())
+        totals = live_stats.snapshot()['totals']
+        recent_interactions = totals['interactions']
+        active_users = totals['engaged_users']
     except Exception as e:
         logging.error(f"[INDEX] Database error: {e}")
         recent_interactions, active_users = 0, 0
@@ -36,37 +85,55 @@ def chat():
     return render_template('chat.html')
 
 
+def collect_public_status():
+    """Build the public status snapshot; called once per push interval, not per client"""
+    # Import here to avoid circular dependencies
+    from app import cipher_personality, notion_vault, openai_brain
+    from platform_adapters import platform_manager
+
+    live_stats.ensure_started(current_app._get_current_object())
+    totals = live_stats.snapshot()['totals']
+
+    return {
+        'cipher_personality': {
+            'name': getattr(cipher_personality, 'real_name', 'CipherH'),
+            'active': True,
+            'birth_date': getattr(cipher_personality, 'birth_date', 'Unknown')
+        },
+        'notion_vault': getattr(notion_vault, 'get_vault_status', lambda: {'connected': False})(),
+        'openai_brain': getattr(openai_brain, 'get_brain_status', lambda: {'connected': False})(),
+        'platforms': getattr(platform_manager, 'get_all_statuses', lambda: {})(),
+        'database': {
+            'total_interactions': totals['interactions'],
+            'total_users': totals['users'],
+            'total_memories': totals['memories']
+        },
+        'response_cache': response_cache.get_stats(),
+        'brain_admission': brain_admission.get_stats()
+    }
+
+
+stats_publisher.register('public', collect_public_status)
+
+
 @bp.route('/status')
 def status():
     """System status endpoint"""
     try:
-        # Import here to avoid circular dependencies
-        from app import cipher_personality, notion_vault, openai_brain
-        from platform_adapters import platform_manager
-
-        status_data = {
-            'cipher_personality': {
-                'name': getattr(cipher_personality, 'real_name', 'CipherH'),
-                'active': True,
-                'birth_date': getattr(cipher_personality, 'birth_date', 'Unknown')
-            },
-            'notion_vault': getattr(notion_vault, 'get_vault_status', lambda: {'connected': False})(),
-            'openai_brain': getattr(openai_brain, 'get_brain_status', lambda: {'connected': False})(),
-            'platforms': getattr(platform_manager, 'get_all_statuses', lambda: {})(),
-            'database': {
-                'total_interactions': Interaction.query.count(),
-                'total_users': User.query.count(),
-                'total_memories': Memory.query.count()
-            }
-        }
-
-        return jsonify(status_data)
+        stats_publisher.start(current_app._get_current_object())
+        return jsonify(stats_publisher.current('public'))
 
     except Exception as e:
         logging.exception("[STATUS] Failed to retrieve system status")
         return jsonify({'error': str(e)}), 500
 
 
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Latency histograms in Prometheus text format"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 @bp.route('/api/chat', methods=['POST'])
 def api_chat():
     """API endpoint for chat messages"""
@@ -81,19 +148,58 @@ def api_chat():
         user_id = data.get('user_id', 'anonymous')
 
         from app import process_cipher_message
-        response = process_cipher_message(message, platform, user_id)
+        response, shed_reason = admitted_reply(
+            message, platform, user_id, process_cipher_message,
+            use_cache=cache_requested(data, request.headers)
+        )
 
-        return jsonify({
+        result = {
             'response': response,
             'platform': platform,
             'user_id': user_id
-        })
+        }
+        if shed_reason:
+            result['degraded'] = shed_reason
+        return jsonify(result)
 
     except Exception as e:
         logging.exception("[API_CHAT] Error processing chat request")
         return jsonify({'error': f'Chat processing failed: {e}'}), 500
 
 
+@bp.route('/api/chat/stream', methods=['POST'])
+def api_chat_stream():
+    """Streaming variant of /api/chat: the reply arrives as Server-Sent Events"""
+    data = request.get_json(silent=True) or {}
+
+    message = data.get('message')
+    if not message:
+        return jsonify({'error': 'Message is required'}), 400
+
+    platform = data.get('platform', 'web')
+    user_id = data.get('user_id', 'anonymous')
+
+    def generate():
+        try:
+            use_cache = cache_requested(data, request.headers)
+            reply = ReplyStream(stream_cipher_message(message, platform, user_id, use_cache=use_cache))
+            for chunk in reply:
+                yield sse_event('chunk', {'text': chunk})
+            done = {'response': reply.text, 'platform': platform, 'user_id': user_id}
+            if reply.shed_reason:
+                done['degraded'] = reply.shed_reason
+            yield sse_event('done', done)
+        except Exception as e:
+            logging.exception("[API_CHAT_STREAM] Error processing chat request")
+            yield sse_event('error', {'error': f'Chat processing failed: {e}'})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @bp.route('/personality')
 def personality():
     """Display CipherH's personality profile"""
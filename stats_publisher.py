@@ -0,0 +1,121 @@
+"""
+CipherH Stats Publisher
+
+Pushes dashboard stats over SocketIO instead of having every open page
+poll them. Each feed (admin, public) is built once per interval by one
+background task, and only the keys that changed since the last push are
+broadcast to the feed's room. The cost is the same for one tab or a hundred. Clients get
+the full snapshot when they subscribe, and the HTTP status endpoints
+serve the same cached snapshot.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, request
+from flask_socketio import join_room
+
+from app import socketio
+
+
+class _Feed:
+    __slots__ = ('name', 'builder', 'namespace', 'room', 'snapshot', 'built_at', 'pushed')
+
+    def __init__(self, name, builder, namespace, room):
+        self.name = name
+        self.builder = builder
+        self.namespace = namespace
+        self.room = room
+        self.snapshot = None
+        self.built_at = 0.0
+        # Last snapshot broadcast to the room; polls and subscribes rebuild snapshot without pushing it
+        self.pushed = None
+
+
+class StatsPublisher:
+    """Builds each stats feed once per interval and pushes deltas to its room"""
+    def __init__(self, socketio, interval=5.0):
+        self.socketio = socketio
+        self.interval = interval
+        self.app = None
+        self.feeds = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.stats = {'builds': 0, 'deltas_sent': 0, 'skipped_idle': 0}
+
+    def register(self, name, builder, namespace='/'):
+        """Register a feed; clients join it with a 'stats_subscribe' event in namespace"""
+        self.feeds[name] = _Feed(name, builder, namespace, f'stats:{name}')
+
+        def handle_subscribe(data=None):
+            self.start(current_app._get_current_object())
+            join_room(f'stats:{name}', sid=request.sid, namespace=namespace)
+            return self.current(name)
+
+        self.socketio.on_event('stats_subscribe', handle_subscribe, namespace=namespace)
+        return builder
+
+    def start(self, app):
+        if self._task is not None:
+            return
+        with self._lock:
+            if self._task is None:
+                self.app = app
+                self._task = self.socketio.start_background_task(self._run)
+                logging.info(f'CipherH: Stats publisher started ({self.interval}s interval)')
+
+    def _build(self, feed):
+        snapshot = feed.builder()
+        feed.snapshot = snapshot
+        feed.built_at = time.monotonic()
+        self.stats['builds'] += 1
+        return snapshot
+
+    def current(self, name):
+        """Latest snapshot of a feed, rebuilt only when older than the interval"""
+        feed = self.feeds[name]
+        with self._lock:
+            if feed.snapshot is None or time.monotonic() - feed.built_at > self.interval:
+                self._build(feed)
+            return feed.snapshot
+
+    def _has_listeners(self, feed):
+        try:
+            return next(iter(self.socketio.server.manager.get_participants(feed.namespace, feed.room)), None) is not None
+        except (KeyError, AttributeError):
+            return False
+
+    def publish(self, feed):
+        if not self._has_listeners(feed):
+            self.stats['skipped_idle'] += 1
+            return
+        with self._lock:
+            previous = feed.pushed or {}
+            snapshot = self._build(feed)
+            delta = {k: v for k, v in snapshot.items() if k != 'timestamp' and previous.get(k) != v}
+            feed.pushed = snapshot
+        if not delta:
+            return
+        delta['timestamp'] = datetime.utcnow().isoformat()
+        self.socketio.emit('stats_delta', delta, to=feed.room, namespace=feed.namespace)
+        self.stats['deltas_sent'] += 1
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            for feed in list(self.feeds.values()):
+                try:
+                    with self.app.app_context():
+                        self.publish(feed)
+                except Exception as e:
+                    logging.error(f'CipherH: Stats feed {feed.name} failed: {e}')
+
+    def get_stats(self):
+        return {**self.stats, 'interval': self.interval, 'feeds': sorted(self.feeds)}
+
+
+# Global instance
+stats_publisher = StatsPublisher(socketio, interval=float(os.getenv('CIPHERH_STATS_PUSH_INTERVAL', '5')))
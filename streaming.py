@@ -0,0 +1,179 @@
+"""
+CipherH Streaming Replies
+
+Generator-based variant of the message processor. The reply is yielded
+chunk by chunk while the brain generates it, so the first bytes can
+reach the client right away. If the configured brain has
+stream_response(message, platform, user_id), it is used directly.
+Otherwise the blocking process_cipher_message reply is re-chunked, which
+keeps the wire protocol the same but does not speed up the first byte.
+FakeBrain (CIPHERH_FAKE_BRAIN=1) yields canned tokens with delays for
+local testing.
+
+When admission control sheds the call, stream_cipher_message raises
+BrainOverloaded before the first chunk. ReplyStream turns that into the
+fallback reply, sets shed_reason and skips on_complete, so a shed reply
+is neither persisted nor cached.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+from brain_admission import brain_admission, BrainOverloaded
+from response_cache import response_cache
+
+_TOKEN_RE = re.compile(r'\S+\s*|\s+')
+
+
+def split_tokens(text):
+    """Split text into word-sized chunks that concatenate back to the original"""
+    return _TOKEN_RE.findall(text or '')
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Events frame"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+class FakeBrain:
+    """Deterministic local brain that yields its reply one token at a time"""
+    def __init__(self, delay=0.05, first_token_delay=0.2):
+        self.delay = delay
+        self.first_token_delay = first_token_delay
+
+    def reply_for(self, message, platform, user_id):
+        return f'CipherH nghe rồi, {user_id}. Bạn vừa nói trên {platform}: "{message}". Mình đang suy nghĩ về điều đó.'
+
+    def stream_response(self, message, platform, user_id):
+        time.sleep(self.first_token_delay)
+        for n, token in enumerate(split_tokens(self.reply_for(message, platform, user_id))):
+            if n:
+                time.sleep(self.delay)
+            yield token
+
+    async def astream_response(self, message, platform, user_id):
+        await asyncio.sleep(self.first_token_delay)
+        for n, token in enumerate(split_tokens(self.reply_for(message, platform, user_id))):
+            if n:
+                await asyncio.sleep(self.delay)
+            yield token
+
+    def get_brain_status(self):
+        return {'connected': True, 'model': 'fake', 'streaming': True}
+
+
+def async_brain():
+    """The configured brain if it can stream natively from a coroutine, else None"""
+    brain = _default_brain()
+    return brain if hasattr(brain, 'astream_response') else None
+
+
+def _default_brain():
+    if os.getenv('CIPHERH_FAKE_BRAIN') == '1':
+        return fake_brain
+    try:
+        from app import openai_brain
+    except ImportError:
+        return None
+    return openai_brain if hasattr(openai_brain, 'stream_response') else None
+
+
+def _generate(message, platform, user_id, brain):
+    brain = brain or _default_brain()
+    if brain is not None:
+        yield from brain.stream_response(message, platform, user_id)
+        return
+    from app import process_cipher_message
+    yield from split_tokens(process_cipher_message(message, platform, user_id))
+
+
+def stream_cipher_message(message, platform, user_id, brain=None, use_cache=True):
+    """Yield the reply to a message as text chunks, replaying cached replies.
+    Raises BrainOverloaded before the first chunk if the call is shed."""
+    key = response_cache.key_for(message, platform) if response_cache.enabled and use_cache else None
+    cached = response_cache.get(key) if key else None
+    if cached is not None:
+        yield from split_tokens(cached)
+        return
+    parts = []
+    # The slot is held until the last chunk has been generated
+    with brain_admission.slot(platform):
+        for chunk in _generate(message, platform, user_id, brain):
+            parts.append(chunk)
+            yield chunk
+    # Only complete replies are cached
+    if key:
+        response_cache.put(key, ''.join(parts))
+
+
+class ReplyStream:
+    """Iterates a reply's chunks, then calls on_complete(full_text) exactly once.
+    on_complete also runs when the consumer stops early, with the partial
+    text, and it is not called at all when generation fails or is shed;
+    a shed reply streams the fallback and sets shed_reason."""
+    def __init__(self, chunks, on_complete=None):
+        self.chunks = chunks
+        self.on_complete = on_complete
+        self.parts = []
+        self.result = None
+        self.completed = False
+        self.shed_reason = None
+        self.first_chunk_at = None
+        self.started_at = time.monotonic()
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def __iter__(self):
+        failed = False
+        try:
+            for chunk in self.chunks:
+                if self.first_chunk_at is None:
+                    self.first_chunk_at = time.monotonic()
+                self.parts.append(chunk)
+                yield chunk
+        except BrainOverloaded as e:
+            self.shed_reason = e.reason
+            for chunk in split_tokens(e.fallback_reply):
+                if self.first_chunk_at is None:
+                    self.first_chunk_at = time.monotonic()
+                self.parts.append(chunk)
+                yield chunk
+        except Exception:
+            failed = True
+            raise
+        finally:
+            close = getattr(self.chunks, 'close', None)
+            if close:
+                close()
+            if not failed:
+                self.finish()
+
+    def finish(self):
+        if self.completed or self.shed_reason:
+            return self.result
+        self.completed = True
+        if self.on_complete:
+            try:
+                self.result = self.on_complete(self.text)
+            except Exception as e:
+                logging.error(f'CipherH: Persisting streamed reply failed: {e}')
+        return self.result
+
+    def get_timing(self):
+        return {
+            'ttfb_ms': round((self.first_chunk_at - self.started_at) * 1000, 1) if self.first_chunk_at else None,
+            'total_ms': round((time.monotonic() - self.started_at) * 1000, 1)
+        }
+
+
+# Global instance
+fake_brain = FakeBrain(
+    delay=float(os.getenv('CIPHERH_FAKE_BRAIN_DELAY_MS', '50')) / 1000,
+    first_token_delay=float(os.getenv('CIPHERH_FAKE_BRAIN_FIRST_TOKEN_MS', '200')) / 1000
+)
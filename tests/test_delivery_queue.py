@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from platform_adapters import DeliveryQueue, DeliveryQueueFull, PlatformManager, RateLimiter
+from platform_transport import FakeTransport
+
+
+def _wait_for(queue, delivery_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        record = queue.get_status(delivery_id)
+        if record['status'] not in ('queued', 'sending'):
+            return record
+        time.sleep(0.01)
+    raise AssertionError(f'delivery {delivery_id} still {record["status"]}')
+
+
+@pytest.fixture
+def manager():
+    manager = PlatformManager()
+    manager.set_transport(FakeTransport())
+    return manager
+
+
+def test_enqueue_delivers_through_transport(manager):
+    delivery_id = manager.enqueue_message('facebook', 'u1', 'hello')
+    record = _wait_for(manager.delivery_queue, delivery_id)
+    assert record['status'] == 'sent'
+    assert record['completed_at'] is not None
+    transport = manager.get_adapter('facebook').transport
+    assert [(s['recipient_id'], s['payload']) for s in transport.sent] == [('u1', 'hello')]
+
+
+def test_unknown_platform_is_not_queued(manager):
+    assert manager.enqueue_message('myspace', 'u1', 'hello') is None
+
+
+def test_rate_limited_send_is_retried_after_backoff(manager):
+    transport = FakeTransport(rate_limited=2, headers={'Retry-After': '0'})
+    manager.set_transport(transport, 'telegram')
+    record = _wait_for(manager.delivery_queue, manager.enqueue_message('telegram', 'u1', 'hi'))
+    assert record['status'] == 'sent'
+    assert transport.rate_limited == 0
+    assert len(transport.sent) == 1
+    assert manager.get_adapter('telegram').rate_limiter.backoff_streak >= 2
+
+
+def test_rate_limit_retries_are_bounded(manager):
+    adapter = manager.get_adapter('telegram')
+    transport = FakeTransport(rate_limited=10, headers={'Retry-After': '0'})
+    manager.set_transport(transport, 'telegram')
+    record = _wait_for(manager.delivery_queue, manager.enqueue_message('telegram', 'u1', 'hi'))
+    assert record['status'] == 'failed'
+    assert 'rate limit' in record['error']
+    assert transport.rate_limited == 10 - (adapter.MAX_RATE_LIMIT_RETRIES + 1)
+    assert transport.sent == []
+
+
+def test_transport_failure_marks_delivery_failed(manager):
+    manager.set_transport(FakeTransport(fail_recipients={'bad'}), 'zalo')
+    record = _wait_for(manager.delivery_queue, manager.enqueue_message('zalo', 'bad', 'hi'))
+    assert record['status'] == 'failed'
+    assert 'bad' in record['error']
+
+
+def test_full_queue_rejects(manager):
+    queue = DeliveryQueue(manager, maxsize=1, workers_per_platform=0)
+    first = queue.enqueue('facebook', 'u1', 'one')
+    with pytest.raises(DeliveryQueueFull):
+        queue.enqueue('facebook', 'u2', 'two')
+    assert queue.get_status(first)['status'] == 'queued'
+    assert queue.get_stats() == {'facebook': {'queued': 1, 'workers': 0}}
+    rejected = [r for r in queue._deliveries.values() if r['recipient_id'] == 'u2']
+    assert rejected[0]['status'] == 'rejected'
+
+
+def test_rate_limiter_paces_past_the_burst():
+    limiter = RateLimiter(rate_limit=20, rate_burst=2, recipient_rate_limit=1000, recipient_burst=1000)
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('b') == 0.0
+    waited = limiter.acquire('c')
+    assert 0.0 < waited <= 0.1
+    assert limiter.get_status()['throttled_seconds'] > 0
+
+
+def test_rate_limiter_paces_each_recipient():
+    limiter = RateLimiter(rate_limit=1000, rate_burst=1000, recipient_rate_limit=20, recipient_burst=1)
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('b') == 0.0
+    assert limiter.acquire('a') > 0.0
+
+
+def test_rate_limiter_backs_off_on_429():
+    limiter = RateLimiter(rate_limit=10, rate_burst=10, recipient_rate_limit=10, recipient_burst=10)
+    limiter.observe({}, 429)
+    assert limiter.backoff_streak == 1
+    assert 0 < limiter.get_status()['backoff_remaining'] <= 1.0
+    limiter.observe({'Retry-After': '30'}, 429)
+    assert limiter.get_status()['backoff_remaining'] > 29
+
+
+def test_rate_limiter_follows_usage_headers():
+    limiter = RateLimiter(rate_limit=40, rate_burst=80, recipient_rate_limit=1, recipient_burst=5)
+    limiter.observe({'X-App-Usage': '{"call_count": 90, "total_time": 10}'}, 200)
+    assert limiter.rate_factor == 0.5
+    assert limiter.bucket.rate == 20
+    # Malformed usage headers are ignored
+    limiter.observe({'X-App-Usage': '[1, 2]', 'X-Business-Use-Case-Usage': '{"1": [3]}'}, 200)
+    assert limiter.rate_factor == 0.5
+    limiter.observe({'X-App-Usage': '{"call_count": 10}'}, 200)
+    assert limiter.rate_factor == pytest.approx(0.6)
@@ -0,0 +1,108 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('models')
+
+from memory_index import HashingEmbedder, MemoryIndex  # noqa: E402
+
+WORDS = ('chào bạn hôm nay trời đẹp quá mình muốn học lập trình python cà phê sữa đá '
+         'bóng đá tối nay đội nhà thắng âm nhạc guitar piano hát karaoke du lịch đà lạt '
+         'biển nha trang nấu ăn phở bò bún chả công việc họp dự án báo cáo').split()
+
+
+def _texts(n, seed=7):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(8)) + f' #{i}' for i in range(n)]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = MemoryIndex(str(tmp_path / 'index'), dim=128)
+    index.load()
+    return index
+
+
+def test_embedder_is_deterministic_unit_length_and_folds_diacritics():
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed_many(['Chào bạn', 'chao ban', ''])
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1.0)
+    assert np.allclose(vectors[0], vectors[1])
+    assert not vectors[2].any()
+    assert np.array_equal(embedder.embed('Chào bạn'), vectors[0])
+
+
+def test_add_and_search(index):
+    index.add_many([1, 2, 3], ['học lập trình python', 'cà phê sữa đá buổi sáng', 'bóng đá tối nay'])
+    results = index.search('lập trình python', k=2)
+    assert [r['memory_id'] for r in results][0] == 1
+    assert len(results) == 2
+    assert results[0]['score'] >= results[1]['score']
+    assert index.get_stats()['vectors'] == 3
+
+
+def test_removed_memories_leave_results_and_compaction_drops_them(index):
+    index.add_many([1, 2, 3], ['học lập trình python', 'học lập trình python nâng cao', 'bóng đá tối nay'])
+    index.remove(1)
+    assert 1 not in [r['memory_id'] for r in index.search('học lập trình python', k=3)]
+    index.compact()
+    assert index.deleted == set() and index.count == 2
+    assert sorted(int(i) for i in index.ids[:index.count]) == [2, 3]
+    assert index.search('học lập trình python', k=1)[0]['memory_id'] == 2
+
+
+def test_delete_before_add_is_kept(index):
+    index.add_many([1], ['bóng đá'])
+    # A delete that raced ahead of its add must survive compaction
+    index.remove(5)
+    index.compact()
+    assert index.deleted == {5}
+    index.add(5, 'bóng đá tối nay')
+    assert 5 not in [r['memory_id'] for r in index.search('bóng đá tối nay', k=2)]
+
+
+def test_another_process_sees_appends_and_deletes(index, tmp_path):
+    index.add_many([1, 2], ['du lịch đà lạt', 'nấu ăn phở bò'])
+    other = MemoryIndex(index.path, dim=128)
+    other.load()
+    assert other.search('phở bò', k=1)[0]['memory_id'] == 2
+    index.add(3, 'biển nha trang')
+    index.remove(2)
+    results = [r['memory_id'] for r in other.search('phở bò', k=3)]
+    assert 3 in results and 2 not in results
+
+
+def test_exact_search_until_ivf_is_trained(tmp_path):
+    texts = _texts(3000)
+    index = MemoryIndex(str(tmp_path / 'index'), dim=128, exact_below=2000, ivf=True, nprobe=16)
+    index.load()
+    index.add_many(list(range(1, 1501)), texts[:1500])
+    assert not index._needs_training()
+    index.search(texts[10])
+    assert index.stats['exact_searches'] == 1
+
+    index.add_many(list(range(1501, 3001)), texts[1500:])
+    assert index._needs_training()
+    index.remove(11)
+    index.train()
+    assert index.centroids is not None and index.trained_count == index.count == 2999
+    assert index.deleted == set()
+    # A memory's own text finds it through the partitions, without an exact scan
+    for i in (0, 1499, 2999):
+        assert index.search(texts[i], k=1)[0]['memory_id'] == i + 1
+    assert index.stats['exact_searches'] == 1
+    assert 11 not in [r['memory_id'] for r in index.search(texts[10], k=10)]
+    # Appended after training: assigned to a partition and searchable right away
+    index.add(5000, 'guitar piano hát karaoke guitar piano hát karaoke')
+    assert index.search('guitar piano hát karaoke guitar piano hát karaoke', k=1)[0]['memory_id'] == 5000
+
+
+def test_exact_search_is_the_default(tmp_path):
+    index = MemoryIndex(str(tmp_path / 'index'), dim=128, exact_below=0)
+    index.load()
+    index.add_many(list(range(1, 1101)), _texts(1100))
+    assert not index._needs_training()
+    index.search('bóng đá')
+    assert index.stats['exact_searches'] == 1
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+app_module = pytest.importorskip('app')
+models = pytest.importorskip('models')
+
+from memory_outbox import FAILED, PENDING, SYNCED, FakeVault, MemoryOutbox, MemorySyncer  # noqa: E402
+
+db = app_module.db
+Memory = models.Memory
+
+
+@pytest.fixture
+def app():
+    with app_module.app.app_context():
+        db.create_all()
+        MemoryOutbox.__table__.create(db.engine, checkfirst=True)
+        yield app_module.app
+        db.session.remove()
+        MemoryOutbox.__table__.drop(db.engine, checkfirst=True)
+
+
+def _syncer(vault, **kwargs):
+    syncer = MemorySyncer(rate=1000, burst=1000, **kwargs)
+    syncer._vault = vault
+    return syncer
+
+
+def _add_memories(syncer, contents):
+    memories = [Memory(content=content, confidence=0.8, memory_type='insight') for content in contents]
+    db.session.add_all(memories)
+    db.session.flush()
+    for memory in memories:
+        syncer.enqueue(memory)
+    db.session.commit()
+    return [memory.id for memory in memories]
+
+
+def _outbox(memory_id):
+    db.session.expire_all()
+    return db.session.get(MemoryOutbox, memory_id)
+
+
+def test_drain_stores_every_pending_memory(app):
+    vault = FakeVault(latency=0)
+    syncer = _syncer(vault, batch_size=2)
+    ids = _add_memories(syncer, ['một', 'hai', 'ba'])
+    assert syncer.sync_batch() == 2
+    assert syncer.sync_batch() == 1
+    assert syncer.sync_batch() == 0
+    assert sorted(i['content'] for i in vault.insights.values()) == ['ba', 'hai', 'một']
+    for memory_id in ids:
+        assert _outbox(memory_id).status == SYNCED
+        assert db.session.get(Memory, memory_id).notion_id in vault.insights
+    assert syncer.stats['synced'] == 3
+
+
+def test_failed_store_is_retried_with_backoff(app):
+    vault = FakeVault(latency=0, fail_every=1)
+    syncer = _syncer(vault)
+    [memory_id] = _add_memories(syncer, ['một'])
+    started = time.time()
+    assert syncer.sync_batch() == 1
+    row = _outbox(memory_id)
+    assert row.status == PENDING and row.attempts == 1
+    assert row.available_at >= started + 2 and 'Fake vault' in row.last_error
+    # Not due yet, so the next pass leaves it alone
+    assert syncer.sync_batch() == 0
+
+    vault.fail_every = 0
+    db.session.execute(MemoryOutbox.__table__.update().values(available_at=time.time()))
+    db.session.commit()
+    assert syncer.sync_batch() == 1
+    assert _outbox(memory_id).status == SYNCED
+    assert syncer.stats['retried'] == 1 and syncer.stats['synced'] == 1
+
+
+def test_store_gives_up_after_max_attempts(app):
+    syncer = _syncer(FakeVault(latency=0, fail_every=1), max_attempts=1)
+    [memory_id] = _add_memories(syncer, ['một'])
+    assert syncer.sync_batch() == 1
+    assert _outbox(memory_id).status == FAILED
+    assert syncer.stats['failed'] == 1
+
+
+def test_failed_reindex_keeps_the_request(app):
+    class FailingVault(FakeVault):
+        def update_memory_index(self):
+            self.index_runs.append(None)
+            raise ConnectionError('Fake vault: simulated Notion 502')
+
+    vault = FailingVault(latency=0)
+    syncer = _syncer(vault, interval=60)
+    syncer.request_reindex()
+    syncer.start(app)
+    deadline = time.monotonic() + 5
+    while not (vault.index_runs and syncer._reindex.is_set()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert vault.index_runs
+    # Still requested, so the next pass runs it again
+    assert syncer._reindex.is_set()
+    assert syncer.stats['index_runs'] == 0
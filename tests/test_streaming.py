@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+
+import pytest
+
+import streaming
+from brain_admission import BrainOverloaded
+from response_cache import response_cache
+from streaming import FakeBrain, ReplyStream, split_tokens, stream_cipher_message
+
+
+class ClosingBrain(FakeBrain):
+    """FakeBrain that records whether its generator was closed"""
+    def __init__(self, fail_after=None):
+        super().__init__(delay=0, first_token_delay=0)
+        self.fail_after = fail_after
+        self.closed = False
+
+    def stream_response(self, message, platform, user_id):
+        try:
+            for n, token in enumerate(super().stream_response(message, platform, user_id)):
+                if n == self.fail_after:
+                    raise RuntimeError('brain failed')
+                yield token
+        finally:
+            self.closed = True
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(response_cache, 'enabled', True)
+    response_cache.clear()
+    yield response_cache
+    response_cache.clear()
+
+
+def _reply(brain, message='xin chào'):
+    return brain.reply_for(message, 'web', 7)
+
+
+def test_split_tokens_round_trips():
+    text = 'Chào  bạn!\nHôm nay thế nào? '
+    assert ''.join(split_tokens(text)) == text
+    assert split_tokens(None) == []
+
+
+def test_completed_reply_is_persisted_once_and_cached(cache):
+    brain, saved = ClosingBrain(), []
+    stream = ReplyStream(stream_cipher_message('xin chào', 'web', 7, brain=brain), on_complete=saved.append)
+    assert ''.join(stream) == _reply(brain)
+    assert saved == [_reply(brain)]
+    assert stream.completed and stream.shed_reason is None
+    assert stream.finish() is None and saved == [_reply(brain)]
+    assert stream.get_timing()['ttfb_ms'] is not None
+    assert cache.get(cache.key_for('xin chào', 'web')) == _reply(brain)
+
+
+def test_cached_reply_is_replayed_without_the_brain(cache):
+    cache.put(cache.key_for('xin chào', 'web'), 'đã lưu sẵn')
+    brain = ClosingBrain()
+    assert ''.join(ReplyStream(stream_cipher_message('xin chào', 'web', 7, brain=brain))) == 'đã lưu sẵn'
+    assert not brain.closed
+
+
+def test_client_disconnect_persists_the_partial_reply_and_skips_the_cache(cache):
+    brain, saved = ClosingBrain(), []
+    stream = ReplyStream(stream_cipher_message('xin chào', 'web', 7, brain=brain), on_complete=saved.append)
+    chunks = iter(stream)
+    received = [next(chunks) for _ in range(3)]
+    chunks.close()
+    assert saved == [''.join(received)]
+    assert brain.closed
+    assert cache.get(cache.key_for('xin chào', 'web')) is None
+
+
+def test_failed_generation_is_not_persisted(cache):
+    brain, saved = ClosingBrain(fail_after=2), []
+    stream = ReplyStream(stream_cipher_message('xin chào', 'web', 7, brain=brain), on_complete=saved.append)
+    with pytest.raises(RuntimeError):
+        list(stream)
+    assert saved == [] and not stream.completed
+    assert cache.get(cache.key_for('xin chào', 'web')) is None
+
+
+def test_shed_reply_streams_the_fallback_and_is_not_persisted(cache, monkeypatch):
+    @contextmanager
+    def shed(platform, deadline=None):
+        raise BrainOverloaded('queue_full', 'CipherH đang bận, thử lại sau nhé.')
+        yield
+
+    monkeypatch.setattr(streaming.brain_admission, 'slot', shed)
+    brain, saved = ClosingBrain(), []
+    stream = ReplyStream(stream_cipher_message('xin chào', 'web', 7, brain=brain), on_complete=saved.append)
+    assert ''.join(stream) == 'CipherH đang bận, thử lại sau nhé.'
+    assert stream.shed_reason == 'queue_full'
+    assert saved == [] and not stream.completed
+    assert cache.get(cache.key_for('xin chào', 'web')) is None
+
+
+def test_on_complete_errors_are_logged_not_raised():
+    def fail(text):
+        raise RuntimeError('db down')
+
+    stream = ReplyStream(iter(['a', 'b']), on_complete=fail)
+    assert ''.join(stream) == 'ab'
+    assert stream.completed and stream.result is None
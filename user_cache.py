@@ -0,0 +1,171 @@
+"""
+CipherH User Cache
+
+LRU/TTL cache of User rows keyed by (platform_type, platform_id), so the hot
+conversation and history endpoints skip the identity lookup for active users.
+Cached rows are detached snapshots merged into the request session without a
+query. Counters are incremented in SQL, never written back from a snapshot;
+the snapshot only mirrors the increment. Users updated or deleted through
+the ORM are evicted once the transaction commits.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from app import db
+from models import User
+
+
+class UserCache:
+    """Thread-safe LRU cache of detached User snapshots with a TTL"""
+    LOCK_STRIPES = 64
+
+    def __init__(self, max_size=10000, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _snapshot(self, user, **overrides):
+        """Copy loaded column values into a detached instance safe to share"""
+        values = {c.key: getattr(user, c.key) for c in User.__table__.columns}
+        values.update(overrides)
+        snapshot = User(**values)
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            snapshot, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return snapshot
+
+    def put(self, user):
+        key = (user.platform_type, user.platform_id)
+        snapshot = self._snapshot(user)
+        with self._lock:
+            self._entries[key] = (snapshot, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, platform_type, platform_id):
+        with self._lock:
+            if self._entries.pop((platform_type, platform_id), None) is not None:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def find(self, platform_id, platform_type):
+        """Return the user attached to the current session, or None"""
+        snapshot = self._get((platform_type, platform_id))
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+        user = User.query.filter_by(platform_id=platform_id, platform_type=platform_type).first()
+        if user:
+            self.put(user)
+        return user
+
+    def find_or_create(self, platform_id, platform_type, username=None, display_name=None):
+        """Race-safe find-or-create; concurrent first messages share one row"""
+        user = self.find(platform_id, platform_type)
+        if user:
+            return user
+
+        key_lock = self._key_locks[hash((platform_type, platform_id)) % self.LOCK_STRIPES]
+        with key_lock:
+            # Another thread may have created the user while we waited
+            user = self.find(platform_id, platform_type)
+            if user:
+                return user
+            user = User(
+                platform_id=platform_id,
+                platform_type=platform_type,
+                username=username or platform_id,
+                display_name=display_name or platform_id
+            )
+            db.session.add(user)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker process won the insert
+                db.session.rollback()
+                user = User.query.filter_by(platform_id=platform_id, platform_type=platform_type).first()
+                if user is None:
+                    raise
+            self.put(user)
+            return user
+
+    def record_activity(self, platform_id, platform_type, timestamp):
+        """Mirror a committed (or write-behind) counter increment into the cached snapshot"""
+        key = (platform_type, platform_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            # Snapshots are shared, so replace rather than mutate (merge() rejects dirty objects)
+            snapshot, expires_at = entry
+            self._entries[key] = (self._snapshot(
+                snapshot,
+                interaction_count=(snapshot.interaction_count or 0) + 1,
+                last_interaction=timestamp
+            ), expires_at)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else None
+            }
+
+
+# Global instance
+user_cache = UserCache(
+    max_size=int(os.getenv('CIPHERH_USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('CIPHERH_USER_CACHE_TTL', '300'))
+)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _queue_eviction(mapper, connection, target):
+    # Flushed values may still be rolled back; evict only once they are committed
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('cipherh_stale_users', set()).add((target.platform_type, target.platform_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_committed_users(session):
+    for platform_type, platform_id in session.info.pop('cipherh_stale_users', ()):
+        user_cache.invalidate(platform_type, platform_id)
+        logging.debug(f'CipherH: Evicted cached user {platform_type}/{platform_id}')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back_users(session):
+    session.info.pop('cipherh_stale_users', None)
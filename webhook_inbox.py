@@ -0,0 +1,243 @@
+"""
+CipherH Webhook Inbox
+
+Acknowledge-first webhook ingestion. Raw payloads are appended to a local
+SQLite database in WAL mode and acknowledged immediately. A worker pool
+then processes them with at-least-once semantics: claimed entries carry a
+lease, and if a worker dies its entries are reclaimed once the lease
+expires. An entry whose lease expires max_attempts times (one that keeps
+killing its worker) is moved to 'dead' instead of being retried. A unique (platform, event_id) key drops upstream retries.
+Workers wait a short coalescing window so bursts are handed to the
+adapters' batch path together. If a burst raises, its entries are replayed
+one at a time so a single poison payload fails alone. Enabled with
+CIPHERH_WEBHOOK_INBOX=1.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import webhook_queue_lag
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    received_at REAL NOT NULL,
+    error TEXT,
+    UNIQUE (platform, event_id)
+);
+CREATE INDEX IF NOT EXISTS inbox_ready ON inbox (status, available_at);
+"""
+
+
+class WebhookInbox:
+    """Durable append-only inbox drained by a background worker pool"""
+    def __init__(self, path, workers=4, batch_size=100, lease_seconds=60.0,
+                 max_attempts=5, retention_seconds=86400.0, coalesce_window=0.05):
+        self.enabled = os.getenv('CIPHERH_WEBHOOK_INBOX') == '1'
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.coalesce_window = coalesce_window
+        self.app = None
+        self.handler = None
+        self.batch_handler = None
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._initialized = False
+        self._stats_lock = threading.Lock()
+        self.stats = {'accepted': 0, 'duplicates': 0, 'processed': 0, 'retried': 0, 'failed': 0,
+                      'dead': 0, 'split_batches': 0}
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL + NORMAL survives process crashes without an fsync per append
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._initialized:
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def append(self, platform, event_id, raw_payload):
+        """Persist a payload; returns (inbox_id, duplicate)"""
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT OR IGNORE INTO inbox (platform, event_id, payload, available_at, received_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (platform, event_id, raw_payload, now, now)
+        )
+        if cursor.rowcount == 0:
+            self._count('duplicates')
+            return None, True
+        self._count('accepted')
+        self._wake.set()
+        return cursor.lastrowid, False
+
+    def start(self, app, handler, batch_handler=None):
+        """Start the worker pool; handler(platform, payload) processes one entry and
+        batch_handler(platform, payloads), when given, processes a coalesced burst"""
+        with self._start_lock:
+            if self._started:
+                return
+            self.app = app
+            self.handler = handler
+            self.batch_handler = batch_handler
+            for n in range(self.workers):
+                threading.Thread(target=self._worker_loop, name=f'cipherh-inbox-{n}', daemon=True).start()
+            self._started = True
+        logging.info(f'CipherH: Webhook inbox started with {self.workers} workers at {self.path}')
+
+    def claim(self):
+        """Lease up to batch_size ready entries to this worker"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Leases that expired max_attempts times: the entry keeps killing its worker
+            dead = conn.execute(
+                "UPDATE inbox SET status = 'dead', error = 'lease expired after max attempts' "
+                "WHERE status = 'processing' AND available_at <= ? AND attempts >= ?",
+                (now, self.max_attempts)
+            ).rowcount
+            rows = conn.execute(
+                "SELECT id, platform, payload, attempts, received_at FROM inbox "
+                "WHERE status IN ('pending', 'processing') AND available_at <= ? "
+                "ORDER BY id LIMIT ?",
+                (now, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE inbox SET status = 'processing', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                    [(now + self.lease_seconds, row[0]) for row in rows]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if dead:
+            self._count('dead', dead)
+            logging.error(f'CipherH: Webhook inbox moved {dead} entries to dead after {self.max_attempts} expired leases')
+        for _, platform, _, attempts, received_at in rows:
+            if not attempts:
+                # Queue lag of first deliveries; retries would add their backoff
+                webhook_queue_lag.labels(platform).observe(now - received_at)
+        return [row[:4] for row in rows]
+
+    def complete(self, entry_ids):
+        conn = self._conn()
+        conn.execute('BEGIN')
+        conn.executemany(
+            "UPDATE inbox SET status = 'done', payload = '', error = NULL WHERE id = ?",
+            [(entry_id,) for entry_id in entry_ids]
+        )
+        conn.execute('COMMIT')
+        self._count('processed', len(entry_ids))
+
+    def fail(self, entry_id, attempts, error):
+        if attempts >= self.max_attempts:
+            self._conn().execute("UPDATE inbox SET status = 'failed', error = ? WHERE id = ?", (error, entry_id))
+            self._count('failed')
+            logging.error(f'CipherH: Webhook inbox entry {entry_id} failed permanently: {error}')
+            return
+        retry_at = time.time() + min(300, 2 ** attempts)
+        self._conn().execute(
+            "UPDATE inbox SET status = 'pending', available_at = ?, error = ? WHERE id = ?",
+            (retry_at, error, entry_id)
+        )
+        self._count('retried')
+
+    def process(self, rows):
+        if self.batch_handler is None:
+            self._process_each(rows)
+            return
+
+        by_platform = {}
+        for row in rows:
+            by_platform.setdefault(row[1], []).append(row)
+        for platform, group in by_platform.items():
+            try:
+                self.batch_handler(platform, [json.loads(row[2]) for row in group])
+            except Exception as e:
+                # Replay the burst one entry at a time so only the entry that raises is failed;
+                # handlers must tolerate redelivery anyway
+                logging.error(f'CipherH: Webhook inbox batch of {len(group)} from {platform} failed, '
+                              f'retrying entries singly: {e}')
+                self._count('split_batches')
+                self._process_each(group)
+            else:
+                self.complete([row[0] for row in group])
+
+    def _process_each(self, rows):
+        done = []
+        for entry_id, platform, payload, attempts in rows:
+            try:
+                if self.batch_handler is not None:
+                    self.batch_handler(platform, [json.loads(payload)])
+                else:
+                    self.handler(platform, json.loads(payload))
+            except Exception as e:
+                logging.error(f'CipherH: Webhook inbox entry {entry_id} from {platform} failed: {e}')
+                self.fail(entry_id, attempts + 1, str(e))
+            else:
+                done.append(entry_id)
+        self.complete(done)
+
+    def purge(self):
+        """Drop finished entries past retention; their event ids stop deduplicating"""
+        cutoff = time.time() - self.retention_seconds
+        self._conn().execute("DELETE FROM inbox WHERE status IN ('done', 'failed', 'dead') AND received_at < ?", (cutoff,))
+
+    def _worker_loop(self):
+        last_purge = time.monotonic()
+        while True:
+            try:
+                rows = self.claim()
+                if rows:
+                    with self.app.app_context():
+                        self.process(rows)
+                    continue
+                if time.monotonic() - last_purge > 60:
+                    self.purge()
+                    last_purge = time.monotonic()
+            except Exception as e:
+                logging.error(f'CipherH: Webhook inbox worker error: {e}')
+            if self._wake.wait(1.0) and self.coalesce_window:
+                # Woken by a new entry: let the rest of the burst arrive before claiming
+                time.sleep(self.coalesce_window)
+            self._wake.clear()
+
+    def get_stats(self):
+        counts = dict(self._conn().execute('SELECT status, COUNT(*) FROM inbox GROUP BY status').fetchall())
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {**stats, 'enabled': self.enabled, 'by_status': counts}
+
+
+# Global instance
+webhook_inbox = WebhookInbox(
+    os.getenv('CIPHERH_WEBHOOK_INBOX_PATH', 'webhook_inbox.db'),
+    workers=int(os.getenv('CIPHERH_WEBHOOK_INBOX_WORKERS', '4')),
+    coalesce_window=float(os.getenv('CIPHERH_WEBHOOK_COALESCE_MS', '50')) / 1000
+)